@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+""" Compares the frames/sec of pyapns.server.encode_notifications with the
+encoder it replaced, and with payloads rendered from a Template.
+
+    $ python benchmarks/encode.py [notifications] [repeat]
+"""
+
+import os
+import sys
+import time
+import struct
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pyapns import _json as json
+from pyapns.server import encode_notifications
+from pyapns.template import Template
+
+
+def legacy_encode_notifications(tokens, notifications):
+  # encode_notifications as of pyapns 0.4.0
+  fmt = "!BH32sH%ds"
+  structify = lambda t, p: struct.pack(fmt % len(p), 0, 32, t, len(p), p)
+  binaryify = lambda t: t.decode('hex')
+  if type(notifications) is dict and type(tokens) in (str, unicode):
+    tokens, notifications = ([tokens], [notifications])
+  if type(notifications) is list and type(tokens) is list:
+    return ''.join(map(lambda y: structify(*y), ((binaryify(t), json.dumps(p, separators=(',',':'), ensure_ascii=False).encode('utf-8'))
+                                    for t, p in zip(tokens, notifications))))
+
+
+def bench(name, f, repeat, count):
+  best = None
+  for _ in xrange(repeat):
+    start = time.time()
+    f()
+    elapsed = time.time() - start
+    best = elapsed if best is None else min(best, elapsed)
+  print '%-40s %10.0f frames/sec' % (name, count / best)
+
+
+def main(count=100000, repeat=5):
+  tokens = ['%064x' % n for n in xrange(count)]
+  spaced = [' '.join(t[i:i+8] for i in xrange(0, 64, 8)) for t in tokens]
+  notifications = [{'aps': {'alert': 'Hello %i' % n, 'badge': n % 10}}
+                   for n in xrange(count)]
+  assert legacy_encode_notifications(tokens, notifications) == \
+         encode_notifications(tokens, notifications)
+  
+  print 'encoding %i notifications, best of %i' % (count, repeat)
+  bench('legacy (command 0)',
+    lambda: legacy_encode_notifications(
+      [t.replace(' ', '') for t in spaced], notifications), repeat, count)
+  bench('encode_notifications (command 0)',
+    lambda: encode_notifications(spaced, notifications), repeat, count)
+  bench('legacy, normalized tokens',
+    lambda: legacy_encode_notifications(tokens, notifications), repeat, count)
+  for command in (0, 1, 2):
+    bench('encode_notifications, normalized (%i)' % command,
+      lambda: encode_notifications(tokens, notifications, 1, 0, command),
+      repeat, count)
+  template = Template({'aps': {'alert': 'Hello ${n}', 'badge': '${badge}'}})
+  values = [[n % 10, n] for n in xrange(count)]
+  assert encode_notifications(tokens, [template.render(v) for v in values]) \
+         == encode_notifications(tokens, notifications)
+  bench('rendered from a template (2)',
+    lambda: encode_notifications(tokens, map(template.render, values),
+                                 1, 0, 2), repeat, count)
+
+
+if __name__ == '__main__':
+  main(*map(int, sys.argv[1:]))
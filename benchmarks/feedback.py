@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+""" Measures the records/sec of decoding feedback with
+pyapns.server.decode_feedback and its streaming and compact variants.
+
+    $ python benchmarks/feedback.py [records] [repeat]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pyapns.fake import encode_feedback
+from pyapns.server import (decode_feedback, iter_feedback,
+                           decode_feedback_compact)
+
+
+def bench(name, f, repeat, count):
+  best = None
+  for _ in xrange(repeat):
+    start = time.time()
+    f()
+    elapsed = time.time() - start
+    best = elapsed if best is None else min(best, elapsed)
+  print '%-40s %10.0f records/sec' % (name, count / best)
+
+
+def main(count=100000, repeat=5):
+  records = encode_feedback([(int(time.time()) - n, '%064x' % n)
+                             for n in xrange(count)])
+
+  print 'decoding %i feedback records, best of %i' % (count, repeat)
+  bench('decode_feedback', lambda: decode_feedback(records), repeat, count)
+  bench('iter_feedback', lambda: [r for r in iter_feedback(records)],
+        repeat, count)
+  bench('decode_feedback_compact', lambda: decode_feedback_compact(records),
+        repeat, count)
+
+
+if __name__ == '__main__':
+  main(*map(int, sys.argv[1:]))
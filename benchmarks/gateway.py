@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+""" Measures notifications end to end through pyapns.server against the
+local stand-in of pyapns.fake: notify throughput and latency through
+APNSServer, raw APNSService.write throughput, delivery while the gateway
+rejects notifications and drops connections, and feedback reads.
+
+    $ python benchmarks/gateway.py [notifications] [batch] [concurrency]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from twisted.internet import reactor, defer
+from pyapns import fake, server
+
+
+def percentile(values, p):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * p))] if values else 0
+
+def report(name, count, elapsed, latencies=None, unit='notifications'):
+  line = '%-36s %10.0f %s/sec' % (name, count / elapsed, unit)
+  if latencies:
+    line += '   latency p50 %7.2fms p99 %7.2fms' % (
+            percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000)
+  print line
+
+def settled(gateway, quiet=1.0):
+  """ Returns a Deferred firing with the time of the last notification the
+  gateway received once it received none for `quiet` seconds
+  """
+  d = defer.Deferred()
+  def check(received, last):
+    if gateway.received != received:
+      received, last = gateway.received, time.time()
+    if time.time() - last >= quiet:
+      d.callback(last)
+    else:
+      reactor.callLater(0.05, check, received, last)
+  check(gateway.received, time.time())
+  return d
+
+def provision(apns, app_id, pem, connections=1):
+  apns.xmlrpc_provision(app_id, pem, 'sandbox', 15, connections)
+  return apns.apns_service(app_id).whenConnected()
+
+def requests(count, batch):
+  tokens = ['%064x' % n for n in xrange(batch)]
+  notifications = [{'aps': {'alert': 'Hello %i' % n, 'badge': n % 10}}
+                   for n in xrange(batch)]
+  return [(tokens, notifications)] * max(1, count // batch)
+
+
+@defer.inlineCallbacks
+def bench_notify(apns, gateway, app_id, count, batch, concurrency):
+  "notify calls through APNSServer, `concurrency` of them at a time"
+  semaphore = defer.DeferredSemaphore(concurrency)
+  latencies = []
+  def call(tokens, notifications):
+    start = time.time()
+    return apns.xmlrpc_notify(app_id, tokens, notifications).addCallback(
+      lambda _: latencies.append(time.time() - start))
+  batches = requests(count, batch)
+  expected = gateway.received + len(batches) * batch
+  start = time.time()
+  yield defer.DeferredList([semaphore.run(call, *b) for b in batches])
+  yield gateway.expect(expected)
+  report('notify, %i per call' % batch, len(batches) * batch,
+         time.time() - start, latencies)
+
+@defer.inlineCallbacks
+def bench_write(apns, gateway, app_id, count, batch):
+  "APNSService.write of notifications encoded beforehand"
+  service = apns.apns_service(app_id)
+  frames = [service.encode(*b) for b in requests(count, batch)]
+  expected = gateway.received + sum(map(len, frames))
+  start = time.time()
+  yield defer.DeferredList([service.write(f) for f in frames])
+  yield gateway.expect(expected)
+  report('APNSService.write, %i per write' % batch, sum(map(len, frames)),
+         time.time() - start)
+
+@defer.inlineCallbacks
+def bench_errors(apns, gateway, app_id, count, batch, name):
+  """ notify calls while the gateway rejects notifications or drops 
+  connections. What was written to a dropped connection is lost, as with 
+  APNS, so that waits for the gateway to stop receiving.
+  """
+  service = apns.apns_service(app_id)
+  batches = requests(count, batch)
+  received = gateway.received
+  start = time.time()
+  yield defer.DeferredList([apns.xmlrpc_notify(app_id, *b) for b in batches])
+  if gateway.disconnect_every:
+    end = yield settled(gateway)
+  else:
+    yield gateway.expect(received + len(batches) * batch)
+    end = time.time()
+  stats = service.statistics()
+  report(name, gateway.received - received, end - start)
+  print '%36s %i reconnects, %i retransmitted, %i rejected, %i lost' % (
+        '', stats.get('reconnects', 0), stats.get('frames_retransmitted', 0),
+        gateway.errors, received + len(batches) * batch - gateway.received)
+
+@defer.inlineCallbacks
+def bench_feedback(apns, feedback, app_id, reads, records):
+  "xmlrpc_feedback calls, each reading the feedback service"
+  latencies = []
+  start = time.time()
+  for _ in xrange(reads):
+    call = time.time()
+    result = yield apns.xmlrpc_feedback(app_id)
+    assert len(result) == records
+    latencies.append(time.time() - call)
+  report('feedback, %i records per read' % records, reads, time.time() - start,
+         latencies, 'reads')
+
+
+@defer.inlineCallbacks
+def run(count, batch, concurrency):
+  pem = fake.self_signed_pem()
+  records = 10000
+  gateway, feedback, gateway_port, feedback_port = fake.listen(
+    pem, feedback=fake.FakeFeedbackFactory(
+      [[(int(time.time()), '%064x' % n) for n in xrange(records)]], True))
+  failing, _, failing_port, _ = fake.listen(pem, fake.FakeGatewayFactory(
+    error_every=max(2, count // 5)))
+  dropping, _, dropping_port, _ = fake.listen(pem, fake.FakeGatewayFactory(
+    disconnect_every=max(2, count // 5)))
+  apns = server.APNSServer()
+  apns.dead_tokens = False # the feedback would mark the tokens dead
+
+  print '%i notifications, %i per call, %i calls at a time' % (
+        count, batch, concurrency)
+  fake.redirect('127.0.0.1', gateway_port, feedback_port)
+  yield provision(apns, 'bench', pem)
+  yield provision(apns, 'bench-pool', pem, 4)
+  yield bench_notify(apns, gateway, 'bench', count, batch, concurrency)
+  yield bench_notify(apns, gateway, 'bench', count // 10, 1, concurrency)
+  yield bench_notify(apns, gateway, 'bench-pool', count, batch, concurrency)
+  yield bench_write(apns, gateway, 'bench', count, batch)
+
+  fake.redirect('127.0.0.1', failing_port, feedback_port)
+  yield provision(apns, 'bench-errors', pem, 2)
+  yield bench_errors(apns, failing, 'bench-errors', count, batch,
+                     'notify, error responses')
+  fake.redirect('127.0.0.1', dropping_port, feedback_port)
+  yield provision(apns, 'bench-drops', pem, 2)
+  yield bench_errors(apns, dropping, 'bench-drops', count, batch,
+                     'notify, dropped connections')
+
+  yield bench_feedback(apns, feedback, 'bench', 20, records)
+
+def main(count=100000, batch=100, concurrency=10):
+  def done(r):
+    reactor.stop()
+    return r
+  reactor.callWhenRunning(lambda: run(count, batch, concurrency).addBoth(done))
+  reactor.run()
+
+
+if __name__ == '__main__':
+  main(*map(int, sys.argv[1:]))
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+""" Compares the CPU cost of getting notify and broadcast requests to the 
+daemon through XML-RPC and through the compact ingestion protocol, 
+measuring the client side encoding and the daemon side decoding.
+
+    $ python benchmarks/ingest.py [tokens] [repeat]
+"""
+
+import os
+import sys
+import time
+import xmlrpclib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pyapns import wire
+
+
+def bench(name, encode, decode, repeat, count):
+  best_encode = best_decode = None
+  for _ in xrange(repeat):
+    start = time.time()
+    body = encode()
+    middle = time.time()
+    decode(body)
+    end = time.time()
+    best_encode = min(best_encode or middle - start, middle - start)
+    best_decode = min(best_decode or end - middle, end - middle)
+  print '%-28s %9i bytes %10.0f tokens/sec encode %10.0f tokens/sec decode' % (
+        name, len(body), count / best_encode, count / best_decode)
+
+
+def main(count=100000, repeat=5):
+  tokens = ['%064x' % n for n in xrange(count)]
+  notifications = [{'aps': {'alert': 'Hello %i' % n, 'badge': n % 10}}
+                   for n in xrange(count)]
+  notification = {'aps': {'alert': 'Hello everyone'}}
+  
+  print 'requests with %i tokens, best of %i' % (count, repeat)
+  bench('notify xml-rpc',
+    lambda: xmlrpclib.dumps(('app', tokens, notifications), 'notify'),
+    xmlrpclib.loads, repeat, count)
+  bench('notify json',
+    lambda: wire.json_request(1, 'notify', ['app', tokens, notifications]),
+    wire.parse_request, repeat, count)
+  bench('notify binary',
+    lambda: wire.binary_request(1, 'notify', 'app', tokens, notifications),
+    wire.parse_request, repeat, count)
+  bench('broadcast xml-rpc',
+    lambda: xmlrpclib.dumps(('app', tokens, notification), 'broadcast'),
+    xmlrpclib.loads, repeat, count)
+  bench('broadcast json',
+    lambda: wire.json_request(1, 'broadcast', ['app', tokens, notification]),
+    wire.parse_request, repeat, count)
+  bench('broadcast binary',
+    lambda: wire.binary_request(1, 'broadcast', 'app', tokens, notification),
+    wire.parse_request, repeat, count)
+
+
+if __name__ == '__main__':
+  main(*map(int, sys.argv[1:]))
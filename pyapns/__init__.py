@@ -1 +1,8 @@
-from .client import notify, provision, feedback, configure__version__ = "0.4.0"__author__ = "Samuel Sutch"__license__ = "MIT"__copyright__ = "Copyrighit 2012 Samuel Sutch"
\ No newline at end of file
+import sys
+if sys.version_info < (3,): # pyapns.aioclient is all there is for Python 3
+  from .client import (notify, broadcast, provision, feedback, register,
+                       template, notify_template, configure, Batcher)
+__version__ = "0.4.0"
+__author__ = "Samuel Sutch"
+__license__ = "MIT"
+__copyright__ = "Copyrighit 2012 Samuel Sutch"
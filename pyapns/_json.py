@@ -19,3 +19,10 @@ except AttributeError:
 
 loads = json.loads
 dumps = json.dumps
+
+try: # reuse one encoder, dumps creates a new one for every call with options
+  compact_dumps = json.JSONEncoder(separators=(',',':'), 
+                                   ensure_ascii=False).encode
+except AttributeError:
+  compact_dumps = lambda obj: dumps(obj, separators=(',',':'), 
+                                    ensure_ascii=False)
@@ -0,0 +1,267 @@
+""" An asyncio client for Python 3 programs. It has `provision`, `notify`,
+`broadcast`, `feedback`, `register`, `template` and `notify_template`
+coroutines taking the same arguments as those of pyapns.client, without
+async/callback/errback:
+
+    from pyapns import aioclient
+
+    async def send():
+      aioclient.configure({'HOST': 'tcp://localhost:7078/'})
+      await aioclient.provision('myapp', cert, 'sandbox')
+      rejected = await aioclient.notify('myapp', tokens, notifications)
+
+Requests go over the compact ingestion listener of the daemon as JSON
+messages (see pyapns/wire.py), so `HOST` is tcp://host:port/ or
+unix:///path/to/socket. They are pipelined on a pool of at most
+`CONNECTIONS` connections and at most `CONCURRENCY` are in flight at a
+time, the others wait their turn. Requests failing with an unknown app_id
+provision `INITIAL` and are retried once, like with pyapns.client.
+
+This module is standalone, it doesn't use the rest of pyapns which runs on
+Python 2 and isn't imported by the pyapns package.
+"""
+
+import asyncio
+import base64
+import datetime
+import itertools
+import json
+import struct
+import time
+from xmlrpc.client import Fault
+
+LENGTH = struct.Struct('!I')
+MAX_LENGTH = 64*1024*1024
+
+OPTIONS = {'CONFIGURED': False, 'TIMEOUT': 20, 'CONNECTIONS': 4,
+           'CONCURRENCY': 100}
+
+
+class UnknownAppID(Exception): pass
+class APNSNotConfigured(Exception): pass
+
+
+def configure(opts):
+  """ Takes the HOST, TIMEOUT, CONNECTIONS, CONCURRENCY and INITIAL options
+  of pyapns.client.configure. Unlike there, INITIAL app_ids are provisioned
+  on the first request that fails with an unknown app_id.
+  """
+  if not OPTIONS['CONFIGURED']:
+    OPTIONS.update(opts)
+    OPTIONS['CONFIGURED'] = True
+  return OPTIONS['CONFIGURED']
+
+
+def _default(obj):
+  if isinstance(obj, datetime.datetime):
+    return {'$datetime': time.mktime(obj.timetuple())}
+  if isinstance(obj, (bytes, bytearray)):
+    return {'$binary': base64.b64encode(obj).decode('ascii')}
+  raise TypeError('%r is not JSON serializable' % (obj,))
+
+def _object_hook(obj):
+  if '$datetime' in obj:
+    return datetime.datetime.fromtimestamp(obj['$datetime'])
+  if '$binary' in obj:
+    return base64.b64decode(obj['$binary'])
+  return obj
+
+
+class Connection(object):
+  """ One connection to the compact ingestion listener, requests are sent
+  without waiting for the responses to the previous ones.
+  """
+
+  def __init__(self, reader, writer):
+    self.reader = reader
+    self.writer = writer
+    self.pending = {} # {id: Future}
+    self.ids = itertools.count(1)
+    self.closed = False
+    self.receiving = asyncio.ensure_future(self.receive())
+
+  async def call(self, method, params, timeout):
+    id = next(self.ids) % 2**32
+    body = b'J' + json.dumps({'id': id, 'method': method,
+                              'params': list(params)},
+                             default=_default).encode('utf-8')
+    future = asyncio.get_running_loop().create_future()
+    self.pending[id] = future
+    self.writer.write(LENGTH.pack(len(body)) + body)
+    try:
+      await self.writer.drain()
+      return await asyncio.wait_for(asyncio.shield(future), timeout)
+    except asyncio.TimeoutError:
+      raise asyncio.TimeoutError('No response from the pyapns daemon')
+    finally:
+      self.pending.pop(id, None)
+
+  async def receive(self):
+    error = ConnectionError('Connection to the pyapns daemon lost')
+    try:
+      while True:
+        length, = LENGTH.unpack(await self.reader.readexactly(LENGTH.size))
+        if length > MAX_LENGTH:
+          raise ValueError('Response of %i bytes is too long' % length)
+        message = json.loads(await self.reader.readexactly(length),
+                             object_hook=_object_hook)
+        future = self.pending.pop(message['id'], None)
+        if future is None or future.done():
+          continue # timed out already
+        if message.get('error'):
+          future.set_exception(Fault(message['error']['code'],
+                                     message['error']['message']))
+        else:
+          future.set_result(message.get('result'))
+    except (asyncio.IncompleteReadError, OSError, ValueError) as e:
+      if not isinstance(e, asyncio.IncompleteReadError):
+        error = e
+    finally:
+      self.closed = True
+      self.writer.close()
+      pending, self.pending = self.pending, {}
+      for future in pending.values():
+        if not future.done():
+          future.set_exception(error)
+
+  def close(self):
+    self.receiving.cancel()
+
+
+class Client(object):
+  """ Calls the pyapns daemon at `host` (see the module documentation) with
+  at most `concurrency` requests in flight on at most `connections`
+  connections. `timeout` is in seconds for connecting and for each response,
+  with None responses are waited for as long as they take. `initial` is a
+  list of provision arguments to reprovision with when the daemon doesn't
+  know an app_id.
+  """
+
+  def __init__(self, host, connections=4, concurrency=100, timeout=20,
+               initial=None):
+    self.host = host
+    self.connections = connections
+    self.timeout = timeout
+    self.initial = initial
+    self.semaphore = asyncio.Semaphore(concurrency)
+    self.pool = []
+    self.connecting = None # Future of the connection being opened
+
+  async def connect(self):
+    scheme, _, address = self.host.partition('://')
+    if scheme == 'unix':
+      opened = asyncio.open_unix_connection(address)
+    elif scheme == 'tcp':
+      host, port = address.strip('/').rsplit(':', 1)
+      opened = asyncio.open_connection(host, int(port))
+    else:
+      raise ValueError('HOST must be a tcp:// or unix:// address, not %r' %
+                       self.host)
+    reader, writer = await asyncio.wait_for(opened, self.timeout or 30)
+    return Connection(reader, writer)
+
+  async def connection(self):
+    "Returns the least loaded connection, opening one if need be"
+    self.pool = [c for c in self.pool if not c.closed]
+    if self.pool:
+      best = min(self.pool, key=lambda c: len(c.pending))
+      if not best.pending or len(self.pool) >= self.connections or \
+          self.connecting is not None:
+        return best
+    if self.connecting is None:
+      self.connecting = asyncio.ensure_future(self.connect())
+      try:
+        connection = await self.connecting
+      finally:
+        self.connecting = None
+      self.pool.append(connection)
+      return connection
+    return await asyncio.shield(self.connecting)
+
+  async def call(self, method, *params):
+    "Returns the result of an XML-RPC method"
+    try:
+      return await self.request(method, params)
+    except UnknownAppID:
+      if not self.initial:
+        raise
+    await asyncio.gather(*[self.request('provision', args)
+                           for args in self.initial])
+    return await self.request(method, params)
+
+  async def request(self, method, params):
+    async with self.semaphore:
+      connection = await self.connection()
+      try:
+        return await connection.call(method, params, self.timeout)
+      except Fault as e:
+        if e.faultCode == 404:
+          raise UnknownAppID()
+        raise
+
+  def close(self):
+    "Closes the connections to the daemon"
+    for connection in self.pool:
+      connection.close()
+    self.pool = []
+
+
+_clients = {}
+
+def _client():
+  "Returns the Client for the configured HOST on the running event loop"
+  if not OPTIONS['CONFIGURED']:
+    raise APNSNotConfigured('APNS Has not been configured.')
+  key = (OPTIONS['HOST'], OPTIONS['TIMEOUT'], asyncio.get_running_loop())
+  if key not in _clients:
+    _clients[key] = Client(OPTIONS['HOST'], OPTIONS['CONNECTIONS'],
+                           OPTIONS['CONCURRENCY'], OPTIONS['TIMEOUT'],
+                           OPTIONS.get('INITIAL'))
+  return _clients[key]
+
+async def provision(app_id, path_to_cert, environment, timeout=15,
+                    connections=1, http2=None):
+  args = [app_id, path_to_cert, environment, timeout]
+  if connections != 1 or http2:
+    args.append(connections)
+  if http2:
+    args.append(http2)
+  return await _client().call('provision', *args)
+
+async def notify(app_id, tokens, notifications, expiry=None, bulk=False):
+  args = [app_id, tokens, notifications]
+  if expiry is not None or bulk:
+    args.append(expiry or 0)
+  if bulk:
+    args.append(True)
+  return await _client().call('notify', *args)
+
+async def broadcast(app_id, tokens, notification, expiry=None):
+  args = [app_id, tokens, notification]
+  if expiry is not None:
+    args.append(expiry)
+  return await _client().call('broadcast', *args)
+
+async def template(app_id, name, notification):
+  return await _client().call('template', app_id, name, notification)
+
+async def notify_template(app_id, name, tokens, values, expiry=None,
+                          bulk=False):
+  args = [app_id, name, tokens, values]
+  if expiry is not None or bulk:
+    args.append(expiry or 0)
+  if bulk:
+    args.append(True)
+  return await _client().call('notify_template', *args)
+
+async def feedback(app_id, since=None):
+  args = [app_id]
+  if since is not None:
+    args.extend([False, since])
+  return await _client().call('feedback', *args)
+
+async def register(app_id, tokens, registered=None):
+  args = [app_id, tokens]
+  if registered is not None:
+    args.append(registered)
+  return await _client().call('register', *args)
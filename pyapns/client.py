@@ -2,9 +2,16 @@ import xmlrpclib
 import threading
 import httplib
 import functools
+import atexit
+import time
+import traceback
+import Queue
+import socket
+import wire
 from sys import hexversion
 
-OPTIONS = {'CONFIGURED': False, 'TIMEOUT': 20}
+OPTIONS = {'CONFIGURED': False, 'TIMEOUT': 20, 'WORKERS': 4, 
+           'QUEUE_SIZE': 1000}
 
 def configure(opts):
   if not OPTIONS['CONFIGURED']:
@@ -43,28 +50,22 @@ class APNSNotConfigured(Exception): pass
 
 def reprovision_and_retry(func):
   """
-  Wraps the `errback` callback of the API functions, automatically trying to
-  re-provision if the app ID can not be found during the operation. If that's
-  unsuccessful, it will raise the UnknownAppID error.
+  Wraps a call to the daemon, automatically trying to re-provision if the
+  app ID can not be found during the operation and calling it once more. 
+  This happens in the calling thread, for asynchronous calls the worker 
+  thread that holds the request. If that's unsuccessful, it will raise the
+  UnknownAppID error.
   """
   @functools.wraps(func)
   def wrapper(*a, **kw):
-    errback = kw.get('errback', None)
-    if errback is None:
-      def errback(e):
-        raise e
-    def errback_wrapper(e):
-      if isinstance(e, UnknownAppID) and 'INITIAL' in OPTIONS:
-        try:
-          for initial in OPTIONS['INITIAL']:
-            provision(*initial) # retry provisioning the initial setup
-          func(*a, **kw) # and try the function once more
-        except Exception, new_exc:
-          errback(new_exc) # throwing the new exception
-      else:
-        errback(e) # not an instance of UnknownAppID - nothing we can do here
-    kw['errback'] = errback_wrapper
-    return func(*a, **kw)
+    try:
+      return func(*a, **kw)
+    except UnknownAppID:
+      if 'INITIAL' not in OPTIONS:
+        raise
+    for initial in OPTIONS['INITIAL']:
+      provision(*initial) # retry provisioning the initial setup
+    return func(*a, **kw) # and try the function once more
   return wrapper
 
 def default_callback(func):
@@ -76,57 +77,366 @@ def default_callback(func):
   return wrapper
 
 @default_callback
-@reprovision_and_retry
 def provision(app_id, path_to_cert, environment, timeout=15, async=False, 
-              callback=None, errback=None):
+              callback=None, errback=None, connections=1, http2=None):
   args = [app_id, path_to_cert, environment, timeout]
+  if connections != 1 or http2:
+    args.append(connections)
+  if http2:
+    args.append(http2)
   f_args = ['provision', args, callback, errback]
   if not async:
     return _xmlrpc_thread(*f_args)
-  t = threading.Thread(target=_xmlrpc_thread, args=f_args)
-  t.daemon = True
-  t.start()
+  _submit(f_args)
 
 @default_callback
-@reprovision_and_retry
 def notify(app_id, tokens, notifications, async=False, callback=None, 
-           errback=None):
+           errback=None, expiry=None, bulk=False):
   args = [app_id, tokens, notifications]
+  if expiry is not None or bulk:
+    args.append(expiry or 0)
+  if bulk:
+    args.append(True)
   f_args = ['notify', args, callback, errback]
   if not async:
     return _xmlrpc_thread(*f_args)
-  t = threading.Thread(target=_xmlrpc_thread, args=f_args)
-  t.daemon = True
-  t.start()
+  _submit(f_args)
 
 @default_callback
-@reprovision_and_retry
-def feedback(app_id, async=False, callback=None, errback=None):
+def template(app_id, name, notification, async=False, callback=None,
+             errback=None):
+  f_args = ['template', [app_id, name, notification], callback, errback]
+  if not async:
+    return _xmlrpc_thread(*f_args)
+  _submit(f_args)
+
+@default_callback
+def notify_template(app_id, name, tokens, values, async=False, callback=None,
+                    errback=None, expiry=None, bulk=False):
+  args = [app_id, name, tokens, values]
+  if expiry is not None or bulk:
+    args.append(expiry or 0)
+  if bulk:
+    args.append(True)
+  f_args = ['notify_template', args, callback, errback]
+  if not async:
+    return _xmlrpc_thread(*f_args)
+  _submit(f_args)
+
+@default_callback
+def broadcast(app_id, tokens, notification, async=False, callback=None,
+              errback=None, expiry=None):
+  args = [app_id, tokens, notification]
+  if expiry is not None:
+    args.append(expiry)
+  f_args = ['broadcast', args, callback, errback]
+  if not async:
+    return _xmlrpc_thread(*f_args)
+  _submit(f_args)
+
+@default_callback
+def feedback(app_id, async=False, callback=None, errback=None, since=None):
   args = [app_id]
+  if since is not None:
+    args.extend([False, since])
   f_args = ['feedback', args, callback, errback]
   if not async:
     return _xmlrpc_thread(*f_args)
-  t = threading.Thread(target=_xmlrpc_thread, args=f_args)
-  t.daemon = True
-  t.start()
+  _submit(f_args)
+
+@default_callback
+def register(app_id, tokens, registered=None, async=False, callback=None,
+             errback=None):
+  args = [app_id, tokens]
+  if registered is not None:
+    args.append(registered)
+  f_args = ['register', args, callback, errback]
+  if not async:
+    return _xmlrpc_thread(*f_args)
+  _submit(f_args)
+
+class NotifyResult(object):
+  """ The outcome of a notification queued on a Batcher. `callback` or 
+  `errback` are executed in the sending thread once its batch was sent.
+  """
+  
+  def __init__(self, callback=None, errback=None):
+    self.event = threading.Event()
+    self.callback = callback
+    self.errback = errback
+    self.result = None
+    self.exception = None
+  
+  def done(self):
+    return self.event.is_set()
+  
+  def wait(self, timeout=None):
+    """ Blocks until the notification was sent and returns the result of 
+    the `notify` call, raising its exception if there was one.
+    """
+    if not self.event.wait(timeout):
+      raise Exception('Notification not sent after %s seconds' % timeout)
+    if self.exception is not None:
+      raise self.exception
+    return self.result
+  
+  def _set(self, result=None, exception=None):
+    self.result, self.exception = result, exception
+    self.event.set()
+    if exception is None and self.callback is not None:
+      self.callback(result)
+    elif exception is not None and self.errback is not None:
+      self.errback(exception)
+
+
+class Batcher(object):
+  """ Collects notifications per app_id and sends each app_id's as one 
+  `notify` call once `size` of them are waiting or `interval` seconds 
+  after the first of them was queued. Batches are sent from a background 
+  thread, call `close` (also done at exit) to send what is left and stop it.
+  
+    >>> batcher = Batcher(size=500, interval=0.25)
+    >>> result = batcher.notify('myapp', token, {'aps': {'alert': 'Hello!'}})
+    >>> result.wait()
+  """
+  
+  def __init__(self, size=1000, interval=0.5):
+    self.size = size
+    self.interval = interval
+    self.lock = threading.Condition()
+    # {(app_id, expiry): (queued_at, tokens, notifications, 
+    #                     [(result, first index, count)])}
+    self.pending = {}
+    self.closed = False
+    self.thread = threading.Thread(target=self._run)
+    self.thread.daemon = True
+    self.thread.start()
+    atexit.register(self.close)
+  
+  def notify(self, app_id, tokens, notifications, callback=None, errback=None,
+             expiry=None):
+    """ Queues notifications like `notify` and returns a NotifyResult for 
+    them. Its result is None, or the [index, reason] of the ones the server
+    rejected, indexed like `tokens`.
+    """
+    if not isinstance(tokens, list):
+      tokens, notifications = [tokens], [notifications]
+    elif isinstance(notifications, dict):
+      notifications = [notifications] * len(tokens) # sent to every token
+    # the server leaves out tokens or notifications without a counterpart
+    count = min(len(tokens), len(notifications))
+    tokens, notifications = tokens[:count], notifications[:count]
+    result = NotifyResult(callback, errback)
+    with self.lock:
+      if self.closed:
+        raise Exception('Batcher is closed.')
+      key = (app_id, expiry)
+      if key not in self.pending:
+        self.pending[key] = (time.time(), [], [], [])
+        self.lock.notify() # start timing the interval
+      queued_at, batch_tokens, batch_notifications, results = self.pending[key]
+      results.append((result, len(batch_tokens), len(tokens)))
+      batch_tokens.extend(tokens)
+      batch_notifications.extend(notifications)
+      if len(batch_tokens) >= self.size:
+        self.lock.notify()
+    return result
+  
+  def flush(self):
+    "Sends everything that is queued from the calling thread"
+    with self.lock:
+      pending, self.pending = self.pending, {}
+    self._send(pending)
+  
+  def close(self, timeout=None):
+    "Sends what is left and stops the background thread"
+    with self.lock:
+      self.closed = True
+      self.lock.notify()
+    if self.thread.is_alive() and self.thread is not threading.current_thread():
+      self.thread.join(timeout)
+  
+  def _due(self, now):
+    return dict((key, batch) for key, batch in self.pending.iteritems()
+                if self.closed or len(batch[1]) >= self.size
+                or now - batch[0] >= self.interval)
+  
+  def _run(self):
+    while True:
+      with self.lock:
+        due = self._due(time.time())
+        while not due and not self.closed:
+          oldest = min([batch[0] for batch in self.pending.values()] or [None])
+          self.lock.wait(None if oldest is None
+                         else max(0, oldest + self.interval - time.time()))
+          due = self._due(time.time())
+        for key in due:
+          del self.pending[key]
+        closed = self.closed
+      self._send(due)
+      if closed:
+        return
+  
+  def _send(self, batches):
+    for (app_id, expiry), (_, tokens, notifications, results) in batches.items():
+      def callback(r, results=results):
+        for result, start, count in results:
+          # the notifications the server rejected, as [index, reason]
+          rejected = [[n - start, reason] for n, reason in (r or ())
+                      if start <= n < start + count]
+          result._set(result=rejected or None)
+      def errback(e, results=results):
+        for result, _, _ in results:
+          result._set(exception=e)
+      try:
+        notify(app_id, tokens, notifications, callback=callback, 
+               errback=errback, expiry=expiry)
+      except Exception, e:
+        errback(e)
+
+
+_pool = {'queue': None, 'workers': []}
+_pool_lock = threading.Lock()
+_local = threading.local()
+
+def _submit(f_args):
+  """ Queues an asynchronous request for the worker threads, blocking while
+  QUEUE_SIZE requests are already waiting.
+  """
+  with _pool_lock:
+    if _pool['queue'] is None:
+      _pool['queue'] = Queue.Queue(OPTIONS['QUEUE_SIZE'])
+      for _ in xrange(OPTIONS['WORKERS']):
+        t = threading.Thread(target=_worker, args=[_pool['queue']])
+        t.daemon = True
+        t.start()
+        _pool['workers'].append(t)
+  _pool['queue'].put(f_args)
+
+def _worker(queue):
+  while True:
+    f_args = queue.get()
+    try:
+      _xmlrpc_thread(*f_args)
+    except Exception:
+      traceback.print_exc()
+    finally:
+      queue.task_done()
+
+def _server_proxy():
+  "Returns this thread's ServerProxy, which keeps its connection open"
+  key = (OPTIONS['HOST'], OPTIONS['TIMEOUT'])
+  if getattr(_local, 'key', None) != key:
+    if OPTIONS['HOST'].startswith(('tcp://', 'unix://')):
+      _local.proxy = BinaryProxy(OPTIONS['HOST'], timeout=OPTIONS['TIMEOUT'])
+    else:
+      _local.proxy = ServerProxy(OPTIONS['HOST'], allow_none=True, 
+                                 use_datetime=True, timeout=OPTIONS['TIMEOUT'])
+    _local.key = key
+  return _local.proxy
 
 def _xmlrpc_thread(method, args, callback, errback=None):
   if not configure({}):
     raise APNSNotConfigured('APNS Has not been configured.')
-  proxy = ServerProxy(OPTIONS['HOST'], allow_none=True, use_datetime=True,
-                      timeout=OPTIONS['TIMEOUT'])
+  try:
+    result = _call(method, args)
+  except (xmlrpclib.Fault, UnknownAppID), e:
+    if errback is not None:
+      return errback(e)
+    raise e
+  return callback(result)
+
+@reprovision_and_retry
+def _call(method, args):
+  proxy = _server_proxy()
   try:
     parts = method.strip().split('.')
     for part in parts:
       proxy = getattr(proxy, part)
-    return callback(proxy(*args))
+    return proxy(*args)
   except xmlrpclib.Fault, e:
     if e.faultCode == 404:
-      e = UnknownAppID()
-    if errback is not None:
-      errback(e)
+      raise UnknownAppID()
+    raise
+
+
+class BinaryProxy(object):
+  """ Calls the pyapns daemon through its compact ingestion listener 
+  (see pyapns.wire) instead of XML-RPC. `url` is either tcp://host:port/ or
+  unix:///path/to/socket. Errors are raised as xmlrpclib.Fault like with
+  ServerProxy.
+  """
+  
+  def __init__(self, url, timeout=20):
+    self.url = url
+    self.timeout = timeout
+    self.sock = None
+    self.id = 0
+  
+  def __getattr__(self, method):
+    if method.startswith('_'):
+      raise AttributeError(method)
+    return functools.partial(self._call, method)
+  
+  def _connect(self):
+    scheme, _, address = self.url.partition('://')
+    if scheme == 'unix':
+      sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     else:
-      raise e
+      host, port = address.strip('/').rsplit(':', 1)
+      address = (host, int(port))
+      sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(self.timeout)
+    sock.connect(address)
+    return sock
+  
+  def _close(self):
+    if self.sock is not None:
+      self.sock.close()
+      self.sock = None
+  
+  def _call(self, method, *params):
+    self.id = (self.id + 1) % 2**32
+    body = None
+    if method in ('notify', 'broadcast') and 3 <= len(params) <= 4:
+      body = wire.binary_request(self.id, method, *params)
+    if body is None:
+      body = wire.json_request(self.id, method, params)
+    message = wire.pack(body)
+    reused = self.sock is not None
+    try:
+      if self.sock is None:
+        self.sock = self._connect()
+      try:
+        self.sock.sendall(message)
+      except socket.error:
+        if not reused:
+          raise
+        # the daemon closed the idle connection, try a fresh one once
+        self._close()
+        self.sock = self._connect()
+        self.sock.sendall(message)
+      id, result, error = wire.parse_response(self._read())
+    except:
+      self._close()
+      raise
+    if error:
+      raise xmlrpclib.Fault(*error)
+    return result
+  
+  def _read(self):
+    length, = wire.LENGTH.unpack(self._recv(wire.LENGTH.size))
+    return self._recv(length)
+  
+  def _recv(self, size):
+    chunks = []
+    while size:
+      chunk = self.sock.recv(min(size, 1024*1024))
+      if not chunk:
+        raise socket.error('Connection closed by the pyapns daemon')
+      chunks.append(chunk)
+      size -= len(chunk)
+    return ''.join(chunks)
 
 
 ## --------------------------------------------------------------
@@ -146,8 +456,12 @@ class TimeoutTransport(xmlrpclib.Transport):
         conn = TimeoutHTTP(host)
         conn.set_timeout(self.timeout)
     else:
+        # keep the connection open between requests like xmlrpclib does
+        if self._connection and host == self._connection[0]:
+          return self._connection[1]
         conn = TimeoutHTTPConnection(host)
         conn.timeout = self.timeout
+        self._connection = host, conn
     return conn
 
 class TimeoutHTTPConnection(httplib.HTTPConnection):
@@ -0,0 +1,110 @@
+import collections
+from twisted.internet import reactor, defer
+from twisted.python import log
+
+
+class Coalescer(object):
+  """ Holds the notifications of an app_id that carry a collapse key, the
+  `key` member of the notification dict, for up to `window` seconds and
+  then sends only the latest one per token and collapse key. Badge and
+  count updates sent in a burst to the same device so cost one notification.
+  Notifications without a collapse key are sent right away. The collapse
+  key is taken out of the notifications, it is not sent to APNS.
+
+  `send(app_id, tokens, notifications, expiry, lane)` is called with what
+  is left at the end of a window, like APNSServer.send.
+  """
+
+  def __init__(self, send, window=0, key='collapse_id'):
+    self.send = send
+    self.window = window # seconds, 0 to send app_ids right away
+    self.key = key
+    self.windows = {} # {'app_id': seconds}
+    self.held = {} # {'app_id': {(token, collapse key): (token, notification,
+                   #             expiry, lane)}}
+    self.calls = {} # {'app_id': DelayedCall of its flush}
+
+  def configure(self, app_id, window):
+    "Sets the window of an app_id in seconds, 0 to not hold its notifications"
+    self.windows[app_id] = window
+
+  def hold(self, app_id, service, tokens, notifications, expiry=0, lane=0):
+    """ Holds the notifications with a collapse key. Returns the tokens and
+    notifications to send right away and the index in the arguments of each
+    of them, None when nothing was held.
+    """
+    window = self.windows.get(app_id, self.window)
+    if type(notifications) is not list:
+      notifications = self.strip(notifications)
+    if not window:
+      if type(notifications) is list:
+        notifications = map(self.strip, notifications)
+      return tokens, notifications, None
+    if type(notifications) is dict and type(tokens) in (str, unicode):
+      tokens, notifications = [tokens], [notifications]
+    if type(tokens) is not list or type(notifications) is not list:
+      return tokens, notifications, None
+    if app_id not in self.held:
+      self.held[app_id] = collections.OrderedDict()
+      service.coalescing = self.held[app_id]
+    held = self.held[app_id]
+    count = min(len(tokens), len(notifications))
+    indexes, waiting, coalesced = [], len(held), 0
+    for n in xrange(count):
+      token, notification = tokens[n], notifications[n]
+      key = None
+      if type(notification) is dict:
+        key = notification.get(self.key)
+      if type(key) not in (str, unicode, int) or \
+         type(token) not in (str, unicode):
+        indexes.append(n)
+        continue
+      key = token.lower(), key
+      if key in held:
+        coalesced += 1
+      held[key] = token, self.strip(notification), expiry, lane
+    if len(indexes) == count:
+      return tokens, map(self.strip, notifications), None
+    service.stats.incr('notifications_held', count - len(indexes))
+    if coalesced:
+      service.stats.incr('notifications_coalesced', coalesced)
+    if not waiting and app_id not in self.calls:
+      self.calls[app_id] = reactor.callLater(window, self.flush, app_id)
+    return ([tokens[n] for n in indexes],
+            [self.strip(notifications[n]) for n in indexes], indexes)
+
+  def strip(self, notification):
+    "Returns the notification without its collapse key"
+    if type(notification) is dict and self.key in notification:
+      notification = dict(notification)
+      del notification[self.key]
+    return notification
+
+  def flush(self, app_id):
+    "Sends the held notifications of an app_id, returns a Deferred"
+    call = self.calls.pop(app_id, None)
+    if call is not None and call.active():
+      call.cancel()
+    held = self.held.get(app_id)
+    if not held:
+      return defer.succeed(None)
+    groups = collections.OrderedDict() # {(expiry, lane): (tokens, dicts)}
+    for token, notification, expiry, lane in held.itervalues():
+      tokens, notifications = groups.setdefault((expiry, lane), ([], []))
+      tokens.append(token)
+      notifications.append(notification)
+    held.clear()
+    def sent(r, count):
+      if r:
+        log.msg('Coalescer %i of %i notifications for %s not sent: %s' % (
+                len(r), count, app_id, r[0][1]))
+    return defer.DeferredList([
+      defer.maybeDeferred(self.send, app_id, tokens, notifications, expiry,
+                          lane).addCallbacks(sent, log.err,
+                                             callbackArgs=(len(tokens),))
+      for (expiry, lane), (tokens, notifications) in groups.iteritems()])
+
+  def flushAll(self):
+    "Sends every held notification, returns a Deferred"
+    return defer.DeferredList([self.flush(app_id) for app_id in self.held
+                               if self.held[app_id]])
@@ -0,0 +1,98 @@
+import struct
+import hashlib
+import anydbm
+from twisted.python import log
+
+
+TIMESTAMP = struct.Struct('!l')
+
+
+class BloomFilter(object):
+  """ A set of binary tokens that may answer yes for tokens it doesn't hold
+  but never no for one it does, using `bits` bits of memory.
+  """
+
+  def __init__(self, bits, hashes=4):
+    self.bits = bits
+    self.hashes = hashes
+    self.array = bytearray((bits + 7) // 8)
+
+  def _positions(self, token):
+    digest = hashlib.md5(token).digest()
+    return [n % self.bits for n in
+            struct.unpack('!4I', digest)[:self.hashes]]
+
+  def add(self, token):
+    for p in self._positions(token):
+      self.array[p >> 3] |= 1 << (p & 7)
+
+  def __contains__(self, token):
+    for p in self._positions(token):
+      if not self.array[p >> 3] & (1 << (p & 7)):
+        return False
+    return True
+
+
+class DeadTokens(object):
+  """ Binary tokens the feedback service reported inactive, with the time
+  they went inactive. Kept in a dict, or in a dbm file at `path` so it
+  persists. With `bloom_bits` a BloomFilter in front answers most lookups of
+  live tokens without touching the store, which bounds the memory used for
+  very large dbm backed indexes.
+  """
+
+  def __init__(self, path=None, bloom_bits=0):
+    self.path = path
+    if path is not None:
+      self.store = anydbm.open(path, 'c')
+    else:
+      self.store = {}
+    self.bloom = None
+    if bloom_bits:
+      self.bloom = BloomFilter(bloom_bits)
+      for token in self.store.keys():
+        self.bloom.add(token)
+
+  def __len__(self):
+    return len(self.store)
+
+  def __contains__(self, token):
+    if self.bloom is not None and token not in self.bloom:
+      return False
+    return self.store.has_key(token)
+
+  def get(self, token):
+    "Returns the UNIX time `token` went inactive or None"
+    if token not in self:
+      return None
+    return TIMESTAMP.unpack(self.store[token])[0]
+
+  def add(self, token, timestamp):
+    "Records that `token` went inactive at `timestamp`"
+    current = self.get(token)
+    if current is None or current < timestamp:
+      self.store[token] = TIMESTAMP.pack(timestamp)
+      if self.bloom is not None:
+        self.bloom.add(token)
+
+  def register(self, token, timestamp):
+    """ Forgets `token` if it was registered with the app again at
+    `timestamp`, after it went inactive. Returns True if it was forgotten.
+    """
+    current = self.get(token)
+    if current is not None and current <= timestamp:
+      del self.store[token]
+      return True
+    return False
+
+  def sync(self):
+    if self.path is not None:
+      try:
+        self.store.sync()
+      except AttributeError:
+        pass # not every dbm module can sync
+
+  def close(self):
+    if self.path is not None:
+      self.store.close()
+      log.msg('DeadTokens %s closed' % self.path)
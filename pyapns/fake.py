@@ -0,0 +1,422 @@
+""" A local stand-in for the APNS gateway and feedback services, to load test
+pyapns without reaching Apple.
+
+The gateway takes notifications in the simple (0), enhanced (1) and frame (2)
+formats and can be told to reject some with an error response or to drop
+connections. The feedback service sends scripted records. Both use a self
+signed certificate and don't check the one of the client, any .pem works.
+With the h2 package there is also a stand-in for the HTTP/2 provider API
+taking the same error injection, it doesn't check provider tokens either
+but answers the ones in `expired_tokens` with ExpiredProviderToken.
+
+    $ python -m pyapns.fake --gateway-port 2195 --feedback-port 2196 \\
+        --http2-port 2197 --pem /tmp/fake-apns.pem
+
+and in the process running pyapns.server, before provisioning:
+
+    >>> from pyapns import fake
+    >>> fake.redirect('localhost', 2195, 2196, 2197)
+"""
+
+import sys
+import time
+import struct
+import binascii
+import optparse
+from OpenSSL import SSL, crypto
+from twisted.internet import reactor, defer, ssl
+from twisted.internet.protocol import Protocol, ServerFactory
+from twisted.python import log
+try:
+  from h2.config import H2Configuration
+  from h2.connection import H2Connection
+  from h2.settings import Settings, SettingCodes
+  from h2 import events
+except ImportError:
+  H2Connection = None
+from . import server, _json as json
+
+
+ENHANCED_HEADER = server.FRAME_STRUCTS[1][0]
+SIMPLE_HEADER = server.FRAME_STRUCTS[0][0]
+FRAME_HEADER = struct.Struct('!BI') # command, frame length
+ITEM_HEADER = struct.Struct('!BH') # item id, item length
+ERROR_RESPONSE = struct.Struct('!BBI')
+# the HTTP/2 response to error statuses of the binary protocol
+HTTP2_ERRORS = {7: (413, 'PayloadTooLarge'), 8: (400, 'BadDeviceToken'),
+                10: (503, 'Shutdown'), 403: (403, 'ExpiredProviderToken'),
+                410: (410, 'Unregistered'), 429: (429, 'TooManyRequests')}
+
+
+def self_signed_pem(common_name='localhost', bits=2048):
+  "Returns a new self signed certificate and its private key as PEM"
+  key = crypto.PKey()
+  key.generate_key(crypto.TYPE_RSA, bits)
+  cert = crypto.X509()
+  cert.get_subject().CN = common_name
+  cert.set_serial_number(1)
+  cert.gmtime_adj_notBefore(0)
+  cert.gmtime_adj_notAfter(365*24*60*60)
+  cert.set_issuer(cert.get_subject())
+  cert.set_pubkey(key)
+  cert.sign(key, 'sha256')
+  return (crypto.dump_certificate(crypto.FILETYPE_PEM, cert) +
+          crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+
+
+class FakeContextFactory(ssl.ContextFactory):
+  "Server side SSL context of a PEM certificate, resuming TLS sessions"
+
+  def __init__(self, pem, alpn=None):
+    self.ctx = SSL.Context(SSL.SSLv23_METHOD)
+    self.ctx.set_options(SSL.OP_NO_SSLv2 | SSL.OP_NO_SSLv3)
+    self.ctx.use_certificate(crypto.load_certificate(crypto.FILETYPE_PEM, pem))
+    self.ctx.use_privatekey(crypto.load_privatekey(crypto.FILETYPE_PEM, pem))
+    self.ctx.set_session_id('pyapns.fake')
+    if alpn:
+      self.ctx.set_alpn_select_callback(lambda connection, offered: alpn)
+
+  def getContext(self):
+    return self.ctx
+
+
+class FakeGateway(Protocol):
+  def __init__(self):
+    self.buffer = ''
+    self.closing = False
+
+  def dataReceived(self, data):
+    if self.closing:
+      return # APNS ignores everything after a failed notification
+    data = self.buffer + data
+    pos = 0
+    while not self.closing:
+      frame = parse_frame(data, pos)
+      if frame is None:
+        break
+      pos, command, identifier, token, payload = frame
+      self.factory.notificationReceived(self, command, identifier, token,
+                                        payload)
+    self.buffer = data[pos:]
+
+  def fail(self, status, identifier):
+    "Responds with an error for `identifier` and closes the connection"
+    self.closing = True
+    self.transport.write(ERROR_RESPONSE.pack(8, status, identifier))
+    self.transport.loseConnection()
+
+  def drop(self):
+    "Closes the connection without an error response"
+    self.closing = True
+    self.transport.abortConnection()
+
+
+class FakeGatewayFactory(ServerFactory):
+  """ Counts the notifications it receives, and keeps them in
+  `notifications` as (command, identifier, hex token, payload) when `keep` is
+  set.
+
+  Errors are injected with `fail_tokens`, a dict of hex tokens to the status
+  to respond with, or by responding with `error_status` to every
+  `error_every`th notification. With `disconnect_every` the connection is
+  dropped without a response after that many notifications.
+  """
+
+  protocol = FakeGateway
+
+  def __init__(self, keep=False, fail_tokens=None, error_every=0,
+               error_status=8, disconnect_every=0):
+    self.keep = keep
+    self.fail_tokens = fail_tokens or {}
+    self.error_every = error_every
+    self.error_status = error_status
+    self.disconnect_every = disconnect_every
+    self.notifications = []
+    self.received = 0 # notifications, including rejected ones
+    self.accepted = 0
+    self.errors = 0
+    self.connections = 0
+    self.expected = [] # (received, deferred)
+
+  def buildProtocol(self, addr):
+    self.connections += 1
+    return ServerFactory.buildProtocol(self, addr)
+
+  def notificationReceived(self, protocol, command, identifier, token, payload):
+    self.received += 1
+    status = None
+    if self.fail_tokens:
+      status = self.fail_tokens.get(binascii.hexlify(token))
+    if self.error_every and self.received % self.error_every == 0:
+      status = self.error_status
+    if status is not None:
+      self.errors += 1
+      protocol.fail(status, identifier)
+    else:
+      self.accepted += 1
+      if self.keep:
+        self.notifications.append((command, identifier,
+                                   binascii.hexlify(token), payload))
+      if self.disconnect_every and self.received % self.disconnect_every == 0:
+        protocol.drop()
+    if self.expected and self.received >= self.expected[0][0]:
+      self.expected.sort(key=lambda e: e[0])
+      while self.expected and self.received >= self.expected[0][0]:
+        self.expected.pop(0)[1].callback(self.received)
+
+  def expect(self, received):
+    """ Returns a Deferred that fires once `received` notifications were, 
+    accepted or not
+    """
+    if self.received >= received:
+      return defer.succeed(self.received)
+    d = defer.Deferred()
+    self.expected.append((received, d))
+    return d
+
+
+class FakeHTTP2Gateway(Protocol):
+  "Answers every request on its stream, 200 unless the factory fails it"
+
+  def __init__(self):
+    self.conn = H2Connection(H2Configuration(client_side=False,
+                                             header_encoding='utf-8'))
+    self.requests = {} # {stream_id: [path, body chunks, authorization]}
+    self.failed = set() # streams answered with an error
+    self.closing = False
+
+  def connectionMade(self):
+    self.transport.setTcpNoDelay(True)
+    self.conn.local_settings = Settings(client=False, initial_values={
+      SettingCodes.MAX_CONCURRENT_STREAMS: self.factory.max_streams})
+    self.conn.initiate_connection()
+    self.transport.write(self.conn.data_to_send())
+
+  def dataReceived(self, data):
+    if self.closing:
+      return
+    try:
+      received = self.conn.receive_data(data)
+    except Exception, e:
+      log.msg('FakeHTTP2Gateway protocol error: %s' % e)
+      self.transport.loseConnection()
+      return
+    for event in received:
+      if isinstance(event, events.RequestReceived):
+        headers = dict(event.headers)
+        self.requests[event.stream_id] = [headers[':path'], [],
+                                          headers.get('authorization')]
+      elif isinstance(event, events.DataReceived):
+        self.conn.acknowledge_received_data(event.flow_controlled_length,
+                                            event.stream_id)
+        self.requests[event.stream_id][1].append(event.data)
+      elif isinstance(event, events.StreamEnded):
+        path, body, authorization = self.requests.pop(event.stream_id)
+        if authorization in self.factory.expired_tokens:
+          self.fail(403, event.stream_id)
+          self.failed.discard(event.stream_id)
+          continue
+        token = binascii.unhexlify(path.rsplit('/', 1)[-1])
+        self.factory.notificationReceived(self, 2, event.stream_id, token,
+                                          ''.join(body))
+        if self.closing:
+          return
+        if event.stream_id not in self.failed:
+          self.respond(event.stream_id, 200)
+        self.failed.discard(event.stream_id)
+    self.transport.write(self.conn.data_to_send())
+
+  def respond(self, stream_id, status, body=None):
+    headers = [(':status', str(status)), ('apns-id', '%032x' % stream_id)]
+    self.conn.send_headers(stream_id, headers, end_stream=body is None)
+    if body is not None:
+      self.conn.send_data(stream_id, body, end_stream=True)
+
+  def fail(self, status, identifier):
+    "Responds to the request on stream `identifier` with an error"
+    status, reason = HTTP2_ERRORS.get(status, (status, 'BadRequest'))
+    response = {'reason': reason}
+    if status == 410:
+      response['timestamp'] = int(time.time() * 1000)
+    self.failed.add(identifier)
+    self.respond(identifier, status, json.compact_dumps(response))
+
+  def drop(self):
+    "Closes the connection without responding"
+    self.closing = True
+    self.transport.abortConnection()
+
+
+class FakeHTTP2Factory(FakeGatewayFactory):
+  """ A FakeGatewayFactory for the HTTP/2 provider API, allowing
+  `max_streams` concurrent streams per connection. Rejected notifications
+  get an error response and the connection stays open. Requests with an
+  authorization header in `expired_tokens` are answered with
+  ExpiredProviderToken without being counted.
+  """
+
+  protocol = FakeHTTP2Gateway
+
+  def __init__(self, max_streams=1000, **kwargs):
+    if H2Connection is None:
+      raise ImportError('The HTTP/2 stand-in needs the h2 package')
+    FakeGatewayFactory.__init__(self, **kwargs)
+    self.max_streams = max_streams
+    self.expired_tokens = set()
+
+
+class FakeFeedback(Protocol):
+  def connectionMade(self):
+    self.transport.write(self.factory.nextBatch())
+    self.transport.loseConnection()
+
+
+class FakeFeedbackFactory(ServerFactory):
+  """ Sends the next of `batches`, lists of (timestamp, hex token), to every
+  connection. Once they are all sent connections get no records, or the
+  batches again from the first with `repeat`.
+  """
+
+  protocol = FakeFeedback
+
+  def __init__(self, batches=(), repeat=False):
+    self.batches = [encode_feedback(batch) for batch in batches]
+    self.repeat = repeat
+    self.connections = 0
+
+  def nextBatch(self):
+    n = self.connections
+    self.connections += 1
+    if self.repeat and self.batches:
+      n %= len(self.batches)
+    return self.batches[n] if n < len(self.batches) else ''
+
+
+def parse_frame(data, pos):
+  """ Returns (end, command, identifier, binary token, payload) of the
+  notification at `pos` of `data`, or None if it is not complete. The
+  identifier is 0 for the simple format.
+  """
+  if len(data) - pos < 1:
+    return None
+  command = ord(data[pos])
+  if command == 0:
+    if len(data) - pos < SIMPLE_HEADER.size:
+      return None
+    _, _, token, length = SIMPLE_HEADER.unpack_from(data, pos)
+    start, identifier = pos + SIMPLE_HEADER.size, 0
+  elif command == 1:
+    if len(data) - pos < ENHANCED_HEADER.size:
+      return None
+    _, identifier, _, _, token, length = ENHANCED_HEADER.unpack_from(data, pos)
+    start = pos + ENHANCED_HEADER.size
+  elif command == 2:
+    if len(data) - pos < FRAME_HEADER.size:
+      return None
+    _, length = FRAME_HEADER.unpack_from(data, pos)
+    end = pos + FRAME_HEADER.size + length
+    if len(data) < end:
+      return None
+    items, item = {}, pos + FRAME_HEADER.size
+    while item < end:
+      item_id, item_length = ITEM_HEADER.unpack_from(data, item)
+      item += ITEM_HEADER.size
+      items[item_id] = data[item:item + item_length]
+      item += item_length
+    identifier = struct.unpack('!I', items.get(3, '\0\0\0\0'))[0]
+    return end, command, identifier, items.get(1, ''), items.get(2, '')
+  else:
+    raise ValueError('Unknown notification command %r' % command)
+  if len(data) - start < length:
+    return None
+  return start + length, command, identifier, token, data[start:start + length]
+
+def encode_feedback(records):
+  "Returns (timestamp, hex token) tuples as binary feedback records"
+  return ''.join([server.FEEDBACK_RECORD.pack(ts, 32, binascii.unhexlify(t))
+                  for ts, t in records])
+
+def listen(pem=None, gateway=None, feedback=None, gateway_port=0,
+           feedback_port=0, interface='127.0.0.1'):
+  """ Starts listening with a gateway and a feedback factory, new ones by
+  default, on the given ports, 0 for any free ones. Returns the factories
+  and the ports they listen on as (gateway, feedback, gateway_port,
+  feedback_port).
+  """
+  context = FakeContextFactory(pem or self_signed_pem())
+  gateway = gateway or FakeGatewayFactory()
+  feedback = feedback or FakeFeedbackFactory()
+  gateway_port = reactor.listenSSL(gateway_port, gateway, context,
+                                   interface=interface).getHost().port
+  feedback_port = reactor.listenSSL(feedback_port, feedback, context,
+                                    interface=interface).getHost().port
+  return gateway, feedback, gateway_port, feedback_port
+
+def listen_http2(pem=None, gateway=None, port=0, interface='127.0.0.1'):
+  """ Starts listening with an HTTP/2 provider API factory, a new one by 
+  default. Returns it and the port it listens on, its `listening` port
+  stops listening.
+  """
+  context = FakeContextFactory(pem or self_signed_pem(), 'h2')
+  gateway = gateway or FakeHTTP2Factory()
+  gateway.listening = reactor.listenSSL(port, gateway, context,
+                                        interface=interface)
+  return gateway, gateway.listening.getHost().port
+
+def redirect(host, gateway_port, feedback_port, http2_port=None):
+  """ Points pyapns.server at a fake gateway and feedback service, and at a
+  fake HTTP/2 provider API with `http2_port`
+  """
+  server.APNS_SERVER_HOSTNAME = server.APNS_SERVER_SANDBOX_HOSTNAME = host
+  server.APNS_SERVER_PORT = gateway_port
+  server.FEEDBACK_SERVER_HOSTNAME = host
+  server.FEEDBACK_SERVER_SANDBOX_HOSTNAME = host
+  server.FEEDBACK_SERVER_PORT = feedback_port
+  if http2_port is not None:
+    from . import http2
+    http2.HTTP2_SERVER_HOSTNAME = http2.HTTP2_SERVER_SANDBOX_HOSTNAME = host
+    http2.HTTP2_SERVER_PORT = http2_port
+
+
+def main(argv=None):
+  parser = optparse.OptionParser(usage='python -m pyapns.fake [options]')
+  parser.add_option('--gateway-port', type='int', default=2195)
+  parser.add_option('--feedback-port', type='int', default=2196)
+  parser.add_option('--http2-port', type='int', default=0,
+                    help='also serve the HTTP/2 provider API on this port')
+  parser.add_option('--interface', default='127.0.0.1')
+  parser.add_option('--pem', help='write the certificate to this file, for '
+                    'clients to use as theirs')
+  parser.add_option('--error-every', type='int', default=0,
+                    help='reject every nth notification')
+  parser.add_option('--error-status', type='int', default=8)
+  parser.add_option('--disconnect-every', type='int', default=0,
+                    help='drop the connection after every nth notification')
+  parser.add_option('--feedback-tokens', type='int', default=0,
+                    help='inactive tokens reported by every feedback read')
+  options, args = parser.parse_args(argv)
+
+  log.startLogging(sys.stdout)
+  pem = self_signed_pem()
+  if options.pem:
+    with open(options.pem, 'w') as f:
+      f.write(pem)
+  gateway = FakeGatewayFactory(error_every=options.error_every,
+                               error_status=options.error_status,
+                               disconnect_every=options.disconnect_every)
+  feedback = FakeFeedbackFactory(
+    [[(int(time.time()), '%064x' % n) 
+      for n in xrange(options.feedback_tokens)]],
+    repeat=True)
+  listen(pem, gateway, feedback, options.gateway_port, options.feedback_port,
+         options.interface)
+  if options.http2_port:
+    listen_http2(pem, FakeHTTP2Factory(
+      error_every=options.error_every, error_status=options.error_status,
+      disconnect_every=options.disconnect_every),
+      options.http2_port, options.interface)
+  reactor.run()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,509 @@
+""" The HTTP/2 provider API of APNS, a backend an app_id can use instead of
+the binary gateway by being provisioned with `http2` settings. Every
+notification is a request on its own stream, many of them are under way at
+once on a connection and each gets a response, so failures are reported
+per notification and nothing has to be resent after one.
+
+Connections authenticate with the certificate of the app_id, or with a
+provider token signed with an APNs auth key when `key`, `key_id` and
+`team_id` are given. Needs the h2 package, and cryptography for token
+authentication, installed with the http2 extra of pyapns.
+"""
+
+import time
+import base64
+import binascii
+import collections
+from OpenSSL import SSL
+from twisted.internet import reactor, defer
+from twisted.internet.protocol import Protocol
+from twisted.python import log
+try:
+  from cryptography.hazmat.backends import default_backend
+  from cryptography.hazmat.primitives import hashes, serialization
+  from cryptography.hazmat.primitives.asymmetric import ec, utils
+except ImportError:
+  serialization = None
+try:
+  from h2.config import H2Configuration
+  from h2.connection import H2Connection
+  from h2 import events
+  from h2.errors import ErrorCodes
+except ImportError:
+  H2Connection = None
+from . import _json as json
+from .server import (APNSService, APNSClientFactory, APNSClientContextFactory,
+                     ssl_context, keep_tls_session, check_notifications,
+                     FEEDBACK_RECORD)
+
+
+HTTP2_SERVER_SANDBOX_HOSTNAME = 'api.sandbox.push.apple.com'
+HTTP2_SERVER_HOSTNAME = 'api.push.apple.com'
+HTTP2_SERVER_PORT = 443
+
+HTTP2_MAX_PAYLOAD = 4096 # bytes
+MAX_STREAMS = 1000 # per connection, when APNS allows more
+TOKEN_LIFETIME = 50*60 # seconds a provider token is used, APNS takes an hour
+
+plain_contexts = [] # the SSL context of connections without a certificate
+
+
+def b64url(data):
+  return base64.urlsafe_b64encode(data).rstrip('=')
+
+
+class ProviderToken(object):
+  """ The JSON web token authenticating requests with an APNs auth key,
+  signed once and used for `lifetime` seconds. `key` is the path to the .p8
+  file or its contents.
+  """
+
+  def __init__(self, key, key_id, team_id, lifetime=TOKEN_LIFETIME):
+    if serialization is None:
+      raise ImportError('Token authentication needs the cryptography '
+                        'package, install pyapns[http2]')
+    if 'BEGIN PRIVATE KEY' not in key:
+      with open(key) as f:
+        key = f.read()
+    self.key = serialization.load_pem_private_key(key, None, default_backend())
+    self.key_id = key_id
+    self.team_id = team_id
+    self.lifetime = lifetime
+    self.header = b64url(json.compact_dumps({'alg': 'ES256', 'kid': key_id}))
+    self.issued = 0
+    self.value = None
+
+  def get(self, now=None):
+    "Returns the authorization header value, signing a new token if it's due"
+    now = int(now or time.time())
+    if self.value is None or now - self.issued >= self.lifetime:
+      signed = self.header + '.' + b64url(json.compact_dumps(
+        {'iss': self.team_id, 'iat': now}))
+      r, s = utils.decode_dss_signature(
+        self.key.sign(signed, ec.ECDSA(hashes.SHA256())))
+      signature = binascii.unhexlify('%064x%064x' % (r, s))
+      self.value = 'bearer %s.%s' % (signed, b64url(signature))
+      self.issued = now
+    return self.value
+
+  def expire(self):
+    "Signs a new token for the next request, after APNS rejected this one"
+    self.value = None
+
+
+class HTTP2ContextFactory(APNSClientContextFactory):
+  "Creates TLS connections negotiating HTTP/2, with or without a certificate"
+
+  def __init__(self, ssl_cert_file=None, hostname=None):
+    if ssl_cert_file:
+      APNSClientContextFactory.__init__(self, ssl_cert_file, hostname)
+    else:
+      self.ssl_cert_file = None
+      self.hostname = hostname
+      self.session = None
+
+  def getContext(self):
+    if self.ssl_cert_file:
+      return ssl_context(self.ssl_cert_file)
+    if not plain_contexts:
+      ctx = SSL.Context(SSL.SSLv23_METHOD)
+      ctx.set_options(SSL.OP_NO_SSLv2 | SSL.OP_NO_SSLv3)
+      ctx.set_session_cache_mode(SSL.SESS_CACHE_CLIENT)
+      plain_contexts.append(ctx)
+    return plain_contexts[0]
+
+  def clientConnectionForTLS(self, tlsProtocol):
+    connection = APNSClientContextFactory.clientConnectionForTLS(
+      self, tlsProtocol)
+    connection.set_alpn_protos(['h2'])
+    return connection
+
+
+class Requests(object):
+  """ Notifications to send to the provider API, `items` holding
+  (requests, index, hex token, payload) of each. `deferred` fires once all
+  of them got a response with a list of (index, reason) of the ones APNS
+  rejected, or fails when none came for `timeout` seconds.
+  """
+
+  def __init__(self, indexes, tokens, payloads, headers):
+    self.items = [(self, n, t, p) for n, t, p in zip(indexes, tokens, payloads)]
+    self.headers = headers
+    self.pending = len(self.items)
+    self.failed = []
+    self.answered = time.time() # of the last response
+    self.deferred = defer.Deferred()
+    if not self.pending:
+      self.deferred.callback(self.failed)
+
+  def __len__(self):
+    return len(self.items)
+
+  def done(self, index, reason=None):
+    if reason is not None:
+      self.failed.append((index, reason))
+    self.pending -= 1
+    self.answered = time.time()
+    if not self.pending and not self.deferred.called:
+      self.deferred.callback(sorted(self.failed))
+
+  def fail(self, f):
+    if not self.deferred.called:
+      self.deferred.errback(f)
+
+  def expire(self, timeout):
+    """ Fails the requests unless all got a response by the time `timeout`
+    seconds pass without any, returns the DelayedCall checking that.
+    """
+    def check():
+      if self.deferred.called:
+        return
+      idle = time.time() - self.answered
+      if idle < timeout:
+        call[0] = reactor.callLater(timeout - idle, check)
+      else:
+        self.fail(defer.TimeoutError(
+          'No response from APNS for %i seconds' % timeout))
+    self.answered = time.time()
+    call = [reactor.callLater(timeout, check)]
+    def cancel(r):
+      if call[0].active():
+        call[0].cancel()
+      return r
+    self.deferred.addBoth(cancel)
+
+
+class HTTP2Protocol(Protocol):
+  """ One connection to the provider API. Notifications wait in `queue`
+  until a stream is free, at most MAX_STREAMS or as many as APNS allows are
+  open at once. The connection counts as congested while any wait.
+  """
+
+  written = 0 # requests sent, used by APNSService to pick the least loaded
+
+  def __init__(self):
+    self.conn = H2Connection(H2Configuration(client_side=True,
+                                             header_encoding='utf-8'))
+    self.queue = collections.deque() # items of Requests
+    self.streams = {} # {stream_id: [item, sent at, status, body chunks]}
+    self.blocked = {} # {stream_id: data waiting for the flow control window}
+    self.ready = False
+    self.closing = False
+
+  @property
+  def queued(self):
+    return len(self.queue) + len(self.streams)
+
+  @property
+  def congested(self):
+    return bool(self.queue)
+
+  def connectionMade(self):
+    log.msg('HTTP2Protocol connectionMade')
+    self.transport.setTcpNoDelay(True) # requests are small and many
+    self.conn.initiate_connection()
+    self.transport.write(self.conn.data_to_send())
+
+  def sendMessage(self, requests):
+    """ Sends Requests, returns a Deferred that fires with the failed ones
+    once all got a response
+    """
+    self.sendItems(requests.items)
+    return requests.deferred
+
+  def sendItems(self, items):
+    self.queue.extend(items)
+    self.flush()
+
+  def flush(self):
+    service = self.factory.service
+    limit = min(self.factory.streams,
+                self.conn.remote_settings.max_concurrent_streams)
+    authorization = service.token and service.token.get()
+    now = time.time()
+    while self.queue and len(self.streams) < limit and not self.closing:
+      item = self.queue.popleft()
+      requests, n, token, payload = item
+      if requests.deferred.called:
+        continue # failed already, like after a timeout
+      stream_id = self.conn.get_next_available_stream_id()
+      headers = [(':method', 'POST'), (':scheme', 'https'),
+                 (':authority', self.factory.hostname),
+                 (':path', '/3/device/' + token)] + requests.headers
+      if authorization:
+        headers.append(('authorization', authorization))
+      self.conn.send_headers(stream_id, headers)
+      self.streams[stream_id] = [item, now, None, []]
+      self.sendData(stream_id, payload)
+      self.written += 1
+      service.stats.incr('requests_sent')
+    self.transport.write(self.conn.data_to_send())
+
+  def sendData(self, stream_id, data):
+    # payloads usually fit, unless many streams used up the connection window
+    while True:
+      size = min(len(data), self.conn.max_outbound_frame_size,
+                 self.conn.local_flow_control_window(stream_id))
+      if size < len(data) and not size:
+        self.blocked[stream_id] = data
+        return
+      self.conn.send_data(stream_id, data[:size],
+                          end_stream=size == len(data))
+      data = data[size:]
+      if not data:
+        self.blocked.pop(stream_id, None)
+        return
+
+  def dataReceived(self, data):
+    try:
+      received = self.conn.receive_data(data)
+    except Exception, e:
+      log.msg('HTTP2Protocol protocol error: %s' % e)
+      self.transport.loseConnection()
+      return
+    for event in received:
+      if isinstance(event, events.ResponseReceived):
+        if event.stream_id in self.streams:
+          self.streams[event.stream_id][2] = int(dict(event.headers)[':status'])
+      elif isinstance(event, events.DataReceived):
+        self.conn.acknowledge_received_data(event.flow_controlled_length,
+                                            event.stream_id)
+        if event.stream_id in self.streams:
+          self.streams[event.stream_id][3].append(event.data)
+      elif isinstance(event, events.StreamEnded):
+        self.responseReceived(event.stream_id)
+      elif isinstance(event, events.StreamReset):
+        self.streamReset(event.stream_id, event.error_code)
+      elif isinstance(event, events.WindowUpdated):
+        for stream_id, data in self.blocked.items():
+          self.sendData(stream_id, data)
+      elif isinstance(event, events.RemoteSettingsChanged):
+        if not self.ready:
+          # APNS speaks HTTP/2 here, notifications can go out
+          self.ready = True
+          self.factory.addClient(self)
+      elif isinstance(event, events.ConnectionTerminated):
+        self.connectionTerminated(event.error_code, event.last_stream_id)
+    self.flush()
+
+  def responseReceived(self, stream_id):
+    if stream_id not in self.streams:
+      return
+    item, sent, status, body = self.streams.pop(stream_id)
+    requests, n, token, payload = item
+    service = self.factory.service
+    service.stats.observe('response_seconds', time.time() - sent)
+    if self.closing and not self.streams:
+      self.transport.loseConnection()
+    if status == 200:
+      requests.done(n)
+      return
+    reason, timestamp = str(status), None
+    try:
+      response = json.loads(''.join(body))
+      reason, timestamp = response.get('reason', reason), response.get('timestamp')
+    except ValueError:
+      pass
+    if status == 403 and reason == 'ExpiredProviderToken' and service.token:
+      service.token.expire()
+      self.queue.append(item)
+      return
+    service.responseFailed(status, reason, token, timestamp)
+    requests.done(n, reason)
+
+  def streamReset(self, stream_id, error_code):
+    if stream_id not in self.streams:
+      return
+    item = self.streams.pop(stream_id)[0]
+    self.blocked.pop(stream_id, None)
+    if error_code == ErrorCodes.REFUSED_STREAM:
+      self.queue.appendleft(item) # not processed, try again
+    else:
+      item[0].done(item[1], 'Stream reset (%s)' % error_code)
+
+  def connectionTerminated(self, error_code, last_stream_id):
+    log.msg('HTTP2Protocol GOAWAY error_code=%s last_stream_id=%s' % (
+            error_code, last_stream_id))
+    self.closing = True
+    if self.ready:
+      self.factory.removeClient(self)
+    # streams after the last one APNS processes go out on another connection,
+    # the others still get their responses
+    unprocessed = [s for s in sorted(self.streams) if s > last_stream_id]
+    items = [self.streams.pop(s)[0] for s in unprocessed] + list(self.queue)
+    self.queue.clear()
+    if items:
+      self.factory.service.sendItems(items)
+    if not self.streams:
+      self.transport.loseConnection()
+
+  def connectionLost(self, reason):
+    log.msg('HTTP2Protocol connectionLost')
+    keep_tls_session(self.transport)
+    if self.ready and not self.closing:
+      self.factory.removeClient(self)
+    self.closing = True
+    # requests without a response go out again on another connection
+    unanswered = [self.streams[s][0] for s in sorted(self.streams)]
+    unanswered.extend(self.queue)
+    self.streams, self.queue, self.blocked = {}, collections.deque(), {}
+    if unanswered:
+      self.factory.service.stats.incr('requests_resent', len(unanswered))
+      self.factory.service.sendItems(unanswered)
+
+
+class HTTP2ClientFactory(APNSClientFactory):
+  protocol = HTTP2Protocol
+
+  def __init__(self, service):
+    APNSClientFactory.__init__(self, service)
+    self.hostname = service.server()[0]
+    self.streams = service.streams
+
+
+class HTTP2Service(APNSService):
+  """ An APNSService sending notifications through the HTTP/2 provider API.
+  There is no feedback service, tokens APNS answers as unregistered are
+  added to the feedback cache and the dead token index as they come. `topic`
+  is the bundle id to send for, required with a provider `token`.
+  """
+
+  clientProtocolFactory = HTTP2ClientFactory
+  max_payload_size = None # bytes, HTTP2_MAX_PAYLOAD by default
+  write_window = 100 # writes wait for their responses, keep more under way
+
+  def __init__(self, cert_path, environment, timeout=15, connections=1,
+               dead_tokens=None, topic=None, token=None, streams=MAX_STREAMS):
+    if H2Connection is None:
+      raise ImportError('The HTTP/2 backend needs the h2 package, '
+                        'install pyapns[http2]')
+    APNSService.__init__(self, cert_path, environment, timeout, connections,
+                         None, dead_tokens)
+    self.topic = topic
+    self.token = token # a ProviderToken, or None to use the certificate
+    self.streams = streams
+
+  def server(self):
+    return ((HTTP2_SERVER_SANDBOX_HOSTNAME if self.environment == 'sandbox'
+             else HTTP2_SERVER_HOSTNAME), HTTP2_SERVER_PORT)
+
+  def getContextFactory(self, hostname=None):
+    if hostname not in self.context_factories:
+      self.context_factories[hostname] = HTTP2ContextFactory(
+        self.cert_path, hostname)
+    return self.context_factories[hostname]
+
+  def connect(self):
+    "Start the pool of provider API connections"
+    server, port = self.server()
+    context = self.getContextFactory(server)
+    while len(self.factories) < self.connections:
+      factory = self.clientProtocolFactory(self)
+      reactor.connectSSL(server, port, factory, context)
+      self.factories.append(factory)
+
+  def encode(self, tokens, notifications, expiry=0, rejected=None):
+    """ Returns the tokens and notifications as Requests. Invalid ones are
+    left out and appended to `rejected` as (index, reason).
+    """
+    start = time.time()
+    invalid = []
+    checked = check_notifications(tokens, notifications,
+                                  self.max_payload_size or HTTP2_MAX_PAYLOAD,
+                                  self.dead_tokens,
+                                  self.truncate_alerts, invalid)
+    if checked is None:
+      return None
+    indexes, raw, payloads = checked
+    if indexes is None:
+      indexes = xrange(len(raw))
+    headers = [('apns-expiration', str(expiry or 0))]
+    if self.topic:
+      headers.append(('apns-topic', self.topic))
+    requests = Requests(indexes, [binascii.hexlify(t) for t in raw], payloads,
+                        headers)
+    self.stats.observe('encode_seconds', time.time() - start)
+    self.stats.incr('frames_encoded', len(requests))
+    if invalid:
+      log.msg('HTTP2Service rejected %i notifications: %s' % (
+              len(invalid), invalid[0][1]))
+      self.stats.incr('notifications_rejected', len(invalid))
+    if self.dead_tokens is not None:
+      count = 1 if type(tokens) in (str, unicode) else len(tokens)
+      if type(notifications) is list:
+        count = min(count, len(notifications))
+      self.stats.incr('dead_tokens_skipped',
+                      count - len(requests) - len(invalid))
+    if rejected is not None:
+      rejected.extend(invalid)
+    return requests
+
+  def write(self, requests):
+    """ Sends Requests. Returns a Deferred that fires with the (index,
+    reason) of the notifications APNS rejected once all were answered, or
+    fails once none was for `timeout` seconds.
+    """
+    self.last_used = time.time()
+    if not self.factories:
+      log.msg('HTTP2Service write (connecting)')
+      self.connect()
+    start = time.time()
+    def answered(r):
+      self.stats.observe('write_seconds', time.time() - start)
+      return r
+    def timed_out(f):
+      if f.check(defer.TimeoutError):
+        self.stats.incr('response_timeouts')
+      return f
+    if requests.pending:
+      requests.expire(self.timeout)
+    self.sendItems(requests.items)
+    return requests.deferred.addCallbacks(answered, timed_out)
+
+  def sendItems(self, items):
+    clients = self.clients()
+    if clients:
+      # spread them over the connections so they all have streams under way
+      share = -(-len(items) // len(clients))
+      for n, client in enumerate(sorted(clients, key=lambda p: p.queued)):
+        if items[n * share:(n + 1) * share]:
+          client.sendItems(items[n * share:(n + 1) * share])
+      return
+    def timed_out(f):
+      self.stats.incr('write_timeouts')
+      for requests in set(item[0] for item in items):
+        requests.fail(f)
+    self.whenConnected().addCallbacks(lambda _: self.sendItems(items),
+                                      timed_out)
+
+  def drain(self):
+    pass # nothing is spooled
+
+  def busy(self):
+    return bool(self.waiting or [p for p in self.clients() if p.queued])
+
+  def statistics(self):
+    stats = APNSService.statistics(self)
+    del stats['queued_bytes']
+    stats['open_streams'] = sum(len(p.streams) for p in self.clients())
+    return stats
+
+  def responseFailed(self, status, reason, token, timestamp=None):
+    "Called when APNS answers a notification with an error"
+    log.msg('HTTP2Service notification to %s failed: %i %s' % (
+            token, status, reason))
+    self.stats.incr('error_responses')
+    if status == 410:
+      # what the feedback service used to report
+      timestamp = int((timestamp or time.time() * 1000) // 1000)
+      record = FEEDBACK_RECORD.pack(timestamp, 32, binascii.unhexlify(token))
+      self.stats.incr('feedback_records')
+      self.feedback.extend(record)
+      self.feedbackReceived(record)
+    elif reason == 'BadDeviceToken' and self.dead_tokens is not None:
+      # not a token of this app and environment, until it's registered again
+      self.dead_tokens.add(binascii.unhexlify(token), int(time.time()))
+
+  def read(self, receiver=None):
+    "Unregistered tokens are already in the feedback cache, nothing to read"
+    return defer.succeed(None if receiver is not None else '')
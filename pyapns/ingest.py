@@ -0,0 +1,54 @@
+""" A listener for the compact ingestion protocol described in pyapns.wire,
+taking the same requests as APNSServer without the XML marshalling.
+"""
+
+from twisted.internet import defer
+from twisted.internet.protocol import ServerFactory
+from twisted.protocols.basic import Int32StringReceiver
+from twisted.python import log, failure
+from twisted.web import xmlrpc
+import wire
+
+
+class IngestProtocol(Int32StringReceiver):
+  MAX_LENGTH = wire.MAX_LENGTH
+
+  def stringReceived(self, body):
+    try:
+      id, method, params = wire.parse_request(body)
+    except Exception, e:
+      log.msg('IngestProtocol bad request: %s' % e)
+      self.transport.loseConnection()
+      return
+    d = defer.maybeDeferred(self.factory.call, method, params)
+    d.addCallbacks(lambda r: wire.response(id, r),
+                   lambda f: wire.response(id, error=fault(f)))
+    d.addCallback(self.respond)
+
+  def respond(self, message):
+    if self.transport.connected:
+      self.sendString(message)
+
+
+class IngestFactory(ServerFactory):
+  """ Calls the xmlrpc_ methods of `server`, an APNSServer, for requests """
+
+  protocol = IngestProtocol
+
+  def __init__(self, server):
+    self.server = server
+
+  def call(self, method, params):
+    f = getattr(self.server, 'xmlrpc_%s' % method, None)
+    if f is None:
+      raise xmlrpc.NoSuchFunction(xmlrpc.XMLRPC.NOT_FOUND,
+                                  'procedure %s not found' % method)
+    return f(*params)
+
+
+def fault(f):
+  "Returns the (code, message) of a failure like XML-RPC would"
+  if f.check(xmlrpc.Fault):
+    return f.value.faultCode, f.value.faultString
+  log.err(f)
+  return xmlrpc.XMLRPC.FAILURE, 'error'
@@ -0,0 +1,182 @@
+import time
+import collections
+from twisted.internet import reactor, defer
+
+
+INTERACTIVE, BULK = 0, 1
+LANES = ('interactive', 'bulk')
+
+
+class TokenBucket(object):
+  """ Allows `rate` notifications a second on average and bursts of up to
+  `burst`. A message larger than the burst is let through once the bucket
+  is full and leaves it in debt.
+  """
+
+  def __init__(self, rate, burst=0):
+    self.rate = float(rate)
+    self.burst = float(burst or rate)
+    self.tokens = self.burst
+    self.updated = time.time()
+
+  def take(self, count, now):
+    "Takes `count` tokens, or returns the seconds until they can be taken"
+    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+    needed = min(count, self.burst)
+    if self.tokens < needed:
+      return (needed - self.tokens) / self.rate
+    self.tokens -= count
+    return 0
+
+
+class AppQueue(object):
+  "The messages of one app_id waiting in the Scheduler, per lane"
+
+  def __init__(self, service, weight=1, bucket=None):
+    self.service = service
+    self.weight = weight
+    self.bucket = bucket
+    self.lanes = [collections.deque() for _ in LANES]
+    self.queued = [0] * len(LANES) # notifications
+    self.deficit = [0] * len(LANES)
+    self.writing = 0
+    self.blocked_until = 0 # by the rate limit
+
+  def writable(self, now):
+    window = self.service.write_window * self.service.connections
+    return self.writing < window and self.blocked_until <= now
+
+
+class Scheduler(object):
+  """ Sits between APNSServer and APNSService.write so one app_id can't take
+  the reactor from the others. Messages wait in a queue per app_id and lane;
+  the interactive lane is always served before the bulk lane, and within a
+  lane app_ids take turns by deficit round robin, each getting `quantum`
+  notifications per turn times its weight. App_ids configured with a rate
+  are held to it by a TokenBucket. At most `turn_size` notifications are
+  written per reactor iteration so requests keep being read in between.
+  """
+
+  def __init__(self, quantum=1000, turn_size=10000, rate=0, burst=0):
+    if quantum <= 0 or turn_size <= 0:
+      raise ValueError('quantum and turn_size must be positive')
+    self.quantum = quantum
+    self.turn_size = turn_size
+    self.rate = rate # notifications a second per app_id, 0 for no limit
+    self.burst = burst
+    self.settings = {} # {'app_id': (rate, burst, weight)}
+    self.queues = {} # {'app_id': AppQueue}
+    self.active = [collections.deque() for _ in LANES] # AppQueues in turn
+    self.call = None
+
+  def configure(self, app_id, rate=None, burst=None, weight=1):
+    """ Sets the rate limit in notifications a second and the weight of an
+    app_id, a rate of None uses the default one
+    """
+    if weight <= 0:
+      raise ValueError('The weight of %s must be positive' % app_id)
+    self.settings[app_id] = (rate, burst, weight)
+    if app_id in self.queues:
+      self.setup(app_id, self.queues[app_id])
+
+  def setup(self, app_id, queue):
+    rate, burst, weight = self.settings.get(app_id, (None, None, 1))
+    if rate is None:
+      rate, burst = self.rate, self.burst
+    queue.weight = weight
+    queue.bucket = TokenBucket(rate, burst) if rate else None
+
+  def queue(self, app_id, service):
+    if app_id not in self.queues:
+      queue = self.queues[app_id] = AppQueue(service)
+      self.setup(app_id, queue)
+      service.scheduled = queue
+    return self.queues[app_id]
+
+  def submit(self, app_id, service, frames, lane=INTERACTIVE):
+    """ Queues Frames for `service` in a lane. Returns a Deferred that fires
+    like the one of APNSService.write once they were written.
+    """
+    queue = self.queue(app_id, service)
+    count = len(frames)
+    d = defer.Deferred()
+    if queue not in self.active[lane]:
+      self.active[lane].append(queue)
+    queue.lanes[lane].append((frames, count, time.time(), d))
+    queue.queued[lane] += count
+    self.schedule(0)
+    return d
+
+  def schedule(self, delay):
+    if self.call is not None and self.call.active():
+      if self.call.getTime() <= time.time() + delay:
+        return
+      self.call.cancel()
+    self.call = reactor.callLater(delay, self.run)
+
+  def run(self):
+    "Writes waiting messages, at most turn_size notifications of them"
+    self.call = None
+    budget, now = self.turn_size, time.time()
+    while budget > 0:
+      # bulk messages only go out while no interactive ones can
+      for lane in xrange(len(LANES)):
+        written, turns = self.serve(lane, budget, now)
+        if turns:
+          break
+      if not turns:
+        break
+      budget -= written
+    if budget <= 0:
+      self.schedule(0)
+    else:
+      # wake up for the app_id whose rate limit is lifted first
+      blocked = [q.blocked_until for active in self.active for q in active
+                 if q.blocked_until > now]
+      if blocked:
+        self.schedule(min(blocked) - now)
+
+  def serve(self, lane, budget, now):
+    """ Gives every app_id with messages in `lane` one turn, returns how many
+    notifications were written and how many app_ids could take their turn
+    """
+    active, written, turns = self.active[lane], 0, 0
+    for _ in xrange(len(active)):
+      queue = active.popleft()
+      messages = queue.lanes[lane]
+      if queue.writable(now):
+        queue.deficit[lane] += self.quantum * queue.weight
+        turns += 1
+      while messages and queue.writable(now) and written < budget:
+        message, count, queued_at, d = messages[0]
+        if count > queue.deficit[lane]:
+          break
+        if queue.bucket is not None:
+          wait = queue.bucket.take(count, now)
+          if wait:
+            queue.blocked_until = now + wait
+            queue.service.stats.incr('rate_limited')
+            break
+        messages.popleft()
+        queue.queued[lane] -= count
+        queue.deficit[lane] -= count
+        written += count
+        self.write(queue, message, queued_at, d, now)
+      if messages and queue not in active:
+        # don't bank turns while blocked beyond what the next message needs
+        queue.deficit[lane] = min(queue.deficit[lane], max(
+          self.quantum * queue.weight, messages[0][1]))
+        active.append(queue)
+      else:
+        queue.deficit[lane] = 0
+    return written, turns
+
+  def write(self, queue, message, queued_at, d, now):
+    queue.service.stats.observe('scheduled_seconds', now - queued_at)
+    queue.writing += 1
+    def written(r):
+      queue.writing -= 1
+      self.schedule(0)
+      return r
+    queue.service.write(message).addBoth(written).chainDeferred(d)
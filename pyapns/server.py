@@ -1,19 +1,31 @@
 from __future__ import with_statement
 import _json as json
 import struct
+import collections
 import binascii
 import datetime
+import random
+import time
+import os
+import urllib
+import hashlib
 from StringIO import StringIO as _StringIO
 from OpenSSL import SSL, crypto
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, task
+from twisted.internet.interfaces import (
+  IPushProducer, IOpenSSLClientConnectionCreator)
 from twisted.internet.protocol import (
   ReconnectingClientFactory, ClientFactory, Protocol, ServerFactory)
 from twisted.internet.ssl import ClientContextFactory
 from twisted.application import service
-from twisted.protocols.basic import LineReceiver
-from twisted.python import log
+from twisted.python import log, failure
 from zope.interface import Interface, implements
 from twisted.web import xmlrpc
+from .stats import Stats, xmlrpc_safe
+from .spool import Spool, FRAMES, HEADER as SPOOL_HEADER
+from .deadtokens import DeadTokens
+from .scheduler import Scheduler, LANES, INTERACTIVE, BULK
+from .template import Template, Payload
 
 
 APNS_SERVER_SANDBOX_HOSTNAME = "gateway.sandbox.push.apple.com"
@@ -23,7 +35,42 @@ FEEDBACK_SERVER_SANDBOX_HOSTNAME = "feedback.sandbox.push.apple.com"
 FEEDBACK_SERVER_HOSTNAME = "feedback.push.apple.com"
 FEEDBACK_SERVER_PORT = 2196
 
+FEEDBACK_RECORD = struct.Struct('!lh32s')
+
+SENT_FRAMES = 10000 # frames each connection keeps around for retransmission
+SEND_QUEUE_HIGH_WATERMARK = 1024*1024 # bytes
+SEND_QUEUE_LOW_WATERMARK = 256*1024
+
+# bytes, by notification command. APNS takes 2048 byte payloads in every
+# binary format since iOS 8, max_payload_size lowers it for older devices
+MAX_PAYLOAD_SIZES = {0: 2048, 1: 2048, 2: 2048}
+
+BROADCAST_CHUNK = 10000 # tokens encoded and written at a time by broadcast
+
+FEEDBACK_CACHE = 100000 # feedback records kept per app_id for readers
+
+HEXDUMP_SAMPLE = 0.0 # fraction of written messages and feedback chunks to log
+
+ERROR_RESPONSE_COMMAND = 8
+ERROR_RESPONSE_SIZE = 6
+ERROR_STATUS_CODES = {
+  0: 'No errors encountered',
+  1: 'Processing error',
+  2: 'Missing device token',
+  3: 'Missing topic',
+  4: 'Missing payload',
+  5: 'Invalid token size',
+  6: 'Invalid topic size',
+  7: 'Invalid payload size',
+  8: 'Invalid token',
+  10: 'Shutdown',
+  255: 'None (unknown)',
+}
+
 app_ids = {} # {'app_id': APNSService()}
+# {'app_id': (cert, environment, timeout, connections, http2 settings)}
+provisioned = {}
+templates = {} # {'app_id': {'name': Template()}}
 
 class StringIO(_StringIO):
   """Add context management protocol to StringIO
@@ -44,77 +91,364 @@ class IAPNSService(Interface):
     def write(self, notification):
         """ Write the notification to APNS """
     
-    def read(self):
+    def read(self, receiver=None):
         """ Read from the feedback service """
 
 
+ssl_contexts = {} # {'certificate fingerprint': SSL.Context}
+ssl_cert_files = {} # {'path': ((mtime, size), 'fingerprint')}
+
+def ssl_context(ssl_cert_file):
+  """ Returns the SSL.Context for a path to a .pem file or a string of one,
+  shared by every connection using the same certificate. The file is only 
+  read again once it changed on disk.
+  """
+  if 'BEGIN CERTIFICATE' in ssl_cert_file:
+    pem = ssl_cert_file
+    fingerprint = hashlib.sha1(pem).hexdigest()
+  else:
+    st = os.stat(ssl_cert_file)
+    stamp = (st.st_mtime, st.st_size)
+    stamped = ssl_cert_files.get(ssl_cert_file)
+    if stamped is not None and stamped[0] == stamp:
+      fingerprint = stamped[1]
+    else:
+      if stamped is not None:
+        log.msg('ssl_context reloading ssl_cert_file=%s' % ssl_cert_file)
+        ssl_contexts.pop(stamped[1], None)
+      with open(ssl_cert_file) as f:
+        pem = f.read()
+      fingerprint = hashlib.sha1(pem).hexdigest()
+      ssl_cert_files[ssl_cert_file] = (stamp, fingerprint)
+  ctx = ssl_contexts.get(fingerprint)
+  if ctx is None:
+    # negotiate the highest version both ends support rather than pinning one
+    ctx = SSL.Context(SSL.SSLv23_METHOD)
+    ctx.set_options(SSL.OP_NO_SSLv2 | SSL.OP_NO_SSLv3)
+    ctx.set_session_cache_mode(SSL.SESS_CACHE_CLIENT)
+    ctx.use_certificate(crypto.load_certificate(crypto.FILETYPE_PEM, pem))
+    ctx.use_privatekey(crypto.load_privatekey(crypto.FILETYPE_PEM, pem))
+    ctx.check_privatekey()
+    ssl_contexts[fingerprint] = ctx
+  return ctx
+
+def keep_tls_session(transport):
+  """ Keeps the TLS session of a connection that is closing with the
+  APNSClientContextFactory that created it, to resume it on the next one
+  """
+  handle = getattr(transport, 'getHandle', lambda: None)()
+  if isinstance(handle, SSL.Connection):
+    creator = handle.get_app_data()
+    if isinstance(creator, APNSClientContextFactory):
+      creator.keepSession(handle)
+
+
 class APNSClientContextFactory(ClientContextFactory):
-  def __init__(self, ssl_cert_file):
+  """ Creates the TLS connections to one APNS host, resuming the TLS 
+  session of the previous connection so reconnects skip the full handshake.
+  """
+  
+  implements(IOpenSSLClientConnectionCreator)
+  
+  def __init__(self, ssl_cert_file, hostname=None):
     if 'BEGIN CERTIFICATE' not in ssl_cert_file:
       log.msg('APNSClientContextFactory ssl_cert_file=%s' % ssl_cert_file)
     else:
       log.msg('APNSClientContextFactory ssl_cert_file={FROM_STRING}')
-    self.ctx = SSL.Context(SSL.TLSv1_METHOD)
-    if 'BEGIN CERTIFICATE' in ssl_cert_file:
-      cer = crypto.load_certificate(crypto.FILETYPE_PEM, ssl_cert_file)
-      pkey = crypto.load_privatekey(crypto.FILETYPE_PEM, ssl_cert_file)
-      self.ctx.use_certificate(cer)
-      self.ctx.use_privatekey(pkey)
-    else:
-      self.ctx.use_certificate_file(ssl_cert_file)
-      self.ctx.use_privatekey_file(ssl_cert_file)
+    self.ssl_cert_file = ssl_cert_file
+    self.hostname = hostname
+    self.session = None # (context, session) of the last handshake
   
   def getContext(self):
-    return self.ctx
+    return ssl_context(self.ssl_cert_file)
+  
+  def clientConnectionForTLS(self, tlsProtocol):
+    ctx = self.getContext()
+    connection = SSL.Connection(ctx, None)
+    connection.set_app_data(self)
+    if self.hostname:
+      connection.set_tlsext_host_name(self.hostname)
+    if self.session is not None and self.session[0] is ctx:
+      connection.set_session(self.session[1])
+    return connection
+  
+  def keepSession(self, connection):
+    # only taken once the connection is done, TLS 1.3 sends session tickets
+    # after the handshake
+    session = connection.get_session()
+    if session is not None:
+      self.session = (connection.get_context(), session)
+
+
+class Frames(object):
+  """ A batch of encoded notification frames numbered with consecutive
+  identifiers starting at `identifier`. `offsets` holds the start of each
+  frame in `data` followed by the length of `data`.
+  """
+
+  def __init__(self, identifier, data, offsets):
+    self.identifier = identifier
+    self.data = data
+    self.offsets = offsets
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def index(self, identifier):
+    "Returns the position of the frame with `identifier` or None"
+    i = (identifier - self.identifier) % 2**32
+    if i < len(self):
+      return i
+
+  def token(self, identifier):
+    "Returns the hex token of the frame with `identifier` or None"
+    i = self.index(identifier)
+    if i is not None:
+      return frame_token(self.data[self.offsets[i]:self.offsets[i+1]])
+
+  def after(self, i):
+    "Returns the frames following position `i` or None"
+    if i + 1 < len(self):
+      start = self.offsets[i+1]
+      return Frames((self.identifier + i + 1) % 2**32, self.data[start:],
+                    [o - start for o in self.offsets[i+1:]])
+
+
+class SentFrames(object):
+  """ A ring buffer of the most recently written Frames on a connection,
+  holding at least the last `size` frames.
+  """
+
+  def __init__(self, size=SENT_FRAMES):
+    self.size = size
+    self.batches = collections.deque()
+    self.count = 0
+
+  def append(self, frames):
+    self.batches.append(frames)
+    self.count += len(frames)
+    while self.count - len(self.batches[0]) >= self.size:
+      self.count -= len(self.batches.popleft())
+
+  def token(self, identifier):
+    for frames in self.batches:
+      token = frames.token(identifier)
+      if token is not None:
+        return token
+
+  def after(self, identifier):
+    """ Returns the frames written after `identifier` as a list of Frames. If
+    the identifier has already left the buffer everything is returned.
+    """
+    batches = list(self.batches)
+    for n, frames in enumerate(batches):
+      i = frames.index(identifier)
+      if i is not None:
+        rest = frames.after(i)
+        return ([rest] if rest else []) + batches[n+1:]
+    log.msg('SentFrames identifier %i is not in the buffer' % identifier)
+    return batches
 
 
 class APNSProtocol(Protocol):
+  """ Writes notifications to the gateway. Messages wait in a send queue
+  while the transport is paused, the connection counts as congested once
+  SEND_QUEUE_HIGH_WATERMARK bytes are queued and until the queue drains
+  to SEND_QUEUE_LOW_WATERMARK.
+  """
+  
+  implements(IPushProducer)
+  written = 0 # bytes written, used by APNSService to pick the least loaded
+
+  def __init__(self):
+    self.sent = SentFrames()
+    self.error = None
+    self.buffer = ''
+    self.queue = collections.deque() # (message, deferred)
+    self.queued = 0 # bytes
+    self.paused = False
+    self.congested = False
+
   def connectionMade(self):
     log.msg('APNSProtocol connectionMade')
+    self.transport.registerProducer(self, True)
     self.factory.addClient(self)
-  
+
   def sendMessage(self, msg):
-    log.msg('APNSProtocol sendMessage msg=%s' % binascii.hexlify(msg))
-    return self.transport.write(msg)
-  
+    """ Queues the message and returns a Deferred that fires once it has 
+    been handed to the transport """
+    d = defer.Deferred()
+    self.queue.append((msg, d))
+    self.queued += len(msg.data if isinstance(msg, Frames) else msg)
+    if self.queued >= SEND_QUEUE_HIGH_WATERMARK:
+      self.congested = True
+    self.flush()
+    return d
+
+  def flush(self):
+    # the transport pauses us from inside write() once its buffer is full
+    while self.queue and not self.paused and self.error is None:
+      msg, d = self.queue.popleft()
+      if isinstance(msg, Frames):
+        self.sent.append(msg)
+        self.factory.service.stats.incr('frames_written', len(msg))
+        msg = msg.data
+      self.queued -= len(msg)
+      if sample_hexdump():
+        log.msg('APNSProtocol sendMessage msg=%s' % binascii.hexlify(msg))
+      self.written += len(msg)
+      self.factory.service.stats.incr('bytes_written', len(msg))
+      self.transport.write(msg)
+      # before the callback, which may write more (like APNSService.drain)
+      if self.queued <= SEND_QUEUE_LOW_WATERMARK:
+        self.congested = False
+      d.callback(None)
+    if self.queued <= SEND_QUEUE_LOW_WATERMARK:
+      self.congested = False
+
+  def pauseProducing(self):
+    self.paused = True
+
+  def resumeProducing(self):
+    self.paused = False
+    self.flush()
+
+  def stopProducing(self):
+    self.paused = True
+
+  def dataReceived(self, data):
+    self.buffer += data
+    if self.error is None and len(self.buffer) >= ERROR_RESPONSE_SIZE:
+      command, status, identifier = struct.unpack(
+        '!BBI', self.buffer[:ERROR_RESPONSE_SIZE])
+      if command != ERROR_RESPONSE_COMMAND:
+        log.msg('APNSProtocol unknown response %s' %
+                binascii.hexlify(self.buffer))
+        return
+      self.error = (status, identifier)
+      log.msg('APNSProtocol error response status=%i (%s) identifier=%i' % (
+              status, ERROR_STATUS_CODES.get(status, 'Unknown'), identifier))
+      self.factory.service.notificationFailed(
+        status, identifier, self.sent.token(identifier))
+      # APNS closes the connection after an error response, don't wait for it
+      self.transport.loseConnection()
+
   def connectionLost(self, reason):
     log.msg('APNSProtocol connectionLost')
+    keep_tls_session(self.transport)
     self.factory.removeClient(self)
+    if self.error is not None:
+      # everything written after the failed (or for a shutdown, the last
+      # successful) notification was discarded by APNS
+      for frames in self.sent.after(self.error[1]):
+        log.msg('APNSProtocol retransmitting %i notifications' % len(frames))
+        self.factory.service.stats.incr('frames_retransmitted', len(frames))
+        self.factory.service.write(frames)
+    # and whatever never left the queue goes out on another connection
+    queue, self.queue, self.queued = self.queue, collections.deque(), 0
+    self.factory.service.requeue(queue)
+
+
+class FeedbackCache(object):
+  """ The most recent `size` (FEEDBACK_CACHE by default) feedback records of
+  an app_id. Records are numbered in the order they were added, a cursor is
+  the number of the record following the last one a reader has seen.
+  """
 
+  def __init__(self, size=None):
+    self.size = size or FEEDBACK_CACHE
+    self.data = ''
+    self.base = 0 # number of the first record in data
 
-class APNSFeedbackHandler(LineReceiver):
-  MAX_LENGTH = 1024*1024
+  def __len__(self):
+    return len(self.data) // FEEDBACK_RECORD.size
+
+  @property
+  def cursor(self):
+    return self.base + len(self)
+
+  def extend(self, records):
+    "Adds a string of binary feedback records"
+    self.data += records
+    dropped = max(0, len(self) - self.size)
+    if dropped:
+      self.data = self.data[dropped * FEEDBACK_RECORD.size:]
+      self.base += dropped
+
+  def since(self, cursor, recent=None):
+    """ Returns the records following `cursor`, the cursor following them
+    and how many records following it are no longer held. `recent` is 
+    (cursor, records) of a read the caller kept in full, it stands in for
+    the records it added that are no longer held. Everything held is 
+    returned for a cursor that isn't valid here, like one handed out before
+    a restart.
+    """
+    size = FEEDBACK_RECORD.size
+    if not 0 <= cursor <= self.cursor:
+      cursor = self.base
+    records = self.data[max(0, cursor - self.base) * size:]
+    lost = max(0, self.base - cursor)
+    if lost and recent is not None:
+      start, read = recent
+      end = start + len(read) // size
+      if end >= self.base:
+        records = (read[max(0, cursor - start) * size:] + 
+                   self.data[(end - self.base) * size:])
+        lost = max(0, start - cursor)
+    return records, self.cursor, lost
+
+
+class APNSFeedbackHandler(Protocol):
+  def __init__(self):
+    self.buffer = ''
   
   def connectionMade(self):
     log.msg('feedbackHandler connectionMade')
 
-  def rawDataReceived(self, data):
-    log.msg('feedbackHandler rawDataReceived %s' % binascii.hexlify(data))
-    self.io.write(data)
-  
-  def lineReceived(self, data):
-    log.msg('feedbackHandler lineReceived %s' % binascii.hexlify(data))
-    self.io.write(data)
+  def dataReceived(self, data):
+    if sample_hexdump():
+      log.msg('feedbackHandler dataReceived %s' % binascii.hexlify(data))
+    # pass on every complete record right away, keep the rest for later
+    data = self.buffer + data
+    end = len(data) - len(data) % FEEDBACK_RECORD.size
+    self.buffer = data[end:]
+    if end:
+      self.factory.recordsReceived(data[:end])
 
   def connectionLost(self, reason):
     log.msg('feedbackHandler connectionLost %s' % reason)
-    self.deferred.callback(self.io.getvalue())
-    self.io.close()
+    keep_tls_session(self.transport)
+    if self.buffer:
+      log.msg('feedbackHandler discarding %i bytes of an incomplete record' %
+              len(self.buffer))
+    self.factory.feedbackFinished()
 
 
 class APNSFeedbackClientFactory(ClientFactory):
+  """ Reads the feedback service. Complete records are passed to `receiver`
+  as they arrive, as a string of one or more binary records, and 
+  `deferred` fires with None once the connection closes. Without a 
+  `receiver` the records are collected and `deferred` fires with all of them.
+  """
+  
   protocol = APNSFeedbackHandler
   
-  def __init__(self):
+  def __init__(self, receiver=None):
     self.deferred = defer.Deferred()
+    self.receiver = receiver
+    self.records = []
   
-  def buildProtocol(self, addr):
-    p = self.protocol()
-    p.factory = self
-    p.deferred = self.deferred
-    p.io = StringIO()
-    p.setRawMode()
-    return p
+  def recordsReceived(self, records):
+    if self.receiver is not None:
+      self.receiver(records)
+    else:
+      self.records.append(records)
+  
+  def feedbackFinished(self):
+    if not self.deferred.called:
+      self.deferred.callback(
+        None if self.receiver is not None else ''.join(self.records))
+    self.records = []
   
   def startedConnecting(self, connector):
     log.msg('APNSFeedbackClientFactory startedConnecting')
@@ -131,19 +465,21 @@ class APNSFeedbackClientFactory(ClientFactory):
 class APNSClientFactory(ReconnectingClientFactory):
   protocol = APNSProtocol
   
-  def __init__(self):
+  def __init__(self, service):
+    self.service = service
     self.clientProtocol = None
-    self.deferred = defer.Deferred()
-    self.deferred.addErrback(log_errback('APNSClientFactory __init__'))
-  
+    self.connects = 0
+
   def addClient(self, p):
     self.clientProtocol = p
-    self.deferred.callback(p)
-  
+    self.connects += 1
+    self.service.stats.incr('connects')
+    if self.connects > 1:
+      self.service.stats.incr('reconnects')
+    self.service.clientConnected(p)
+
   def removeClient(self, p):
     self.clientProtocol = None
-    self.deferred = defer.Deferred()
-    self.deferred.addErrback(log_errback('APNSClientFactory removeClient'))
   
   def startedConnecting(self, connector):
     log.msg('APNSClientFactory startedConnecting')
@@ -171,62 +507,404 @@ class APNSService(service.Service):
   implements(IAPNSService)
   clientProtocolFactory = APNSClientFactory
   feedbackProtocolFactory = APNSFeedbackClientFactory
+  command = 1 # the enhanced format, 2 for the frame format
+  max_payload_size = None # bytes, MAX_PAYLOAD_SIZES of the command by default
+  truncate_alerts = False # shorten the alert of payloads that are too large
+  write_window = 2 # writes per connection a Scheduler keeps under way
   
-  def __init__(self, cert_path, environment, timeout=15):
+  def __init__(self, cert_path, environment, timeout=15, connections=1,
+               spool=None, dead_tokens=None):
     log.msg('APNSService __init__')
-    self.factory = None
+    self.factories = []
+    self.waiting = [] # deferreds waiting for a gateway connection
+    self.spool = spool # a Spool holding writes while not connected
+    self.spooled = collections.deque() # [start, end, sent, deferred]
+    self.respool = None # (end, {start: entry}) of spooled writes read again
+    self.draining = False
     self.environment = environment
     self.cert_path = cert_path
     self.raw_mode = False
     self.timeout = timeout
-  
-  def getContextFactory(self):
-    return APNSClientContextFactory(self.cert_path)
-  
+    self.connections = max(1, int(connections))
+    self.identifier = spool.identifier if spool else 0 # of the next one
+    self.dead_tokens = dead_tokens # a DeadTokens left out of encoded frames
+    self.feedback = FeedbackCache()
+    self.feedback_cursor = 0 # of readers that don't keep their own
+    self.polling = None # deferreds waiting for the feedback read under way
+    self.poller = None # the DelayedCall of the next scheduled feedback read
+    self.stats = Stats()
+    self.context_factories = {} # {'hostname': APNSClientContextFactory}
+    self.last_used = time.time() # of the last write
+    self.scheduled = None # its AppQueue when writes go through a Scheduler
+    self.coalescing = None # its held notifications with a Coalescer
+
+  def getContextFactory(self, hostname=None):
+    "Returns the context factory of the connections to `hostname`"
+    if hostname not in self.context_factories:
+      self.context_factories[hostname] = APNSClientContextFactory(
+        self.cert_path, hostname)
+    return self.context_factories[hostname]
+
+  def connect(self):
+    "Start the pool of gateway connections"
+    server, port = ((APNS_SERVER_SANDBOX_HOSTNAME
+                    if self.environment == 'sandbox'
+                    else APNS_SERVER_HOSTNAME), APNS_SERVER_PORT)
+    context = self.getContextFactory(server)
+    while len(self.factories) < self.connections:
+      factory = self.clientProtocolFactory(self)
+      reactor.connectSSL(server, port, factory, context)
+      self.factories.append(factory)
+
+  def disconnect(self):
+    "Closes the gateway connections, the next write opens them again"
+    factories, self.factories = self.factories, []
+    for factory in factories:
+      factory.stopTrying()
+      if factory.clientProtocol is not None:
+        factory.clientProtocol.transport.loseConnection()
+
+  def busy(self):
+    "Whether notifications are waiting to be written to a connection"
+    return bool(self.waiting or [p for p in self.clients() if p.queue] or
+                (self.spool is not None and self.spool.pending()))
+
+  def whenConnected(self):
+    """ Returns a Deferred that fires once a gateway connection is up, 
+    connecting if need be, or fails after `timeout` seconds.
+    """
+    if not self.factories:
+      self.connect()
+    if self.client():
+      return defer.succeed(None)
+    d = defer.Deferred()
+    self.waiting.append(d)
+    def expire():
+      if d in self.waiting:
+        self.waiting.remove(d)
+      if not d.called:
+        d.errback(Exception('Connection timed out after %i seconds' % 
+                            self.timeout))
+    timeout = reactor.callLater(self.timeout, expire)
+    def cancel_timeout(r):
+      try: timeout.cancel()
+      except: pass
+      return r
+    return d.addBoth(cancel_timeout)
+
+  def clients(self):
+    "Returns the connected gateway protocols"
+    return [f.clientProtocol for f in self.factories if f.clientProtocol]
+
+  def client(self):
+    "Returns the least loaded connected gateway protocol or None"
+    clients = self.clients()
+    if clients:
+      return min(clients, key=lambda p: (p.congested, p.queued, p.written))
+
+  def clientConnected(self, p):
+    # start a fresh connection level with its siblings, otherwise it would
+    # take all of the traffic until it caught up with them
+    p.written = min([c.written for c in self.clients() if c is not p] or [0])
+    waiting, self.waiting = self.waiting, []
+    for d in waiting:
+      d.called or d.callback(None)
+    self.drain()
+
+  def encode(self, tokens, notifications, expiry=0, rejected=None):
+    """ Returns the tokens and notifications as Frames with the next 
+    identifiers. Invalid ones are left out and appended to `rejected` as 
+    (index, reason).
+    """
+    start = time.time()
+    invalid = []
+    frames = encode_frames(tokens, notifications, self.identifier, expiry,
+                           self.command, self.dead_tokens, 
+                           self.max_payload_size, self.truncate_alerts, invalid)
+    if frames is not None:
+      self.identifier = (self.identifier + len(frames)) % 2**32
+      self.stats.observe('encode_seconds', time.time() - start)
+      self.stats.incr('frames_encoded', len(frames))
+      if invalid:
+        log.msg('APNSService rejected %i notifications: %s' % (
+                len(invalid), invalid[0][1]))
+        self.stats.incr('notifications_rejected', len(invalid))
+      if self.dead_tokens is not None:
+        count = 1 if type(tokens) in (str, unicode) else len(tokens)
+        if type(notifications) is list:
+          count = min(count, len(notifications))
+        self.stats.incr('dead_tokens_skipped', 
+                        count - len(frames) - len(invalid))
+    if rejected is not None:
+      rejected.extend(invalid)
+    return frames
+
+  def broadcast(self, tokens, notification, expiry=0, rejected=None,
+                write=None):
+    """ Sends one notification to every token, BROADCAST_CHUNK tokens at a
+    time. The next chunk is encoded once the previous one was handed to a 
+    connection, by `write` instead of self.write if given. Returns a 
+    Deferred that fires after the last one was. Invalid tokens are appended
+    to `rejected` as (index, reason).
+    """
+    write = write or self.write
+    if type(tokens) in (str, unicode):
+      tokens = [tokens]
+    def failed(r, start):
+      # per notification responses, of the HTTP/2 backend
+      if r and rejected is not None:
+        rejected.extend((start + n, reason) for n, reason in r)
+    def chunks():
+      for start in xrange(0, len(tokens), BROADCAST_CHUNK):
+        invalid = []
+        frames = self.encode(tokens[start:start + BROADCAST_CHUNK],
+                             notification, expiry, invalid)
+        if rejected is not None:
+          rejected.extend((start + n, reason) for n, reason in invalid)
+        if len(frames):
+          yield write(frames).addCallback(failed, start)
+    return task.coiterate(chunks()).addCallback(lambda _: None)
+
+  def notificationFailed(self, status, identifier, token):
+    "Called when APNS responds with an error for a notification"
+    log.msg('APNSService notification %i to %s failed: %s' % (
+            identifier, token, ERROR_STATUS_CODES.get(status, status)))
+    self.stats.incr('error_responses')
+    if status == 8 and token and self.dead_tokens is not None:
+      # not a token of this app and environment, until it's registered again
+      self.dead_tokens.add(binascii.unhexlify(token), int(time.time()))
+
+  def feedbackReceived(self, records):
+    "Adds the tokens of binary feedback records to the dead token index"
+    if self.dead_tokens is None:
+      return
+    unpack, size = FEEDBACK_RECORD.unpack_from, FEEDBACK_RECORD.size
+    for offset in xrange(0, len(records) - size + 1, size):
+      ts, toklen, tok = unpack(records, offset)
+      self.dead_tokens.add(tok, ts)
+    self.dead_tokens.sync()
+
+  def pollFeedback(self):
+    """ Reads the feedback service into the feedback cache. Returns a
+    Deferred firing once done with (cursor, records) of every record read,
+    which the cache may not hold all of. Callers share the read that is 
+    under way.
+    """
+    d = defer.Deferred()
+    if self.polling is not None:
+      self.polling.append(d)
+      return d
+    self.polling = [d]
+    start, chunks = self.feedback.cursor, []
+    def received(records):
+      chunks.append(records)
+      self.feedback.extend(records)
+    def done(r):
+      waiting, self.polling = self.polling, None
+      for d in waiting:
+        if isinstance(r, failure.Failure):
+          d.errback(r)
+        else:
+          d.callback((start, ''.join(chunks)))
+    self.read(received).addBoth(done)
+    return d
+
+  def startPolling(self, interval, jitter=0.1):
+    """ Polls the feedback service every `interval` seconds give or take 
+    `jitter` of it, the first time after a random part of an interval so 
+    app_ids started together don't poll together.
+    """
+    def poll():
+      self.pollFeedback().addErrback(lambda f: None).addCallback(
+        lambda _: self.poller and schedule(interval * (1 + 
+          random.uniform(-jitter, jitter))))
+    def schedule(delay):
+      self.poller = reactor.callLater(delay, poll)
+    self.stopPolling()
+    schedule(random.uniform(0, interval))
+
+  def stopPolling(self):
+    if self.poller is not None:
+      if self.poller.active():
+        self.poller.cancel()
+      self.poller = None
+
+  def register(self, tokens, timestamp):
+    """ Takes tokens that were registered with the app at `timestamp` out of
+    the dead token index if they went inactive before. Returns how many were.
+    """
+    if self.dead_tokens is None:
+      return 0
+    if type(tokens) in (str, unicode):
+      tokens = [tokens]
+    registered = 0
+    for token in decode_tokens(tokens):
+      registered += self.dead_tokens.register(token, timestamp)
+    self.dead_tokens.sync()
+    self.stats.incr('dead_tokens_registered', registered)
+    return registered
+
+  def statistics(self):
+    "Returns the counters and histograms of this app_id with current gauges"
+    stats = self.stats.snapshot()
+    clients = self.clients()
+    stats['connections'] = len(clients)
+    stats['queued_bytes'] = sum(p.queued for p in clients)
+    stats['queued_messages'] = sum(len(p.queue) for p in clients)
+    stats['waiting_writes'] = len(self.waiting)
+    stats['feedback_cached'] = len(self.feedback)
+    if self.scheduled is not None:
+      for lane, name in enumerate(LANES):
+        stats['scheduled_' + name] = self.scheduled.queued[lane]
+    if self.coalescing is not None:
+      stats['coalescing'] = len(self.coalescing)
+    if self.spool is not None:
+      stats['spool_bytes'] = self.spool.end - self.spool.committed
+    return stats
+
   def write(self, notifications):
-    "Connect to the APNS service and send notifications"
-    if not self.factory:
+    """ Connect to the APNS service and send notifications. Returns a 
+    Deferred that fires once the notifications were handed to a connection.
+    """
+    self.last_used = time.time()
+    if not self.factories:
       log.msg('APNSService write (connecting)')
-      server, port = ((APNS_SERVER_SANDBOX_HOSTNAME 
-                      if self.environment == 'sandbox'
-                      else APNS_SERVER_HOSTNAME), APNS_SERVER_PORT)
-      self.factory = self.clientProtocolFactory()
-      context = self.getContextFactory()
-      reactor.connectSSL(server, port, self.factory, context)
-    
-    client = self.factory.clientProtocol
+      self.connect()
+
+    if self.spool is not None and (self.spool.pending() or 
+                                   not self.clients()):
+      # keep the spooled order, and don't lose anything while disconnected
+      if self.spoolMessage(notifications):
+        self.drain()
+        return defer.succeed(None)
+      log.msg('APNSService spool is full')
+      self.stats.incr('spool_full')
+
+    start = time.time()
+    def written(r):
+      self.stats.observe('write_seconds', time.time() - start)
+      return r
+    client = self.client()
     if client:
-      return client.sendMessage(notifications)
-    else:      
-      d = self.factory.deferred
-      timeout = reactor.callLater(self.timeout, 
-        lambda: d.called or d.errback(
-          Exception('Notification timed out after %i seconds' % self.timeout)))
-      def cancel_timeout(r):
-        try: timeout.cancel()
-        except: pass
-        return r
-      
-      d.addCallback(lambda p: p.sendMessage(notifications))
+      return client.sendMessage(notifications).addCallback(written)
+    else:
+      def timed_out(f):
+        self.stats.incr('write_timeouts')
+        return f
+      d = self.whenConnected().addErrback(timed_out)
+      d.addCallback(lambda _: self.client().sendMessage(notifications))
       d.addErrback(log_errback('apns-service-write'))
-      d.addBoth(cancel_timeout)
-      return d
+      return d.addCallback(written)
   
-  def read(self):
-    "Connect to the feedback service and read all data."
+  def spoolMessage(self, msg):
+    "Appends a message to the spool, returns False when it is full"
+    if isinstance(msg, Frames):
+      spooled = self.spool.append(msg.data, FRAMES, msg.identifier, len(msg))
+    else:
+      spooled = self.spool.append(msg)
+    if spooled:
+      self.stats.incr('spooled_messages')
+    return spooled
+
+  def drain(self):
+    """ Writes spooled messages to the connections until all are written or
+    the connections are congested, in which case it carries on once one of
+    them takes the message it is waiting on.
+    """
+    if self.spool is None or self.draining:
+      return
+    self.draining = True
+    try:
+      while True:
+        client = self.client()
+        if client is None:
+          return
+        if client.congested:
+          client.queue[-1][1].addBoth(lambda r: (self.drain(), r)[1])
+          return
+        start = self.spool.cursor
+        record = self.spool.read()
+        if record is None:
+          return
+        kind, identifier, data, offset = record
+        if self.respool is not None and start >= self.respool[0]:
+          self.respool = None
+        if self.respool is not None:
+          # read again after a lost connection, skip what others have taken
+          sent = self.respool[1].get(start)
+          if sent is None:
+            continue
+        else:
+          sent = [start, offset, False, None]
+          self.spooled.append(sent)
+        msg = (Frames(identifier, data, frame_offsets(data))
+               if kind == FRAMES else data)
+        sent[3] = client.sendMessage(msg)
+        sent[3].addCallback(self.spoolSent, sent)
+        self.stats.incr('spool_drained')
+    finally:
+      self.draining = False
+
+  def spoolSent(self, r, sent):
+    # connections hand over messages in their own order, only commit the 
+    # spool up to the first message that is still waiting
+    sent[2] = True
+    while self.spooled and self.spooled[0][2]:
+      self.spool.commit(self.spooled.popleft()[1])
+    return r
+
+  def requeue(self, queue):
+    """ Writes again the (message, deferred) queue of a lost connection.
+    Spooled messages are read from the spool again instead, from the oldest
+    of them, so they keep their order.
+    """
+    lost = set(d for msg, d in queue)
+    resend = dict((sent[0], sent) for sent in self.spooled if sent[3] in lost)
+    if resend:
+      end = self.spool.cursor
+      if self.respool is not None:
+        # including what an earlier lost connection left to read again
+        end, earlier = self.respool
+        resend.update((start, sent) for start, sent in earlier.iteritems()
+                      if start >= self.spool.cursor)
+      self.respool = end, resend
+      self.spool.rewind(min(resend))
+    spooled = set(sent[3] for sent in resend.itervalues())
+    for msg, d in queue:
+      if d not in spooled:
+        self.write(msg).chainDeferred(d)
+    self.drain()
+
+  def read(self, receiver=None):
+    """ Connect to the feedback service and read all data. When `receiver`
+    is given it is called with chunks of complete binary records as they
+    arrive instead.
+    """
     log.msg('APNSService read (connecting)')
     try:
       server, port = ((FEEDBACK_SERVER_SANDBOX_HOSTNAME 
                       if self.environment == 'sandbox'
                       else FEEDBACK_SERVER_HOSTNAME), FEEDBACK_SERVER_PORT)
-      factory = self.feedbackProtocolFactory()
-      context = self.getContextFactory()
+      def counted(records):
+        self.stats.incr('feedback_records', 
+                        len(records) // FEEDBACK_RECORD.size)
+        self.feedbackReceived(records)
+        return records
+      factory = self.feedbackProtocolFactory(
+        receiver and (lambda records: receiver(counted(records))))
+      context = self.getContextFactory(server)
       reactor.connectSSL(server, port, factory, context)
+      if receiver is None:
+        factory.deferred.addCallback(counted)
       factory.deferred.addErrback(log_errback('apns-feedback-read'))
+      self.stats.incr('feedback_reads')
       
-      timeout = reactor.callLater(self.timeout,
-        lambda: factory.deferred.called or factory.deferred.errback(
-          Exception('Feedbcak fetch timed out after %i seconds' % self.timeout)))
+      def expire():
+        if not factory.deferred.called:
+          self.stats.incr('feedback_timeouts')
+          factory.deferred.errback(Exception(
+            'Feedbcak fetch timed out after %i seconds' % self.timeout))
+      timeout = reactor.callLater(self.timeout, expire)
       def cancel_timeout(r):
         try: timeout.cancel()
         except: pass
@@ -240,40 +918,165 @@ class APNSService(service.Service):
 
 
 class APNSServer(xmlrpc.XMLRPC):
+  spool_dir = None # spool writes to this directory while disconnected
+  spool_size = 64*1024*1024 # bytes per app_id
+  dead_tokens = False # leave out tokens the feedback service reported
+  dead_tokens_dir = None # keep them in a file per app_id in this directory
+  dead_tokens_bloom = 0 # bits of a bloom filter in front of each file
+  max_payload_size = None # see APNSService
+  truncate_alerts = False
+  feedback_interval = 0 # seconds between feedback reads, 0 to read on demand
+  feedback_jitter = 0.1 # fraction of feedback_interval to vary it by
+  idle_timeout = 0 # seconds after which unused connections are closed
+  max_connections = 0 # gateway connections open at once, 0 for no limit
+  scheduler = None # a Scheduler for writes to go through
+  coalescer = None # a Coalescer holding notifications to send only the latest
+  
   def __init__(self):
     self.app_ids = app_ids
+    self.provisioned = provisioned
+    self.templates = templates
     self.use_date_time = True
     self.useDateTime = True
     xmlrpc.XMLRPC.__init__(self, allowNone=True)
   
   def apns_service(self, app_id):
-    if app_id not in app_ids:
-      raise xmlrpc.Fault(404, 'The app_id specified has not been provisioned.')
+    if app_id not in self.app_ids:
+      if app_id not in self.provisioned:
+        raise xmlrpc.Fault(404, 'The app_id specified has not been provisioned.')
+      self.app_ids[app_id] = self.start_service(app_id)
     return self.app_ids[app_id]
   
-  def xmlrpc_provision(self, app_id, path_to_cert_or_cert, environment, timeout=15):
-    """ Starts an APNSService for the this app_id and keeps it running
-    
+  def make_room(self, service):
+    "Reaps connections for those `service` is about to open"
+    if not service.factories and self.max_connections:
+      self.reap(service.connections)
+  
+  def spool_path(self, app_id):
+    return os.path.join(self.spool_dir, urllib.quote(app_id, '') + '.spool')
+  
+  def start_service(self, app_id):
+    "Returns a new APNSService for a provisioned app_id"
+    path_to_cert_or_cert, environment, timeout, connections, http2 = \
+      self.provisioned[app_id]
+    spool = None
+    if self.spool_dir and not http2:
+      spool = Spool(self.spool_path(app_id), self.spool_size)
+    dead_tokens = None
+    if self.dead_tokens:
+      dead_tokens = DeadTokens(self.dead_tokens_dir and os.path.join(
+        self.dead_tokens_dir, urllib.quote(app_id, '') + '.dead'),
+        self.dead_tokens_bloom)
+    if http2:
+      service = start_http2_service(path_to_cert_or_cert, environment, 
+                                    timeout, connections, dead_tokens, http2)
+    else:
+      service = APNSService(path_to_cert_or_cert, environment, timeout, 
+                            connections, spool, dead_tokens)
+    service.max_payload_size = self.max_payload_size
+    service.truncate_alerts = self.truncate_alerts
+    if self.feedback_interval:
+      service.startPolling(self.feedback_interval, self.feedback_jitter)
+    if spool is not None and spool.pending():
+      log.msg('APNSServer sending what was spooled for %s' % app_id)
+      self.make_room(service)
+      service.connect()
+    return service
+  
+  def warm(self, app_ids, concurrency=10):
+    """ Connects app_ids ahead of their first notification, `concurrency`
+    of them at a time. Returns a Deferred that fires once they all are 
+    connected or timed out.
+    """
+    semaphore = defer.DeferredSemaphore(concurrency)
+    def connect(app_id):
+      service = self.apns_service(app_id)
+      self.make_room(service)
+      return service.whenConnected()
+    return defer.DeferredList([
+      semaphore.run(connect, app_id).addErrback(
+        log_errback('apns-server-warm'))
+      for app_id in app_ids], consumeErrors=True)
+  
+  def reap(self, pending=0):
+    """ Closes the connections of app_ids that weren't written to for 
+    idle_timeout seconds, and of the least recently written to ones while 
+    more than max_connections are open or about to be with `pending` ones.
+    Connections with notifications waiting to be written are left open.
+    """
+    now = time.time()
+    services = sorted([s for s in self.app_ids.values() if s.factories],
+                      key=lambda s: s.last_used)
+    connections = sum(len(s.factories) for s in services) + pending
+    for service in services:
+      idle = self.idle_timeout and now - service.last_used > self.idle_timeout
+      crowded = self.max_connections and connections > self.max_connections
+      if (idle or crowded) and not service.busy():
+        connections -= len(service.factories)
+        service.stats.incr('idle_disconnects')
+        service.disconnect()
+  
+  def startReaping(self, interval=60):
+    "Calls reap every `interval` seconds"
+    self.reaper = task.LoopingCall(self.reap)
+    self.reaper.start(interval, now=False)
+  
+  def xmlrpc_provision(self, app_id, path_to_cert_or_cert, environment,
+                       timeout=15, connections=1, http2=None):
+    """ Provisions this app_id. Its APNSService is started when it is first
+    used and connects on the first notification.
+
       Arguments:
           app_id                 the app_id to provision for APNS
-          path_to_cert_or_cert   absolute path to the APNS SSL cert or a 
+          path_to_cert_or_cert   absolute path to the APNS SSL cert or a
                                  string containing the .pem file
           environment            either 'sandbox' or 'production'
           timeout                seconds to timeout connection attempts
                                  to the APNS server
+          connections            number of gateway connections to keep
+                                 open, notifications are spread across them
+          http2                  settings of the HTTP/2 provider API to
+                                 send through instead of the binary gateway,
+                                 a dict with the `topic` to send for and for
+                                 token authentication the `key` (path or
+                                 contents of the .p8 file), `key_id` and
+                                 `team_id`, optionally `streams` per
+                                 connection. The cert may be empty then
       Returns:
-          None
+          None, fails with fault code 401 when the certificate can't be
+          read or loaded
     """
     
     if environment not in ('sandbox', 'production'):
       raise xmlrpc.Fault(401, 'Invalid environment provided `%s`. Valid '
                               'environments are `sandbox` and `production`' % (
                               environment,))
-    if not app_id in self.app_ids:
+    if path_to_cert_or_cert or not (http2 and http2.get('key')):
+      # rather than failing every connection attempt later on
+      try:
+        ssl_context(path_to_cert_or_cert)
+      except (EnvironmentError, SSL.Error, crypto.Error), e:
+        raise xmlrpc.Fault(401, 'Invalid certificate provided: %s' % (e,))
+    if not app_id in self.provisioned:
       # log.msg('provisioning ' + app_id + ' environment ' + environment)
-      self.app_ids[app_id] = APNSService(path_to_cert_or_cert, environment, timeout)
+      self.provisioned[app_id] = (path_to_cert_or_cert, environment, timeout,
+                                  connections, http2)
+      # start right away what has work to do before the first notification,
+      # polling feedback doesn't connect to the gateway
+      if self.feedback_interval or (self.spool_dir and not http2 and 
+          os.path.exists(self.spool_path(app_id)) and
+          os.path.getsize(self.spool_path(app_id)) > SPOOL_HEADER.size):
+        self.apns_service(app_id)
+  
+  def write(self, app_id, service, frames, lane=INTERACTIVE):
+    "Writes frames to the service of an app_id through the scheduler if any"
+    self.make_room(service)
+    if self.scheduler is None:
+      return service.write(frames)
+    return self.scheduler.submit(app_id, service, frames, lane)
   
-  def xmlrpc_notify(self, app_id, token_or_token_list, aps_dict_or_list):
+  def xmlrpc_notify(self, app_id, token_or_token_list, aps_dict_or_list,
+                    expiry=0, bulk=False):
     """ Sends push notifications to the Apple APNS server. Multiple 
     notifications can be sent by sending pairing the token/notification
     arguments in lists [token1, token2], [notification1, notification2].
@@ -282,15 +1085,145 @@ class APNSServer(xmlrpc.XMLRPC):
           app_id                provisioned app_id to send to
           token_or_token_list   token to send the notification or a list of tokens
           aps_dict_or_list      notification dicts or a list of notifications
+          expiry                UNIX time until which APNS should keep trying
+                                to deliver the notifications, 0 to only try
+                                once
+          bulk                  send in the bulk lane of the scheduler, after
+                                interactive notifications
+      Returns:
+          None, or a list of [index, reason] of notifications that were not 
+          sent because their token or payload is invalid, or with the 
+          HTTP/2 backend that APNS rejected. Notifications held by the 
+          coalescer are not included
+    """
+    lane = BULK if bulk else INTERACTIVE
+    if self.coalescer is None:
+      return self.send(app_id, token_or_token_list, aps_dict_or_list, expiry,
+                       lane)
+    tokens, notifications, indexes = self.coalescer.hold(
+      app_id, self.apns_service(app_id), token_or_token_list, 
+      aps_dict_or_list, expiry, lane)
+    if indexes is None:
+      return self.send(app_id, tokens, notifications, expiry, lane)
+    if not indexes:
+      return None
+    return renumber(self.send(app_id, tokens, notifications, expiry, lane),
+                    indexes)
+  
+  def send(self, app_id, tokens, notifications, expiry=0, lane=INTERACTIVE):
+    "Encodes and writes notifications, returns the result of xmlrpc_notify"
+    service = self.apns_service(app_id)
+    rejected = []
+    frames = service.encode(tokens, notifications, expiry, rejected)
+    if frames is not None and not len(frames):
+      return rejected or None
+    return self.written(self.write(app_id, service, frames, lane), rejected)
+  
+  def xmlrpc_template(self, app_id, name, aps_dict):
+    """ Registers a notification with placeholders for notify_template, 
+    serialized once. A placeholder is ${name} in a string of the 
+    notification, not in a key, a string that is only a placeholder is
+    replaced by a value of any type. Templates are kept in memory, register them again after 
+    the daemon was restarted.
+    
+      Arguments:
+          app_id     provisioned app_id to send with the template
+          name       String naming the template
+          aps_dict   the notification dict with placeholders, or None to
+                     remove the template
       Returns:
-          None
+          The names of the placeholders, the order of values passed as lists
+    """
+    
+    if app_id not in self.provisioned:
+      raise xmlrpc.Fault(404, 'The app_id specified has not been provisioned.')
+    if aps_dict is None:
+      self.templates.get(app_id, {}).pop(name, None)
+      return []
+    try:
+      template = Template(aps_dict)
+    except ValueError, e:
+      raise xmlrpc.Fault(400, 'Invalid template: %s' % e)
+    self.templates.setdefault(app_id, {})[name] = template
+    return template.order
+  
+  def xmlrpc_notify_template(self, app_id, name, token_or_token_list, values,
+                             expiry=0, bulk=False):
+    """ Sends the notification of a template registered with `template`
+    with values in place of its placeholders, spliced into the serialized 
+    template.
+    
+      Arguments:
+          app_id                provisioned app_id to send to
+          name                  name of the template
+          token_or_token_list   token to send the notification or a list of tokens
+          values                the values of one token or a list of them per 
+                                token, each a dict keyed by the placeholder 
+                                names or a list in their alphabetical order
+          expiry                see notify
+          bulk                  see notify
+      Returns:
+          None, or a list of [index, reason] like notify, values missing 
+          for a placeholder with the reason 'Missing template value'. Fails
+          with fault code 412 when the template is not registered.
+    """
+    
+    if app_id not in self.provisioned:
+      raise xmlrpc.Fault(404, 'The app_id specified has not been provisioned.')
+    template = self.templates.get(app_id, {}).get(name)
+    if template is None:
+      raise xmlrpc.Fault(412, 'The template specified has not been registered.')
+    tokens = token_or_token_list
+    if type(tokens) in (str, unicode):
+      tokens, values = [tokens], [values]
+    if type(tokens) is not list or type(values) is not list:
+      raise xmlrpc.Fault(400, 'tokens and values must be lists')
+    count = min(len(tokens), len(values))
+    indexes, payloads, rejected = [], [], []
+    render = template.render
+    for n in xrange(count):
+      try:
+        payloads.append(render(values[n]))
+        indexes.append(n)
+      except (KeyError, IndexError, TypeError, UnicodeDecodeError):
+        rejected.append([n, 'Missing template value'])
+    if not rejected:
+      return self.send(app_id, tokens[:count], payloads, expiry, 
+                       BULK if bulk else INTERACTIVE)
+    tokens = [tokens[n] for n in indexes]
+    return renumber(self.send(app_id, tokens, payloads, expiry,
+                              BULK if bulk else INTERACTIVE), 
+                    indexes, rejected)
+  
+  def xmlrpc_broadcast(self, app_id, tokens, aps_dict, expiry=0):
+    """ Sends the same push notification to many tokens. The notification 
+    is serialized only once and the tokens are sent in chunks, in the bulk
+    lane of the scheduler.
+    
+      Arguments:
+          app_id     provisioned app_id to send to
+          tokens     list of tokens to send the notification to
+          aps_dict   the notification dict
+          expiry     UNIX time until which APNS should keep trying to 
+                     deliver the notifications, 0 to only try once
+      Returns:
+          None, or a list of [index, reason] of tokens the notification was
+          not sent to because they or the notification are invalid, or with
+          the HTTP/2 backend that APNS rejected
+    """
+    if not isinstance(aps_dict, dict):
+      raise xmlrpc.Fault(400, 'The notification must be a dict')
+    rejected = []
+    service = self.apns_service(app_id)
+    return self.written(service.broadcast(
+      tokens, aps_dict, expiry, rejected, 
+      lambda frames: self.write(app_id, service, frames, BULK)), rejected)
+  
+  def written(self, d, rejected=None):
+    """ Turns the result of APNSService.write into a XML-RPC response, the 
+    `rejected` notifications and those APNS answered with an error if there 
+    are any
     """
-    d = self.apns_service(app_id).write(
-      encode_notifications(
-        [t.replace(' ', '') for t in token_or_token_list] 
-          if (type(token_or_token_list) is list)
-          else token_or_token_list.replace(' ', ''),
-        aps_dict_or_list))
     if d:
       def _finish_err(r):
         # so far, the only error that could really become of this
@@ -298,37 +1231,345 @@ class APNSServer(xmlrpc.XMLRPC):
         # that are made unsuccessfully, which twisted will try endlessly
         # to reconnect to, we timeout and notifify the client
         raise xmlrpc.Fault(500, 'Connection to the APNS server could not be made.')
-      return d.addCallbacks(lambda r: None, _finish_err)
+      return d.addCallbacks(
+        lambda r: sorted((rejected or []) + (r or [])) or None, _finish_err)
+  
+  def xmlrpc_feedback(self, app_id, compact=False, since=None):
+    """ Returns the tokens the Apple APNS feedback server reported inactive.
+    With `feedback_interval` set they were read in the background, otherwise
+    the feedback server is queried, once for all concurrent callers.
+    
+    Without `since` every record is returned once to callers that don't
+    pass it. Readers passing `since` get the records following that cursor
+    and the cursor to pass next time, start with 0.
+    
+      Arguments:
+          app_id    the app_id to query
+          compact   return the feedback as two binary strings instead, the 
+                    timestamps as packed 4 byte big endian integers and the
+                    concatenated 32 byte binary tokens
+          since     OPTIONAL cursor returned by the previous call
+      Returns:
+          Feedback tuples like (datetime_expired, token_str) or 
+          [timestamps, tokens] when compact, as [cursor, feedback] when
+          `since` was given
+    """
+    
+    service = self.apns_service(app_id)
+    if service.poller is not None:
+      d = defer.succeed(None)
+    else:
+      d = service.pollFeedback()
+    def cached(recent):
+      if since is None:
+        records, service.feedback_cursor, lost = service.feedback.since(
+          service.feedback_cursor, recent)
+      else:
+        records, cursor, lost = service.feedback.since(since, recent)
+      if lost:
+        log.msg('APNSServer %i feedback records of %s were dropped from the '
+                'cache before they were read' % (lost, app_id))
+        service.stats.incr('feedback_lost', lost)
+      if compact:
+        timestamps, tokens = decode_feedback_compact(records)
+        feedback = [xmlrpc.Binary(timestamps), xmlrpc.Binary(tokens)]
+      else:
+        feedback = decode_feedback(records)
+      return feedback if since is None else [cursor, feedback]
+    return d.addCallback(cached)
+  
+  def xmlrpc_register(self, app_id, token_or_token_list, registered=None):
+    """ Tells pyapns that tokens were registered with the app again, so 
+    that they are sent to although the feedback service reported them 
+    inactive before that.
+    
+      Arguments:
+          app_id                the app_id the tokens belong to
+          token_or_token_list   token or list of tokens
+          registered            OPTIONAL datetime or UNIX time at which they
+                                were registered, defaults to now
+      Returns:
+          The number of tokens no longer left out
+    """
+    
+    if registered is None:
+      registered = time.time()
+    elif isinstance(registered, datetime.datetime):
+      registered = time.mktime(registered.timetuple())
+    return self.apns_service(app_id).register(token_or_token_list, 
+                                              int(registered))
   
-  def xmlrpc_feedback(self, app_id):
-    """ Queries the Apple APNS feedback server for inactive app tokens. Returns
-    a list of tuples as (datetime_went_dark, token_str).
+  def xmlrpc_stats(self, app_id=None):
+    """ Returns the counters, latency histograms and queue depths of an 
+    app_id, or of every provisioned app_id when none is given.
     
       Arguments:
-          app_id   the app_id to query
+          app_id   OPTIONAL the app_id to get statistics for
       Returns:
-          Feedback tuples like (datetime_expired, token_str)
+          A dict of statistics or a dict of them keyed by app_id
     """
     
-    return self.apns_service(app_id).read().addCallback(
-      lambda r: decode_feedback(r))
+    if app_id is not None:
+      return xmlrpc_safe(self.apns_service(app_id).statistics())
+    return xmlrpc_safe(dict((app_id, service.statistics()) 
+                            for app_id, service in self.app_ids.items()))
 
 
-def encode_notifications(tokens, notifications):
+def renumber(result, indexes, rejected=None):
+  """ Returns the result of xmlrpc_notify for some of the notifications of
+  a call with their index in the call, `indexes`, and the `rejected` ones
+  of the call added. Takes and returns a Deferred or not.
+  """
+  if isinstance(result, defer.Deferred):
+    return result.addCallback(renumber, indexes, rejected)
+  result = [[indexes[n], reason] for n, reason in result or []]
+  return sorted((rejected or []) + result) or None
+
+def start_http2_service(cert, environment, timeout, connections, dead_tokens,
+                        settings):
+  "Returns an HTTP2Service for the `http2` settings of xmlrpc_provision"
+  from .http2 import HTTP2Service, ProviderToken, MAX_STREAMS
+  token = None
+  if settings.get('key'):
+    token = ProviderToken(settings['key'], settings['key_id'], 
+                          settings['team_id'])
+  return HTTP2Service(cert, environment, timeout, connections, dead_tokens,
+                      settings.get('topic'), token,
+                      settings.get('streams', MAX_STREAMS))
+
+def encode_notifications(tokens, notifications, identifier=None, expiry=0,
+                         command=None, dead_tokens=None, max_payload=None,
+                         truncate=False, rejected=None):
   """ Returns the encoded bytes of tokens and notifications
   
         tokens          a list of tokens or a string of only one token
-        notifications   a list of notifications or a dictionary of only one
+        notifications   a list of notifications or a dictionary of only one,
+                        which is sent to every token
+        identifier      identifier of the first notification, the others are
+                        numbered consecutively. Without one the simple
+                        (command 0) format is used, with one the enhanced
+                        (command 1) format
+        expiry          UNIX time after which APNS may discard the 
+                        notifications, 0 to discard them right away if they
+                        can't be delivered
+        command         0, 1 or 2 to force a format, 2 is the frame format
+        dead_tokens     binary tokens to leave out, like a DeadTokens
+        max_payload     bytes a payload may take, MAX_PAYLOAD_SIZES of the 
+                        command by default
+        truncate        shorten the alert of payloads that are too large
+                        rather than rejecting them
+        rejected        a list to append (index, reason) of notifications
+                        with an invalid token or payload to, which are left
+                        out. Without one they raise a ValueError
+  """
+  
+  frames = encode_frames(tokens, notifications, identifier or 0, expiry,
+                         command if command is not None 
+                         else 0 if identifier is None else 1, dead_tokens,
+                         max_payload, truncate, rejected)
+  if frames is not None:
+    return frames.data
+
+FRAME_STRUCTS = { # command: (frame header, frame trailer), payload between
+  0: (struct.Struct('!BH32sH'), None),
+  1: (struct.Struct('!BIIH32sH'), None),
+  2: (struct.Struct('!BIBH32sBH'), struct.Struct('!BHIBHIBHB')),
+}
+
+def check_notifications(tokens, notifications, max_payload, dead_tokens=None,
+                        truncate=False, rejected=None):
+  """ Returns (indexes, binary tokens, payloads) of the notifications to 
+  send, `indexes` holding the position of each of them in the arguments or
+  None when none were left out. Returns None for arguments of the wrong 
+  type, see encode_notifications for the others.
   """
   
-  fmt = "!BH32sH%ds"
-  structify = lambda t, p: struct.pack(fmt % len(p), 0, 32, t, len(p), p)
-  binaryify = lambda t: t.decode('hex')
+  def reject(n, reason):
+    if rejected is None:
+      raise ValueError('Notification %i: %s' % (n, reason))
+    rejected.append((n, reason))
+  dumps = json.compact_dumps
   if type(notifications) is dict and type(tokens) in (str, unicode):
     tokens, notifications = ([tokens], [notifications])
-  if type(notifications) is list and type(tokens) is list:
-    return ''.join(map(lambda y: structify(*y), ((binaryify(t), json.dumps(p, separators=(',',':'), ensure_ascii=False).encode('utf-8'))
-                                    for t, p in zip(tokens, notifications))))
+  broadcast = type(notifications) is dict
+  if broadcast and type(tokens) is list:
+    count = len(tokens)
+  elif type(notifications) is list and type(tokens) is list:
+    count = min(len(tokens), len(notifications))
+    notifications = notifications[:count]
+  else:
+    return None
+  tokens = check_tokens(tokens[:count])
+  indexes = None # of the remaining notifications, when some were left out
+  if dead_tokens is not None or None in tokens:
+    indexes = []
+    for n, t in enumerate(tokens):
+      if t is None:
+        reject(n, 'Invalid token')
+      elif dead_tokens is None or t not in dead_tokens:
+        indexes.append(n)
+    if len(indexes) < count:
+      tokens = [tokens[n] for n in indexes]
+      if not broadcast:
+        notifications = [notifications[n] for n in indexes]
+  if broadcast:
+    # the same notification to every token, serialized once
+    payload = dumps(notifications).encode('utf-8')
+    if len(payload) > max_payload:
+      payload = truncate and truncate_alert(notifications, max_payload)
+      if not payload:
+        for n in (indexes if indexes is not None else xrange(len(tokens))):
+          reject(n, 'Payload too large')
+        indexes, tokens = [], []
+    payloads = [payload] * len(tokens)
+  else:
+    payloads = [p if type(p) is Payload else dumps(p).encode('utf-8')
+                for p in notifications]
+    if payloads and max(map(len, payloads)) > max_payload:
+      fitting_indexes, fitting_tokens, fitting = [], [], []
+      for m, p in enumerate(payloads):
+        n = indexes[m] if indexes is not None else m
+        if len(p) > max_payload:
+          notification = notifications[m]
+          if type(notification) is Payload:
+            notification = json.loads(notification)
+          p = truncate and truncate_alert(notification, max_payload)
+          if not p:
+            reject(n, 'Payload too large')
+            continue
+        fitting_indexes.append(n)
+        fitting_tokens.append(tokens[m])
+        fitting.append(p)
+      indexes, tokens, payloads = fitting_indexes, fitting_tokens, fitting
+  return indexes, tokens, payloads
+
+def encode_frames(tokens, notifications, identifier, expiry=0, command=1,
+                  dead_tokens=None, max_payload=None, truncate=False,
+                  rejected=None):
+  """ Returns the encoded tokens and notifications as Frames, see 
+  encode_notifications for the arguments. Tokens in `dead_tokens`, a 
+  container of binary tokens, are left out.
+  """
+  
+  if command not in FRAME_STRUCTS:
+    raise ValueError('Unknown notification command %r' % (command,))
+  if max_payload is None:
+    max_payload = MAX_PAYLOAD_SIZES[command]
+  checked = check_notifications(tokens, notifications, max_payload, 
+                                dead_tokens, truncate, rejected)
+  if checked is None:
+    return None
+  _, tokens, payloads = checked
+  count = len(tokens)
+  
+  head, tail = FRAME_STRUCTS[command]
+  frame_size = head.size + (tail.size if tail else 0)
+  buf = bytearray(frame_size * count + sum(map(len, payloads)))
+  offsets = [0] * (count + 1)
+  pack_head, pos = head.pack_into, 0
+  for n in xrange(count):
+    t, p = tokens[n], payloads[n]
+    i = (identifier + n) % 2**32
+    if command == 0:
+      pack_head(buf, pos, 0, 32, t, len(p))
+    elif command == 1:
+      pack_head(buf, pos, 1, i, expiry, 32, t, len(p))
+    else:
+      pack_head(buf, pos, 2, frame_size - 5 + len(p), 1, 32, t, 2, len(p))
+    pos += head.size
+    buf[pos:pos + len(p)] = p
+    pos += len(p)
+    if tail:
+      tail.pack_into(buf, pos, 3, 4, i, 4, 4, expiry, 5, 1, 10)
+      pos += tail.size
+    offsets[n + 1] = pos
+  return Frames(identifier, str(buf), offsets)
+
+def decode_tokens(tokens):
+  "Returns the 32 byte binary form of a list of hex tokens, ignoring spaces"
+  
+  joined = ''.join(tokens)
+  if len(joined) == 64 * len(tokens) and len(set(map(len, tokens))) == 1 \
+     and ' ' not in joined:
+    # all well formed, unhexlify them in one go
+    raw = binascii.unhexlify(joined)
+    return [raw[i:i + 32] for i in xrange(0, len(raw), 32)]
+  return [binascii.unhexlify(t.replace(' ', '')) for t in tokens]
+
+def check_tokens(tokens):
+  """ Returns the binary form of a list of hex tokens like decode_tokens, 
+  with None in place of tokens that are not 32 bytes of hex
+  """
+  
+  errors = (TypeError, ValueError, AttributeError, binascii.Error)
+  try:
+    raw = decode_tokens(tokens)
+    if not raw or set(map(len, raw)) == set([32]):
+      return raw
+  except errors:
+    pass
+  checked = []
+  for t in tokens:
+    try:
+      t = decode_tokens([t])[0]
+    except errors:
+      t = None
+    checked.append(t if t is not None and len(t) == 32 else None)
+  return checked
+
+def truncate_alert(notification, max_payload):
+  """ Returns the serialized notification with the end of its alert cut off
+  so it takes at most `max_payload` bytes, without splitting characters, or
+  None when it doesn't have an alert that can be shortened enough
+  """
+  
+  dumps = json.compact_dumps
+  aps = notification.get('aps') if isinstance(notification, dict) else None
+  alert = aps.get('alert') if isinstance(aps, dict) else None
+  body = alert.get('body') if isinstance(alert, dict) else alert
+  if not isinstance(body, basestring):
+    return None
+  try:
+    body = unicode(body) if isinstance(body, unicode) else body.decode('utf-8')
+  except UnicodeDecodeError:
+    return None
+  excess = len(dumps(notification).encode('utf-8')) - max_payload
+  cut = len(body)
+  while excess > 0 and cut > 0:
+    # characters take more bytes in the payload once escaped
+    cut -= 1
+    excess -= len(dumps(body[cut]).encode('utf-8')) - 2
+  if excess > 0:
+    return None
+  if cut and u'\ud800' <= body[cut - 1] <= u'\udbff':
+    cut -= 1 # the first half of a surrogate pair
+  aps = dict(aps)
+  if isinstance(alert, dict):
+    aps['alert'] = dict(alert, body=body[:cut])
+  else:
+    aps['alert'] = body[:cut]
+  return dumps(dict(notification, aps=aps)).encode('utf-8')
+
+def frame_offsets(data):
+  "Returns the offsets of the frames in encoded notifications, see Frames"
+  
+  offsets, pos = [0], 0
+  while pos < len(data):
+    command = ord(data[pos])
+    if command == 2:
+      pos += 5 + struct.unpack_from('!I', data, pos + 1)[0]
+    else:
+      head = FRAME_STRUCTS[command][0]
+      pos += head.size + struct.unpack_from('!H', data, pos + head.size - 2)[0]
+    offsets.append(pos)
+  return offsets
+
+def frame_token(frame):
+  "Returns the hex token of an encoded notification frame"
+  
+  command = ord(frame[0])
+  start = {0: 3, 1: 11, 2: 8}[command]
+  return binascii.hexlify(frame[start:start + 32])
 
 def decode_feedback(binary_tuples):
   """ Returns a list of tuples in (datetime, token_str) format 
@@ -336,12 +1577,31 @@ def decode_feedback(binary_tuples):
         binary_tuples   the binary-encoded feedback tuples
   """
   
-  fmt = '!lh32s'
-  size = struct.calcsize(fmt)
-  with StringIO(binary_tuples) as f:
-    return [(datetime.datetime.fromtimestamp(ts), binascii.hexlify(tok))
-            for ts, toklen, tok in (struct.unpack(fmt, tup) 
-                              for tup in iter(lambda: f.read(size), ''))]
+  return list(iter_feedback(binary_tuples))
+
+def iter_feedback(binary_tuples):
+  "Yields the (datetime, token_str) tuples of binary-encoded feedback tuples"
+  
+  unpack, size = FEEDBACK_RECORD.unpack_from, FEEDBACK_RECORD.size
+  fromtimestamp = datetime.datetime.fromtimestamp
+  hexlify = binascii.hexlify
+  for offset in xrange(0, len(binary_tuples) - size + 1, size):
+    ts, toklen, tok = unpack(binary_tuples, offset)
+    yield fromtimestamp(ts), hexlify(tok)
+
+def decode_feedback_compact(binary_tuples):
+  """ Returns binary-encoded feedback tuples as a string of packed 4 byte 
+  big endian timestamps and a string of the 32 byte binary tokens
+  """
+  
+  size = FEEDBACK_RECORD.size
+  offsets = xrange(0, len(binary_tuples) - size + 1, size)
+  return (''.join([binary_tuples[o:o + 4] for o in offsets]),
+          ''.join([binary_tuples[o + 6:o + size] for o in offsets]))
+
+def sample_hexdump():
+  "Whether to log the hex dump of a message, see HEXDUMP_SAMPLE"
+  return HEXDUMP_SAMPLE and random.random() < HEXDUMP_SAMPLE
 
 def log_errback(name):
   def _log_errback(err, *args):
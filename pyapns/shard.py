@@ -0,0 +1,276 @@
+""" Spreads the app_ids of one daemon over several worker processes so
+encoding, TLS and request parsing use more than one core.
+
+The front process runs a ShardedServer in place of APNSServer and a
+Supervisor starting the workers, which run the same tac file and find their
+place through the PYAPNS_WORKER environment variable (see worker()). Each
+app_id belongs to the worker a HashRing maps it to; requests for it are
+forwarded to that worker over the compact ingestion protocol on a UNIX
+socket, and provisioning is repeated to a worker that was restarted.
+"""
+
+import os
+import sys
+import time
+import bisect
+import hashlib
+import xmlrpclib
+from twisted.application import service
+from twisted.internet import reactor, defer, protocol, error, task
+from twisted.python import log
+from twisted.web import xmlrpc
+from .client import UnknownAppID
+from .txclient import Client
+
+WORKER_ENV = 'PYAPNS_WORKER' # index:count:socket of a worker process
+
+
+def worker():
+  """ Returns the (index, count, socket path) of this worker process, None
+  in the front process
+  """
+  if WORKER_ENV not in os.environ:
+    return None
+  index, count, path = os.environ[WORKER_ENV].split(':', 2)
+  return int(index), int(count), path
+
+def exit_with_parent(interval=1):
+  """ Stops this worker process once the front process that started it is
+  gone, which would otherwise leave it holding its socket
+  """
+  parent = os.getppid()
+  def check():
+    if os.getppid() != parent:
+      log.msg('Worker exiting, its front process is gone')
+      reactor.stop()
+  checker = task.LoopingCall(check)
+  checker.start(interval, now=False)
+  return checker
+
+def twistd_args(tac_file):
+  "Returns the command running `tac_file` in the foreground with twistd"
+  return [sys.executable, sys.argv[0], '--nodaemon', '--pidfile=',
+          '--python', os.path.abspath(tac_file)]
+
+
+class HashRing(object):
+  """ Maps app_ids onto `count` workers by consistent hashing. Each worker
+  is placed on the ring `replicas` times, so app_ids are spread evenly and
+  changing the number of workers moves few of them.
+  """
+
+  def __init__(self, count, replicas=100):
+    ring = sorted((self.hash('%d-%d' % (worker, replica)), worker)
+                  for worker in xrange(count) for replica in xrange(replicas))
+    self.points = [point for point, _ in ring]
+    self.workers = [worker for _, worker in ring]
+
+  @staticmethod
+  def hash(key):
+    if isinstance(key, unicode):
+      key = key.encode('utf-8')
+    return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+  def get(self, app_id):
+    "Returns the index of the worker owning `app_id`"
+    i = bisect.bisect(self.points, self.hash(app_id)) % len(self.points)
+    return self.workers[i]
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+  def __init__(self, supervisor, index):
+    self.supervisor = supervisor
+    self.index = index
+
+  def childDataReceived(self, fd, data):
+    for line in data.splitlines():
+      log.msg('worker %d: %s' % (self.index, line))
+
+  def processEnded(self, reason):
+    self.supervisor.ended(self.index, reason)
+
+
+class Supervisor(service.Service):
+  """ Keeps `count` worker processes running `args` (see twistd_args),
+  restarting one that exits after restart_delay seconds, doubled up to
+  max_restart_delay while it keeps exiting right after it started.
+  `socket_path` is formatted with the index of a worker to get the UNIX
+  socket it listens on.
+  """
+  restart_delay = 1
+  max_restart_delay = 60
+  stop_timeout = 10 # seconds before workers that don't stop are killed
+
+  def __init__(self, args, count, socket_path):
+    self.args = args
+    self.count = count
+    self.socket_path = socket_path
+    self.processes = [None] * count
+    self.started = [0] * count
+    self.delays = [self.restart_delay] * count # before the next restart
+    self.restarts = [None] * count # DelayedCalls
+    self.stopping = None
+
+  def socket(self, index):
+    return self.socket_path % index
+
+  def startService(self):
+    service.Service.startService(self)
+    for index in xrange(self.count):
+      self.spawn(index)
+
+  def spawn(self, index):
+    self.restarts[index] = None
+    env = dict(os.environ)
+    env[WORKER_ENV] = '%d:%d:%s' % (index, self.count, self.socket(index))
+    self.started[index] = time.time()
+    self.processes[index] = reactor.spawnProcess(
+      WorkerProcess(self, index), self.args[0], self.args, env)
+    log.msg('Supervisor started worker %d, pid %d' % (
+      index, self.processes[index].pid))
+
+  def ended(self, index, reason):
+    self.processes[index] = None
+    if not self.running:
+      if self.stopping is not None and not any(self.processes):
+        self.stopping.callback(None)
+      return
+    # back off while the worker keeps exiting right after it started
+    if time.time() - self.started[index] >= self.max_restart_delay:
+      self.delays[index] = self.restart_delay
+    delay = self.delays[index]
+    self.delays[index] = min(delay * 2, self.max_restart_delay)
+    log.msg('Supervisor worker %d exited (%s), restarting in %ss' % (
+      index, reason.value, delay))
+    self.restarts[index] = reactor.callLater(delay, self.spawn, index)
+
+  def stopService(self):
+    service.Service.stopService(self)
+    for index, call in enumerate(self.restarts):
+      if call is not None:
+        call.cancel()
+        self.restarts[index] = None
+    running = [p for p in self.processes if p is not None]
+    if not running:
+      return None
+    self.stopping = defer.Deferred()
+    for process in running:
+      process.signalProcess('TERM')
+    def kill():
+      for process in self.processes:
+        if process is not None:
+          process.signalProcess('KILL')
+    call = reactor.callLater(self.stop_timeout, kill)
+    return self.stopping.addBoth(lambda r: call.active() and call.cancel())
+
+
+class ShardedServer(xmlrpc.XMLRPC):
+  """ Takes the requests of APNSServer, over XML-RPC or an IngestFactory,
+  and forwards each to the worker of the Supervisor owning its app_id.
+  Every worker is called on `connections` pipelined connections.
+  """
+
+  def __init__(self, supervisor, connections=2, concurrency=1000):
+    xmlrpc.XMLRPC.__init__(self, allowNone=True, useDateTime=True)
+    self.ring = HashRing(supervisor.count)
+    self.clients = [Client('unix://' + supervisor.socket(index), connections,
+                           concurrency, timeout=None)
+                    for index in xrange(supervisor.count)]
+    self.provisioned = {} # {'app_id': provision arguments}
+    self.templates = {} # {'app_id': {'name': notification}}
+
+  def call(self, app_id, method, *params):
+    "Returns a Deferred firing with the result of the worker owning app_id"
+    client = self.clients[self.ring.get(app_id)]
+    def reprovision(f):
+      # the worker was restarted since and only knows its autoprovision,
+      # without templates
+      if f.check(UnknownAppID) and app_id in self.provisioned:
+        d = client.request('provision', self.provisioned[app_id])
+      elif f.check(xmlrpclib.Fault) and f.value.faultCode == 412 and \
+          self.templates.get(app_id):
+        d = defer.succeed(None)
+      else:
+        return f
+      for name, template in self.templates.get(app_id, {}).items():
+        d.addCallback(lambda _, params=[app_id, name, template]:
+                      client.request('template', params))
+      return d.addCallback(lambda _: client.request(method, params))
+    d = client.request(method, params).addErrback(reprovision)
+    return d.addErrback(self.failed)
+
+  def failed(self, f):
+    if f.check(UnknownAppID):
+      raise xmlrpc.Fault(404, 'The app_id specified has not been provisioned.')
+    if f.check(xmlrpclib.Fault):
+      raise xmlrpc.Fault(f.value.faultCode, f.value.faultString)
+    if f.check(error.ConnectError, error.ConnectionLost, error.ConnectionDone):
+      log.msg('ShardedServer worker unavailable: %s' % f.value)
+      raise xmlrpc.Fault(503, 'The worker of this app_id is unavailable, '
+                              'try again.')
+    return f
+
+  def xmlrpc_provision(self, app_id, path_to_cert_or_cert, environment,
+                       *args):
+    """ Provisions this app_id on the worker owning it, see
+    APNSServer.xmlrpc_provision
+    """
+    params = [app_id, path_to_cert_or_cert, environment] + list(args)
+    def provisioned(r):
+      self.provisioned.setdefault(app_id, params)
+      return r
+    return self.call(app_id, 'provision', *params).addCallback(provisioned)
+
+  def xmlrpc_notify(self, app_id, *args):
+    "See APNSServer.xmlrpc_notify"
+    return self.call(app_id, 'notify', app_id, *args)
+
+  def xmlrpc_template(self, app_id, name, aps_dict):
+    "See APNSServer.xmlrpc_template"
+    def registered(r):
+      templates = self.templates.setdefault(app_id, {})
+      if aps_dict is None:
+        templates.pop(name, None)
+      else:
+        templates[name] = aps_dict
+      return r
+    d = self.call(app_id, 'template', app_id, name, aps_dict)
+    return d.addCallback(registered)
+
+  def xmlrpc_notify_template(self, app_id, *args):
+    "See APNSServer.xmlrpc_notify_template"
+    return self.call(app_id, 'notify_template', app_id, *args)
+
+  def xmlrpc_broadcast(self, app_id, *args):
+    "See APNSServer.xmlrpc_broadcast"
+    return self.call(app_id, 'broadcast', app_id, *args)
+
+  def xmlrpc_feedback(self, app_id, compact=False, since=None):
+    "See APNSServer.xmlrpc_feedback"
+    def binary(r):
+      # the strings of compact feedback arrive as plain strings
+      feedback = r if since is None else r[1]
+      feedback[:] = [xmlrpc.Binary(s) for s in feedback]
+      return r
+    d = self.call(app_id, 'feedback', app_id, compact, since)
+    return d.addCallback(binary) if compact else d
+
+  def xmlrpc_register(self, app_id, *args):
+    "See APNSServer.xmlrpc_register"
+    return self.call(app_id, 'register', app_id, *args)
+
+  def xmlrpc_stats(self, app_id=None):
+    """ Returns the statistics of an app_id, or of every app_id provisioned
+    on the workers that could be reached when none is given
+    """
+    if app_id is not None:
+      return self.call(app_id, 'stats', app_id)
+    def merge(results):
+      stats = {}
+      for success, result in results:
+        if success:
+          stats.update(result)
+      return stats
+    return defer.DeferredList([client.request('stats', [])
+                               for client in self.clients],
+                              consumeErrors=True).addCallback(merge)
@@ -0,0 +1,131 @@
+import os
+import mmap
+import struct
+from twisted.python import log
+
+
+HEADER = struct.Struct('!8sQ') # magic, committed offset
+RECORD = struct.Struct('!BIII') # kind, identifier, frame count, length
+MAGIC = 'PYAPNSQ1'
+
+RAW, FRAMES = 0, 1
+
+
+class Spool(object):
+  """ An append-only file of messages waiting for a gateway connection.
+
+  Messages are appended as records after a header holding the offset up to
+  which they have been sent. `read` returns the next record through a memory
+  map and `commit` moves the sent offset forward, once everything is sent
+  the file is truncated. A spool never grows beyond `max_size` bytes and
+  picks up where it was after a restart, `identifier` is then the one
+  following the last spooled frames so they don't get reused.
+  """
+
+  def __init__(self, path, max_size=64*1024*1024):
+    self.path = path
+    self.max_size = max_size
+    self.map = None
+    self.identifier = 0
+    if os.path.exists(path):
+      self.file = open(path, 'r+b')
+      self._recover()
+    else:
+      self.file = open(path, 'w+b')
+      self._truncate()
+
+  def _recover(self):
+    magic, committed = HEADER.unpack(self.file.read(HEADER.size).ljust(
+      HEADER.size, '\0'))
+    if magic != MAGIC:
+      log.msg('Spool %s has no valid header, discarding it' % self.path)
+      return self._truncate()
+    # drop a record that was only partly written when the process died
+    self.file.seek(0, os.SEEK_END)
+    size, end = self.file.tell(), committed
+    while end + RECORD.size <= size:
+      self.file.seek(end)
+      kind, identifier, count, length = RECORD.unpack(
+        self.file.read(RECORD.size))
+      if end + RECORD.size + length > size:
+        break
+      end += RECORD.size + length
+      if kind == FRAMES:
+        self.identifier = (identifier + count) % 2**32
+    if end != size:
+      log.msg('Spool %s discarding %i bytes of an incomplete record' % (
+              self.path, size - end))
+      self.file.truncate(end)
+    self.committed = self.cursor = committed
+    self.end = end
+    if self.committed == self.end:
+      self._truncate()
+
+  def _truncate(self):
+    self._unmap()
+    self.file.seek(0)
+    self.file.truncate()
+    self.file.write(HEADER.pack(MAGIC, HEADER.size))
+    self.file.flush()
+    self.committed = self.cursor = self.end = HEADER.size
+
+  def _unmap(self):
+    if self.map is not None:
+      self.map.close()
+      self.map = None
+
+  def __len__(self):
+    "Bytes of messages that have not been read yet"
+    return self.end - self.cursor
+
+  def pending(self):
+    "Whether some messages have not been sent yet"
+    return self.end > self.committed
+
+  def append(self, data, kind=RAW, identifier=0, count=0):
+    "Appends a message, returns False if it would exceed max_size"
+    if self.end + RECORD.size + len(data) > self.max_size:
+      return False
+    if kind == FRAMES:
+      self.identifier = (identifier + count) % 2**32
+    self.file.seek(self.end)
+    self.file.write(RECORD.pack(kind, identifier, count, len(data)))
+    self.file.write(data)
+    self.file.flush()
+    self.end += RECORD.size + len(data)
+    return True
+
+  def read(self):
+    """ Returns the next unread message as (kind, identifier, data, offset),
+    where `offset` is to be committed once the message was sent, or None.
+    """
+    if self.cursor >= self.end:
+      return None
+    if self.map is None or len(self.map) < self.end:
+      self._unmap()
+      self.map = mmap.mmap(self.file.fileno(), self.end,
+                           access=mmap.ACCESS_READ)
+    kind, identifier, count, length = RECORD.unpack_from(self.map, self.cursor)
+    start = self.cursor + RECORD.size
+    self.cursor = start + length
+    return kind, identifier, self.map[start:self.cursor], self.cursor
+
+  def rewind(self, offset):
+    "Reads again from `offset`, the start of a message that wasn't sent"
+    self.cursor = max(self.committed, min(offset, self.cursor))
+
+  def commit(self, offset):
+    "Marks everything before `offset` as sent"
+    if offset <= self.committed:
+      return
+    self.committed = offset
+    if self.committed >= self.end:
+      self._truncate()
+    else:
+      self.file.seek(0)
+      self.file.write(HEADER.pack(MAGIC, self.committed))
+      self.file.flush()
+
+  def close(self):
+    self._unmap()
+    self.file.close()
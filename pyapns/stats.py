@@ -0,0 +1,88 @@
+import bisect
+import collections
+from twisted.web import resource
+
+
+# upper bounds in seconds, the last bucket catches everything above
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5,
+                   10, 30)
+
+
+class Histogram(object):
+  def __init__(self, buckets=LATENCY_BUCKETS):
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1)
+    self.count = 0
+    self.sum = 0.0
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.count += 1
+    self.sum += value
+
+  def snapshot(self):
+    "Bucket counts are cumulative, of the values less or equal to the bound"
+    buckets, total = [], 0
+    for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+      total += count
+      buckets.append([str(bound), total])
+    return {'count': self.count, 'sum': self.sum, 'buckets': buckets}
+
+
+class Stats(object):
+  """ Counters and latency histograms of one app_id """
+
+  def __init__(self):
+    self.counters = collections.defaultdict(int)
+    self.histograms = collections.defaultdict(Histogram)
+
+  def incr(self, name, n=1):
+    self.counters[name] += n
+
+  def observe(self, name, value):
+    self.histograms[name].observe(value)
+
+  def snapshot(self):
+    snapshot = dict(self.counters)
+    for name, histogram in self.histograms.iteritems():
+      snapshot[name] = histogram.snapshot()
+    return snapshot
+
+
+def xmlrpc_safe(value):
+  "XML-RPC integers are 32 bit, larger counters are returned as floats"
+  if isinstance(value, dict):
+    return dict((k, xmlrpc_safe(v)) for k, v in value.iteritems())
+  if isinstance(value, list):
+    return [xmlrpc_safe(v) for v in value]
+  if isinstance(value, (int, long)) and not -2**31 <= value < 2**31:
+    return float(value)
+  return value
+
+
+class StatsResource(resource.Resource):
+  """ Renders the statistics of every provisioned app_id as plain text, one
+  `name{app_id="..."} value` line per counter and histogram bucket.
+  """
+
+  isLeaf = True
+
+  def __init__(self, app_ids):
+    resource.Resource.__init__(self)
+    self.app_ids = app_ids
+
+  def render_GET(self, request):
+    request.setHeader('content-type', 'text/plain; charset=utf-8')
+    lines = []
+    for app_id, service in sorted(self.app_ids.items()):
+      label = 'app_id="%s"' % app_id.replace('\\', '\\\\').replace('"', '\\"')
+      for name, value in sorted(service.statistics().items()):
+        if isinstance(value, dict):
+          for bound, count in value['buckets']:
+            lines.append('pyapns_%s_bucket{%s,le="%s"} %s' % (
+                         name, label, bound, count))
+          lines.append('pyapns_%s_count{%s} %s' % (name, label, value['count']))
+          lines.append('pyapns_%s_sum{%s} %r' % (name, label, value['sum']))
+        else:
+          lines.append('pyapns_%s{%s} %s' % (name, label, value))
+    return '\n'.join(lines).encode('utf-8') + '\n'
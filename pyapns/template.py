@@ -0,0 +1,104 @@
+""" Notification payloads serialized once with placeholders, rendered per
+token by splicing the serialized values between the fragments.
+
+A placeholder is ${name} in a string of the notification, keys can't hold
+one. A string that is only a placeholder is replaced by the value as JSON,
+of any type:
+
+    {"aps": {"alert": "Hello ${name}", "badge": "${badge}"}}
+
+rendered with {"name": "Ann", "badge": 3} gives
+
+    {"aps":{"alert":"Hello Ann","badge":3}}
+"""
+
+import re
+import uuid
+import _json as json
+
+PLACEHOLDER = re.compile(r'\$\{(\w+)\}')
+ESCAPED = re.compile(r'[\x00-\x1f"\\\x7f-\xff]') # or not ASCII
+
+
+class Payload(str):
+  "The serialized JSON of a notification, sent as it is"
+  __slots__ = ()
+
+
+class Template(object):
+  """ A notification serialized once, `notification` being a dict with
+  placeholders. Raises ValueError when it isn't a dict or a key of it holds
+  a placeholder.
+  """
+
+  def __init__(self, notification):
+    if not isinstance(notification, dict):
+      raise ValueError('A template must be a dictionary')
+    # placeholders are found in the strings and stand in the serialized
+    # JSON as markers, which it has nothing else like
+    marker = 'T' + uuid.uuid4().hex
+    found = [] # (name, whether it is the whole string)
+    def mark(match):
+      found.append((match.group(1), False))
+      return '%sE%i%s' % (marker, len(found) - 1, marker)
+    def walk(value):
+      if isinstance(value, dict):
+        for key in value:
+          if isinstance(key, basestring) and PLACEHOLDER.search(key):
+            raise ValueError('A key can not hold a placeholder: %s' % key)
+        return dict((key, walk(v)) for key, v in value.iteritems())
+      if isinstance(value, (list, tuple)):
+        return [walk(v) for v in value]
+      if isinstance(value, basestring):
+        match = PLACEHOLDER.match(value)
+        if match and match.end() == len(value):
+          found.append((match.group(1), True))
+          return '%sW%i%s' % (marker, len(found) - 1, marker)
+        return PLACEHOLDER.sub(mark, value)
+      return value
+    serialized = json.compact_dumps(walk(notification))
+    self.fragments = [] # serialized JSON between the placeholders
+    self.names = [] # of the placeholders
+    self.whole = [] # whether a placeholder is the whole string
+    pos = 0
+    for match in re.finditer('"%sW(\\d+)%s"|%sE(\\d+)%s' % ((marker,) * 4),
+                             serialized):
+      name, whole = found[int(match.group(1) or match.group(2))]
+      self.fragments.append(serialized[pos:match.start()].encode('utf-8'))
+      self.names.append(name)
+      self.whole.append(whole)
+      pos = match.end()
+    self.fragments.append(serialized[pos:].encode('utf-8'))
+    self.order = sorted(set(self.names)) # of the values given as a list
+    self.positions = [self.order.index(name) for name in self.names]
+
+  def render(self, values):
+    """ Returns the Payload with `values` in place of the placeholders, a
+    dict keyed by their names or a list in the alphabetical order of the
+    names (`order`). Raises KeyError or IndexError for a missing value.
+    """
+    dumps = json.compact_dumps
+    if isinstance(values, (list, tuple)):
+      keys = self.positions
+    else:
+      keys = self.names
+    fragments, whole = self.fragments, self.whole
+    parts = [fragments[0]]
+    for n in xrange(len(keys)):
+      value = values[keys[n]]
+      kind = type(value)
+      if kind is int or kind is long:
+        value = str(value)
+      elif kind is str and not ESCAPED.search(value):
+        value = '"%s"' % value if whole[n] else value
+      elif whole[n]:
+        value = dumps(value)
+      else:
+        if not isinstance(value, basestring):
+          value = dumps(value) # numbers as in JSON
+        if isinstance(value, str):
+          value = value.decode('utf-8')
+        value = dumps(value)[1:-1] # escaped, without the quotes
+      parts.append(value if type(value) is str else value.encode('utf-8'))
+      parts.append(fragments[n + 1])
+    return Payload(''.join(parts))
@@ -0,0 +1,248 @@
+""" A non-blocking client for Twisted programs. The functions take the same
+arguments as those of pyapns.client, without async/callback/errback, and
+return Deferreds firing with the result:
+
+    from twisted.internet import defer
+    from pyapns import txclient
+
+    @defer.inlineCallbacks
+    def send():
+      txclient.configure({'HOST': 'tcp://localhost:7078/'})
+      yield txclient.provision('myapp', cert, 'sandbox')
+      rejected = yield txclient.notify('myapp', tokens, notifications)
+
+Configuration is shared with pyapns.client. With a tcp:// or unix:// `HOST`
+requests go over the compact ingestion listener, pipelined on a pool of at
+most `CONNECTIONS` connections; with an http:// one each request is an
+XML-RPC call. At most `CONCURRENCY` requests are in flight at a time, the
+others wait their turn. Requests failing with an unknown app_id reprovision
+`INITIAL` and are retried once, like with pyapns.client.
+"""
+
+import itertools
+import xmlrpclib
+from twisted.internet import reactor, defer, endpoints
+from twisted.internet.protocol import Factory
+from twisted.protocols.basic import Int32StringReceiver
+from twisted.web import xmlrpc
+from client import OPTIONS, UnknownAppID, APNSNotConfigured, configure
+import wire
+
+
+class IngestClientProtocol(Int32StringReceiver):
+  """ One connection to the compact ingestion listener, requests are sent
+  without waiting for the responses to the previous ones.
+  """
+  MAX_LENGTH = wire.MAX_LENGTH
+
+  def connectionMade(self):
+    self.pending = {} # {id: (Deferred, timeout DelayedCall)}
+    self.ids = itertools.count(1)
+
+  def call(self, method, params, timeout):
+    id = self.ids.next() % 2**32
+    body = None
+    if method in ('notify', 'broadcast') and 3 <= len(params) <= 4:
+      body = wire.binary_request(id, method, *params)
+    if body is None:
+      body = wire.json_request(id, method, params)
+    d = defer.Deferred()
+    self.pending[id] = d, timeout and reactor.callLater(timeout,
+                                                        self.timedOut, id)
+    self.sendString(body)
+    return d
+
+  def timedOut(self, id):
+    d, _ = self.pending.pop(id)
+    d.errback(defer.TimeoutError('No response from the pyapns daemon'))
+
+  def stringReceived(self, body):
+    id, result, error = wire.parse_response(body)
+    if id not in self.pending:
+      return # timed out already
+    d, timeout = self.pending.pop(id)
+    if timeout:
+      timeout.cancel()
+    if error:
+      d.errback(xmlrpclib.Fault(*error))
+    else:
+      d.callback(result)
+
+  def connectionLost(self, reason):
+    self.factory.lost(self)
+    pending, self.pending = self.pending, {}
+    for d, timeout in pending.itervalues():
+      if timeout:
+        timeout.cancel()
+      d.errback(reason)
+
+
+class IngestClientFactory(Factory):
+  protocol = IngestClientProtocol
+
+  def __init__(self, pool):
+    self.pool = pool
+
+  def lost(self, protocol):
+    self.pool.lost(protocol)
+
+
+class Client(object):
+  """ Calls the pyapns daemon at `host` (see the module documentation) with
+  at most `concurrency` requests in flight on at most `connections`
+  connections. `timeout` is in seconds for connecting and for each response,
+  with None responses are waited for as long as they take. `initial` is a
+  list of provision arguments to reprovision with when the daemon doesn't
+  know an app_id.
+  """
+
+  def __init__(self, host, connections=4, concurrency=100, timeout=20,
+               initial=None):
+    self.host = host
+    self.connections = connections
+    self.timeout = timeout
+    self.initial = initial
+    self.semaphore = defer.DeferredSemaphore(concurrency)
+    self.protocols = []
+    self.connecting = 0
+    self.waiting = [] # Deferreds for a connection
+    self.factory = IngestClientFactory(self)
+    self.proxy = None
+    if not host.startswith(('tcp://', 'unix://')):
+      self.proxy = xmlrpc.Proxy(host, allowNone=True, useDateTime=True,
+                                connectTimeout=timeout or 30)
+
+  def endpoint(self):
+    scheme, _, address = self.host.partition('://')
+    if scheme == 'unix':
+      return endpoints.UNIXClientEndpoint(reactor, address,
+                                          timeout=self.timeout or 30)
+    host, port = address.strip('/').rsplit(':', 1)
+    return endpoints.TCP4ClientEndpoint(reactor, host, int(port),
+                                        timeout=self.timeout or 30)
+
+  def protocol(self):
+    "Returns a Deferred firing with the least loaded connection"
+    if self.protocols:
+      best = min(self.protocols, key=lambda p: len(p.pending))
+      if not best.pending or len(self.protocols) + self.connecting >= \
+          self.connections:
+        return defer.succeed(best)
+    elif self.connecting:
+      d = defer.Deferred()
+      self.waiting.append(d)
+      return d
+    self.connecting += 1
+    def connected(protocol):
+      self.connecting -= 1
+      self.protocols.append(protocol)
+      waiting, self.waiting = self.waiting, []
+      for d in waiting:
+        d.callback(protocol)
+      return protocol
+    def failed(f):
+      self.connecting -= 1
+      waiting, self.waiting = self.waiting, []
+      for d in waiting:
+        d.errback(f)
+      return f
+    return self.endpoint().connect(self.factory).addCallbacks(connected,
+                                                               failed)
+
+  def lost(self, protocol):
+    if protocol in self.protocols:
+      self.protocols.remove(protocol)
+
+  def call(self, method, *params):
+    "Returns a Deferred firing with the result of an XML-RPC method"
+    def retry(f):
+      if f.check(UnknownAppID) and self.initial:
+        d = defer.gatherResults([self.request('provision', args)
+                                 for args in self.initial],
+                                consumeErrors=True)
+        return d.addCallback(lambda _: self.request(method, params))
+      return f
+    return self.request(method, params).addErrback(retry)
+
+  def request(self, method, params):
+    d = self.semaphore.run(self.send, method, params)
+    return d.addErrback(self.failed)
+
+  def send(self, method, params):
+    if self.proxy is not None:
+      return self.proxy.callRemote(method, *params)
+    return self.protocol().addCallback(
+      lambda protocol: protocol.call(method, params, self.timeout))
+
+  def failed(self, f):
+    if f.check(xmlrpclib.Fault) and f.value.faultCode == 404:
+      raise UnknownAppID()
+    return f
+
+  def close(self):
+    "Closes the connections to the daemon"
+    for protocol in self.protocols:
+      protocol.transport.loseConnection()
+
+
+_clients = {}
+
+def _client():
+  "Returns the Client for the configured HOST"
+  if not configure({}):
+    raise APNSNotConfigured('APNS Has not been configured.')
+  key = (OPTIONS['HOST'], OPTIONS['TIMEOUT'])
+  if key not in _clients:
+    _clients[key] = Client(OPTIONS['HOST'], OPTIONS.get('CONNECTIONS', 4),
+                           OPTIONS.get('CONCURRENCY', 100),
+                           OPTIONS['TIMEOUT'], OPTIONS.get('INITIAL'))
+  return _clients[key]
+
+def _call(method, *params):
+  return defer.maybeDeferred(lambda: _client().call(method, *params))
+
+def provision(app_id, path_to_cert, environment, timeout=15, connections=1,
+              http2=None):
+  args = [app_id, path_to_cert, environment, timeout]
+  if connections != 1 or http2:
+    args.append(connections)
+  if http2:
+    args.append(http2)
+  return _call('provision', *args)
+
+def notify(app_id, tokens, notifications, expiry=None, bulk=False):
+  args = [app_id, tokens, notifications]
+  if expiry is not None or bulk:
+    args.append(expiry or 0)
+  if bulk:
+    args.append(True)
+  return _call('notify', *args)
+
+def template(app_id, name, notification):
+  return _call('template', app_id, name, notification)
+
+def notify_template(app_id, name, tokens, values, expiry=None, bulk=False):
+  args = [app_id, name, tokens, values]
+  if expiry is not None or bulk:
+    args.append(expiry or 0)
+  if bulk:
+    args.append(True)
+  return _call('notify_template', *args)
+
+def broadcast(app_id, tokens, notification, expiry=None):
+  args = [app_id, tokens, notification]
+  if expiry is not None:
+    args.append(expiry)
+  return _call('broadcast', *args)
+
+def feedback(app_id, since=None):
+  args = [app_id]
+  if since is not None:
+    args.extend([False, since])
+  return _call('feedback', *args)
+
+def register(app_id, tokens, registered=None):
+  args = [app_id, tokens]
+  if registered is not None:
+    args.append(registered)
+  return _call('register', *args)
@@ -0,0 +1,116 @@
+""" Messages of the compact ingestion protocol, shared by the pyapns.ingest
+listener and the client.
+
+Every message is a 4 byte big endian length followed by the message body.
+Requests start with one byte giving their kind:
+
+  J   a JSON object {"id": int, "method": str, "params": list} calling any
+      of the XML-RPC methods with the same arguments
+  N   a notify with binary tokens
+  B   a broadcast with binary tokens
+
+The binary kinds continue with the request id (4 bytes), the length of the
+app_id (2 bytes), the app_id, the expiry (4 bytes), the number of tokens
+(4 bytes) and the 32 byte tokens, followed by the JSON list of notifications
+(N) or the JSON notification (B).
+
+Responses are JSON objects {"id": int, "result": ...} or
+{"id": int, "error": {"code": int, "message": str}}. In requests and
+responses datetimes are encoded as {"$datetime": unix_time} and binary
+strings as {"$binary": base64}.
+"""
+
+import struct
+import binascii
+import datetime
+import time
+import _json as json
+
+LENGTH = struct.Struct('!I')
+MAX_LENGTH = 64*1024*1024
+
+JSON_REQUEST = 'J'
+NOTIFY_REQUEST = 'N'
+BROADCAST_REQUEST = 'B'
+BINARY_METHODS = {NOTIFY_REQUEST: 'notify', BROADCAST_REQUEST: 'broadcast'}
+
+BINARY_HEADER = struct.Struct('!cIH') # kind, id, app_id length
+BINARY_TOKENS = struct.Struct('!II') # expiry, token count
+
+
+def pack(body):
+  "Returns the length prefixed message"
+  return LENGTH.pack(len(body)) + body
+
+def json_request(id, method, params):
+  return JSON_REQUEST + json.dumps({'id': id, 'method': method,
+                                    'params': list(params)}, default=_default)
+
+def binary_request(id, method, app_id, tokens, notifications, expiry=0):
+  """ Returns a notify or broadcast request with tokens in binary, or None
+  when the tokens are not all 64 character hex strings.
+  """
+  if type(tokens) in (str, unicode):
+    tokens, notifications = [tokens], [notifications]
+  joined = ''.join(tokens)
+  if len(joined) != 64 * len(tokens) or len(set(map(len, tokens))) > 1:
+    return None
+  try:
+    raw = binascii.unhexlify(joined)
+  except (TypeError, ValueError, binascii.Error):
+    return None
+  kind = NOTIFY_REQUEST if method == 'notify' else BROADCAST_REQUEST
+  app_id = app_id.encode('utf-8')
+  return ''.join([BINARY_HEADER.pack(kind, id, len(app_id)), app_id,
+                  BINARY_TOKENS.pack(expiry or 0, len(tokens)), raw,
+                  json.dumps(notifications, separators=(',',':'),
+                             default=_default)])
+
+def parse_request(body):
+  "Returns the (id, method, params) of a request body"
+  kind = body[:1]
+  if kind == JSON_REQUEST:
+    request = json.loads(body[1:], object_hook=_object_hook)
+    return request['id'], request['method'], request.get('params', [])
+  if kind not in BINARY_METHODS:
+    raise ValueError('Unknown request kind %r' % kind)
+  kind, id, app_id_length = BINARY_HEADER.unpack_from(body)
+  offset = BINARY_HEADER.size
+  app_id = body[offset:offset + app_id_length].decode('utf-8')
+  offset += app_id_length
+  expiry, count = BINARY_TOKENS.unpack_from(body, offset)
+  offset += BINARY_TOKENS.size
+  hexed = binascii.hexlify(body[offset:offset + 32 * count])
+  tokens = [hexed[i:i + 64] for i in xrange(0, len(hexed), 64)]
+  notifications = json.loads(body[offset + 32 * count:],
+                             object_hook=_object_hook)
+  return id, BINARY_METHODS[kind], [app_id, tokens, notifications, expiry]
+
+def _default(obj):
+  if isinstance(obj, datetime.datetime):
+    return {'$datetime': time.mktime(obj.timetuple())}
+  if hasattr(obj, 'data'): # xmlrpclib.Binary
+    return {'$binary': binascii.b2a_base64(obj.data).strip()}
+  raise TypeError('%r is not JSON serializable' % (obj,))
+
+def _object_hook(obj):
+  if '$datetime' in obj:
+    return datetime.datetime.fromtimestamp(obj['$datetime'])
+  if '$binary' in obj:
+    return binascii.a2b_base64(obj['$binary'])
+  return obj
+
+def response(id, result=None, error=None):
+  message = {'id': id}
+  if error is not None:
+    message['error'] = {'code': error[0], 'message': error[1]}
+  else:
+    message['result'] = result
+  return json.dumps(message, default=_default)
+
+def parse_response(body):
+  "Returns the (id, result, error) of a response, error as (code, message)"
+  message = json.loads(body, object_hook=_object_hook)
+  error = message.get('error')
+  return (message['id'], message.get('result'),
+          error and (error['code'], error['message']))
@@ -60,5 +60,6 @@ setup(
     'Topic :: Software Development :: Libraries :: Python Modules'],
   packages=['pyapns'],
   package_data={},
-  install_requires=['Twisted>=8.2.0', 'pyOpenSSL>=0.10']
+  install_requires=['Twisted>=8.2.0', 'pyOpenSSL>=0.10'],
+  extras_require={'http2': ['h2>=3.0', 'cryptography>=2.0']}
 )
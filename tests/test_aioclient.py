@@ -0,0 +1,108 @@
+import sys
+import json
+import struct
+import unittest
+if sys.version_info >= (3,):
+  import asyncio
+  from pyapns import aioclient
+
+LENGTH = struct.Struct('!I')
+
+
+class FakeDaemon(object):
+  "Answers JSON requests of the compact ingestion protocol after `delay`"
+
+  def __init__(self, delay=0.01):
+    self.delay = delay
+    self.provisioned = set()
+    self.calls = []
+    self.outstanding = self.most = 0
+    self.connections = 0
+
+  def protocol(self):
+    daemon = self
+    class Protocol(asyncio.Protocol):
+      buffer = b''
+      def connection_made(self, transport):
+        daemon.connections += 1
+        self.transport = transport
+      def data_received(self, data):
+        self.buffer += data
+        while len(self.buffer) >= 4:
+          length, = LENGTH.unpack(self.buffer[:4])
+          if len(self.buffer) < 4 + length:
+            return
+          body, self.buffer = self.buffer[5:4 + length], self.buffer[4 + length:]
+          daemon.outstanding += 1
+          daemon.most = max(daemon.most, daemon.outstanding)
+          asyncio.get_event_loop().call_later(daemon.delay, self.answer,
+                                              json.loads(body))
+      def answer(self, request):
+        daemon.outstanding -= 1
+        daemon.calls.append((request['method'], request['params']))
+        response = daemon.answer(request['method'], request['params'])
+        response['id'] = request['id']
+        body = json.dumps(response).encode('utf-8')
+        self.transport.write(LENGTH.pack(len(body)) + body)
+    return Protocol()
+
+  def answer(self, method, params):
+    if method == 'provision':
+      self.provisioned.add(params[0])
+      return {'result': None}
+    if params[0] not in self.provisioned:
+      return {'error': {'code': 404, 'message': 'not provisioned'}}
+    if method == 'feedback':
+      return {'result': [[{'$datetime': 0}, 'ab' * 32]]}
+    return {'result': None}
+
+
+@unittest.skipIf(sys.version_info < (3,), 'pyapns.aioclient needs Python 3')
+class AIOClientTestCase(unittest.TestCase):
+  def setUp(self):
+    self.loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(self.loop)
+    self.daemon = FakeDaemon()
+    self.server = self.loop.run_until_complete(self.loop.create_server(
+      self.daemon.protocol, '127.0.0.1', 0))
+    port = self.server.sockets[0].getsockname()[1]
+    self.host = 'tcp://127.0.0.1:%i/' % port
+
+  def tearDown(self):
+    self.server.close()
+    self.loop.run_until_complete(self.server.wait_closed())
+    self.loop.close()
+    asyncio.set_event_loop(None)
+
+  def run_client(self, client, *calls):
+    try:
+      return self.loop.run_until_complete(asyncio.gather(
+        *[client.call(*call) for call in calls]))
+    finally:
+      client.close()
+      self.loop.run_until_complete(asyncio.sleep(0))
+
+  def test_pipelined_and_bounded(self):
+    self.daemon.provisioned.add('a')
+    client = aioclient.Client(self.host, connections=2, concurrency=10)
+    results = self.run_client(
+      client, *[('notify', 'a', 'ab' * 32, {'aps': {}})] * 50)
+    self.assertEqual(results, [None] * 50)
+    self.assertEqual(self.daemon.most, 10)
+    self.assertEqual(self.daemon.connections, 2)
+
+  def test_reprovision(self):
+    client = aioclient.Client(self.host, initial=[('a', 'cert', 'sandbox')])
+    feedback, = self.run_client(client, ('feedback', 'a'))
+    self.assertEqual([method for method, params in self.daemon.calls],
+                     ['feedback', 'provision', 'feedback'])
+    self.assertEqual(feedback[0][1], 'ab' * 32)
+
+  def test_unknown_app_id(self):
+    client = aioclient.Client(self.host)
+    self.assertRaises(aioclient.UnknownAppID, self.run_client, client,
+                      ('notify', 'a', 'ab' * 32, {'aps': {}}))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,117 @@
+import threading
+import xmlrpclib
+from twisted.trial import unittest
+from pyapns import client
+
+
+class Proxy(object):
+  """ Stands in for the daemon, which doesn't know app_ids until 
+  provisioned and answers the first notify call of `unknown` threads as if
+  restarted
+  """
+
+  def __init__(self, daemon):
+    self.daemon = daemon
+
+  def provision(self, app_id, *args):
+    with self.daemon.lock:
+      self.daemon.provisioned.add(app_id)
+
+  def notify(self, app_id, tokens, notifications, *args):
+    self.daemon.calls.wait(1) # until the queue filled up
+    with self.daemon.lock:
+      thread = threading.current_thread()
+      if self.daemon.unknown and thread not in self.daemon.failed:
+        self.daemon.unknown -= 1
+        self.daemon.failed.add(thread)
+        raise xmlrpclib.Fault(404, 'not provisioned')
+      if app_id not in self.daemon.provisioned:
+        raise xmlrpclib.Fault(404, 'not provisioned')
+
+
+class Daemon(object):
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.provisioned = set()
+    self.calls = threading.Event()
+    self.unknown = 0
+    self.failed = set()
+
+
+class AsyncReprovisionTestCase(unittest.TestCase):
+  def setUp(self):
+    self.options = dict(client.OPTIONS)
+    self.pool = dict(client._pool)
+    self.server_proxy = client._server_proxy
+    client.OPTIONS.update({'CONFIGURED': True, 'HOST': 'http://localhost/',
+                           'WORKERS': 2, 'QUEUE_SIZE': 2,
+                           'INITIAL': [('app', 'cert.pem', 'sandbox')]})
+    client._pool.update({'queue': None, 'workers': []})
+    daemon = self.daemon = Daemon()
+    client._server_proxy = lambda: Proxy(daemon)
+
+  def tearDown(self):
+    client.OPTIONS.clear()
+    client.OPTIONS.update(self.options)
+    client._pool.update(self.pool)
+    client._server_proxy = self.server_proxy
+
+  def test_retry_with_full_queue(self):
+    self.daemon.unknown = 2 # both workers
+    done = []
+    lock = threading.Lock()
+    def callback(r):
+      with lock:
+        done.append(r)
+    def produce():
+      for n in xrange(8):
+        client.notify('app', 'ab' * 32, {'aps': {}}, async=True,
+                      callback=callback, errback=callback)
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    while client._pool['queue'] is None or not client._pool['queue'].full():
+      producer.join(0.01)
+    self.daemon.calls.set()
+    producer.join(5)
+    self.assertFalse(producer.is_alive())
+    client._pool['queue'].join()
+    self.assertEqual(done, [None] * 8)
+
+  def test_retry_once(self):
+    client.OPTIONS['INITIAL'] = [('other', 'cert.pem', 'sandbox')]
+    self.daemon.calls.set()
+    self.assertRaises(client.UnknownAppID, client.notify, 'app', 'ab' * 32,
+                      {'aps': {}})
+
+
+class BatcherTestCase(unittest.TestCase):
+  def setUp(self):
+    self.sent = []
+    self.notify = client.notify
+    def notify(app_id, tokens, notifications, callback, errback, expiry):
+      self.sent.append((tokens, notifications))
+      callback([[1, 'Invalid token']])
+    client.notify = notify
+    self.batcher = client.Batcher(interval=60)
+
+  def tearDown(self):
+    self.batcher.close()
+    client.notify = self.notify
+
+  def test_one_notification_for_tokens(self):
+    first = self.batcher.notify('app', ['a', 'b'], {'aps': {}})
+    second = self.batcher.notify('app', 'c', {'aps': {'badge': 1}})
+    self.batcher.flush()
+    self.assertEqual(self.sent, [(['a', 'b', 'c'], [{'aps': {}}] * 2 +
+                                                   [{'aps': {'badge': 1}}])])
+    self.assertEqual(first.wait(1), [[1, 'Invalid token']])
+    self.assertEqual(second.wait(1), None)
+
+  def test_lengths_differ(self):
+    first = self.batcher.notify('app', ['a', 'b'], [{'n': 1}])
+    second = self.batcher.notify('app', ['c'], [{'n': 2}, {'n': 3}])
+    self.batcher.flush()
+    self.assertEqual(self.sent, [(['a', 'c'], [{'n': 1}, {'n': 2}])])
+    self.assertEqual(first.wait(1), None)
+    self.assertEqual(second.wait(1), [[0, 'Invalid token']])
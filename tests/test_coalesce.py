@@ -0,0 +1,44 @@
+from twisted.trial import unittest
+from pyapns.coalesce import Coalescer
+from pyapns.stats import Stats
+
+TOKEN = 'ab' * 32
+
+
+class Service(object):
+  def __init__(self):
+    self.stats = Stats()
+    self.coalescing = None
+
+
+class CoalescerTestCase(unittest.TestCase):
+  def setUp(self):
+    self.sent = []
+    self.coalescer = Coalescer(lambda *args: self.sent.append(args), 10)
+    self.service = Service()
+
+  def tearDown(self):
+    self.coalescer.flushAll()
+
+  def test_collapse_key_not_sent(self):
+    tokens, notifications, indexes = self.coalescer.hold(
+      'app', self.service, [TOKEN, TOKEN, TOKEN],
+      [{'aps': {'badge': 1}, 'collapse_id': 'badge'},
+       {'aps': {'badge': 2}, 'collapse_id': 'badge'},
+       {'aps': {'alert': 'hi'}}])
+    self.assertEqual((tokens, notifications, indexes),
+                     ([TOKEN], [{'aps': {'alert': 'hi'}}], [2]))
+    self.coalescer.flush('app')
+    self.assertEqual(self.sent, [('app', [TOKEN], [{'aps': {'badge': 2}}],
+                                  0, 0)])
+
+  def test_collapse_key_not_sent_without_window(self):
+    self.coalescer.configure('app', 0)
+    notification = {'aps': {'badge': 1}, 'collapse_id': 'badge'}
+    self.assertEqual(
+      self.coalescer.hold('app', self.service, TOKEN, notification),
+      (TOKEN, {'aps': {'badge': 1}}, None))
+    self.assertEqual(
+      self.coalescer.hold('app', self.service, [TOKEN], [notification]),
+      ([TOKEN], [{'aps': {'badge': 1}}], None))
+    self.assertEqual(notification['collapse_id'], 'badge')
@@ -0,0 +1,27 @@
+from twisted.trial import unittest
+from twisted.web import xmlrpc
+from pyapns import server
+
+
+class PayloadSizeTestCase(unittest.TestCase):
+  notification = {'aps': {'alert': 'x' * 1000}}
+
+  def test_binary_formats(self):
+    for command in (0, 1, 2):
+      rejected = []
+      frames = server.encode_frames(['ab' * 32], [self.notification], 1,
+                                    command=command, rejected=rejected)
+      self.assertEqual((len(frames), rejected), (1, []))
+
+  def test_max_payload(self):
+    rejected = []
+    server.encode_frames(['ab' * 32], [self.notification], 1, max_payload=256,
+                         rejected=rejected)
+    self.assertEqual([index for index, _ in rejected], [0])
+
+
+class BroadcastTestCase(unittest.TestCase):
+  def test_not_a_dict(self):
+    e = self.assertRaises(xmlrpc.Fault, server.APNSServer().xmlrpc_broadcast,
+                          'app', ['ab' * 32], ['not', 'a', 'dict'])
+    self.assertEqual(e.faultCode, 400)
@@ -0,0 +1,82 @@
+from twisted.trial import unittest
+from twisted.internet import defer
+from pyapns import server
+
+
+def records(start, count):
+  return ''.join(server.FEEDBACK_RECORD.pack(n, 32, ('%032i' % n))
+                 for n in xrange(start, start + count))
+
+
+class FeedbackCacheTestCase(unittest.TestCase):
+  def test_since(self):
+    cache = server.FeedbackCache(10)
+    cache.extend(records(0, 4))
+    self.assertEqual(cache.since(0), (records(0, 4), 4, 0))
+    self.assertEqual(cache.since(3), (records(3, 1), 4, 0))
+    self.assertEqual(cache.since(4), ('', 4, 0))
+
+  def test_invalid_cursor(self):
+    cache = server.FeedbackCache(10)
+    cache.extend(records(0, 4))
+    self.assertEqual(cache.since(7), (records(0, 4), 4, 0))
+
+  def test_lost(self):
+    cache = server.FeedbackCache(10)
+    cache.extend(records(0, 15))
+    self.assertEqual(cache.since(2), (records(5, 10), 15, 3))
+
+  def test_recent(self):
+    cache = server.FeedbackCache(10)
+    cache.extend(records(0, 3))
+    cache.extend(records(3, 12))
+    cache.extend(records(15, 2))
+    self.assertEqual(cache.since(2, (3, records(3, 12))),
+                     (records(3, 14), 17, 1))
+    self.assertEqual(cache.since(5, (3, records(3, 12))),
+                     (records(5, 12), 17, 0))
+
+
+class FeedbackServerTestCase(unittest.TestCase):
+  """ On demand reads return every record read, whatever the cache holds """
+
+  def setUp(self):
+    self.service = server.APNSService('cert.pem', 'sandbox')
+    self.service.feedback = server.FeedbackCache(100)
+    self.server = server.APNSServer()
+    self.server.app_ids = {'app': self.service}
+    self.server.max_connections = 0
+    self.service.factories = [None]
+
+  def read(self, count):
+    def read(receiver):
+      for start in xrange(0, count, 30):
+        receiver(records(start, min(30, count - start)))
+      return defer.succeed(None)
+    self.service.read = read
+
+  def test_read_on_demand(self):
+    self.read(250)
+    d = self.server.xmlrpc_feedback('app', True)
+    timestamps, tokens = self.successResultOf(d)
+    self.assertEqual(len(tokens.data), 250 * 32)
+    self.assertEqual(self.service.stats.snapshot().get('feedback_lost'), None)
+    self.read(0)
+    timestamps, tokens = self.successResultOf(
+      self.server.xmlrpc_feedback('app', True))
+    self.assertEqual(tokens.data, '')
+
+  def test_since_on_demand(self):
+    self.read(250)
+    cursor, feedback = self.successResultOf(
+      self.server.xmlrpc_feedback('app', False, 0))
+    self.assertEqual(cursor, 250)
+    self.assertEqual(len(feedback), 250)
+
+  def test_lost_in_background(self):
+    self.service.poller = object()
+    self.service.feedback.extend(records(0, 150))
+    cursor, feedback = self.successResultOf(
+      self.server.xmlrpc_feedback('app', False, 0))
+    self.assertEqual((cursor, len(feedback)), (150, 100))
+    self.assertEqual(self.service.stats.snapshot()['feedback_lost'], 50)
@@ -0,0 +1,148 @@
+import binascii
+from twisted.trial import unittest
+from twisted.internet import reactor, defer, task
+from pyapns import server, fake
+from pyapns.deadtokens import DeadTokens
+try:
+  from pyapns import http2
+except ImportError:
+  http2 = None
+
+LIVE, DEAD, UNREGISTERED = 'ab' * 32, 'cd' * 32, 'ef' * 32
+
+
+class HTTP2ServiceTestCase(unittest.TestCase):
+  if http2 is None or http2.H2Connection is None:
+    skip = 'The HTTP/2 backend needs the h2 and cryptography packages'
+
+  def setUp(self):
+    dead_tokens = DeadTokens()
+    dead_tokens.add(binascii.unhexlify(DEAD), 0)
+    self.service = http2.HTTP2Service('cert.pem', 'sandbox',
+                                      dead_tokens=dead_tokens)
+
+  def test_dead_tokens_skipped(self):
+    rejected = []
+    requests = self.service.encode([LIVE, DEAD, DEAD, 'nope'],
+                                   {'aps': {'alert': 'hi'}}, 0, rejected)
+    self.assertEqual(len(requests), 1)
+    self.assertEqual([n for n, reason in rejected], [3])
+    self.assertEqual(self.service.stats.snapshot()['dead_tokens_skipped'], 2)
+
+
+class Connection(object):
+  queued = 0
+
+  def __init__(self):
+    self.items = []
+
+  def sendItems(self, items):
+    self.items.extend(items)
+
+
+class Factory(object):
+  def __init__(self):
+    self.clientProtocol = Connection()
+
+
+class HTTP2TimeoutTestCase(unittest.TestCase):
+  if http2 is None or http2.H2Connection is None:
+    skip = 'The HTTP/2 backend needs the h2 and cryptography packages'
+
+  def setUp(self):
+    self.service = http2.HTTP2Service('cert.pem', 'sandbox', timeout=0.1)
+    self.factory = Factory()
+    self.service.factories = [self.factory]
+
+  def test_no_response(self):
+    requests = self.service.encode([LIVE, LIVE], {'aps': {'alert': 'hi'}})
+    d = self.service.write(requests)
+    self.assertEqual(len(self.factory.clientProtocol.items), 2)
+    d = self.assertFailure(d, defer.TimeoutError)
+    return d.addCallback(lambda _: self.assertEqual(
+      self.service.stats.snapshot()['response_timeouts'], 1))
+
+  def test_responses_keep_it_waiting(self):
+    requests = self.service.encode([LIVE, LIVE], {'aps': {'alert': 'hi'}})
+    d = self.service.write(requests)
+    task.deferLater(reactor, 0.07, requests.done, 0)
+    task.deferLater(reactor, 0.14, requests.done, 1, 'BadDeviceToken')
+    return d.addCallback(self.assertEqual, [(1, 'BadDeviceToken')])
+
+
+class HTTP2EndToEndTestCase(unittest.TestCase):
+  "Sends through an APNSServer to the fake provider API"
+
+  if http2 is None or http2.H2Connection is None:
+    skip = 'The HTTP/2 backend needs the h2 and cryptography packages'
+
+  def setUp(self):
+    pem = fake.self_signed_pem(bits=1024)
+    self.gateway, port = fake.listen_http2(pem, fake.FakeHTTP2Factory(
+      keep=True, fail_tokens={UNREGISTERED: 410, DEAD: 8}))
+    self.addCleanup(self.gateway.listening.stopListening)
+    self.patch(http2, 'HTTP2_SERVER_SANDBOX_HOSTNAME', '127.0.0.1')
+    self.patch(http2, 'HTTP2_SERVER_PORT', port)
+    self.server = server.APNSServer()
+    self.server.app_ids, self.server.provisioned = {}, {}
+    self.server.dead_tokens = True
+    self.server.xmlrpc_provision('app', pem, 'sandbox', 5, 1,
+                                 {'topic': 'com.example'})
+
+  def tearDown(self):
+    closed = []
+    for service in self.server.app_ids.values():
+      for client in service.clients():
+        d = defer.Deferred()
+        closed.append(d)
+        lost = client.connectionLost
+        client.connectionLost = lambda reason, lost=lost, d=d: (
+          lost(reason), d.callback(None))
+      service.disconnect()
+    return defer.DeferredList(closed)
+
+  @defer.inlineCallbacks
+  def test_reasons(self):
+    rejected = yield self.server.xmlrpc_notify(
+      'app', [LIVE, UNREGISTERED, DEAD, 'nope'], {'aps': {'alert': 'hi'}})
+    self.assertEqual([n for n, reason in rejected], [1, 2, 3])
+    self.assertEqual(map(list, rejected[:2]), [[1, 'Unregistered'],
+                                               [2, 'BadDeviceToken']])
+    self.assertEqual(self.gateway.accepted, 1)
+
+  @defer.inlineCallbacks
+  def test_unregistered(self):
+    yield self.server.xmlrpc_notify('app', [LIVE, UNREGISTERED, DEAD],
+                                    {'aps': {}})
+    feedback = yield self.server.xmlrpc_feedback('app')
+    self.assertEqual([token for when, token in feedback], [UNREGISTERED])
+    received = self.gateway.received
+    rejected = yield self.server.xmlrpc_notify(
+      'app', [UNREGISTERED, DEAD, LIVE], {'aps': {}})
+    self.assertEqual(rejected, None)
+    self.assertEqual(self.gateway.received, received + 1)
+
+  @defer.inlineCallbacks
+  def test_expired_provider_token(self):
+    self.server.xmlrpc_provision('token', '', 'sandbox', 5, 1,
+                                 {'topic': 'com.example', 'key': auth_key(),
+                                  'key_id': 'KEY', 'team_id': 'TEAM'})
+    yield self.server.xmlrpc_notify('token', LIVE, {'aps': {}})
+    token = self.server.apns_service('token').token
+    expired = token.value
+    self.gateway.expired_tokens.add(expired)
+    rejected = yield self.server.xmlrpc_notify('token', LIVE, {'aps': {}})
+    self.assertEqual(rejected, None)
+    self.assertEqual(self.gateway.accepted, 2)
+    self.assertNotEqual(token.value, expired)
+
+
+def auth_key():
+  "Returns a new APNs auth key as the contents of a .p8 file"
+  from cryptography.hazmat.backends import default_backend
+  from cryptography.hazmat.primitives import serialization
+  from cryptography.hazmat.primitives.asymmetric import ec
+  key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+  return key.private_bytes(serialization.Encoding.PEM,
+                           serialization.PrivateFormat.PKCS8,
+                           serialization.NoEncryption())
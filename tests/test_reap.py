@@ -0,0 +1,67 @@
+from twisted.trial import unittest
+from twisted.web import xmlrpc
+from pyapns import server, fake
+
+
+class Service(object):
+  "An APNSService with `open` gateway connections"
+
+  def __init__(self, open, last_used, connections=1):
+    self.factories = [None] * open
+    self.connections = connections
+    self.last_used = last_used
+    self.stats = server.Stats()
+
+  def busy(self):
+    return False
+
+  def disconnect(self):
+    self.factories = []
+
+
+class ReapTestCase(unittest.TestCase):
+  def setUp(self):
+    self.server = server.APNSServer()
+    self.server.max_connections = 2
+    self.old, self.recent = Service(1, 1), Service(1, 2)
+    self.new = Service(0, 3, connections=2)
+    self.server.app_ids = {'old': self.old, 'recent': self.recent,
+                           'new': self.new}
+
+  def test_lookup_keeps_connections(self):
+    self.server.max_connections = 1
+    self.server.provisioned = {'new': ()}
+    self.assertIdentical(self.server.apns_service('new'), self.new)
+    self.assertEqual(len(self.old.factories), 1)
+
+  def test_room_for_pending(self):
+    self.server.make_room(self.new)
+    self.assertEqual((len(self.old.factories), len(self.recent.factories)),
+                     (0, 0))
+
+
+class ProvisionTestCase(unittest.TestCase):
+  def server(self):
+    apns = server.APNSServer()
+    apns.app_ids, apns.provisioned = {}, {}
+    return apns
+
+  def test_feedback_interval(self):
+    apns = self.server()
+    apns.feedback_interval = 60
+    apns.max_connections = 1
+    connected = Service(2, 1)
+    apns.app_ids = {'other': connected}
+    apns.xmlrpc_provision('app', fake.self_signed_pem(bits=1024), 'sandbox')
+    service = apns.app_ids['app']
+    self.addCleanup(service.stopPolling)
+    self.assertNotIdentical(service.poller, None)
+    self.assertEqual((service.factories, len(connected.factories)), ([], 2))
+
+  def test_bad_certificate(self):
+    apns = self.server()
+    for cert in ('/nonexistent.pem', '-----BEGIN CERTIFICATE-----\nnope'):
+      e = self.assertRaises(xmlrpc.Fault, apns.xmlrpc_provision, 'app', cert,
+                            'sandbox')
+      self.assertEqual(e.faultCode, 401)
+    self.assertEqual(apns.provisioned, {})
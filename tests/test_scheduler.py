@@ -0,0 +1,11 @@
+from twisted.trial import unittest
+from pyapns.scheduler import Scheduler
+
+
+class SchedulerTestCase(unittest.TestCase):
+  def test_positive_settings(self):
+    self.assertRaises(ValueError, Scheduler, quantum=0)
+    self.assertRaises(ValueError, Scheduler, turn_size=-1)
+    scheduler = Scheduler()
+    self.assertRaises(ValueError, scheduler.configure, 'app', weight=0)
+    self.assertEqual(scheduler.settings, {})
@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+from twisted.trial import unittest
+from twisted.python import failure
+from twisted.internet import error
+from twisted.test.proto_helpers import StringTransport
+from pyapns import server
+from pyapns.spool import Spool, RECORD
+
+
+class SpoolTestCase(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.spool = Spool(os.path.join(self.dir, 'app.spool'))
+
+  def tearDown(self):
+    self.spool.close()
+    shutil.rmtree(self.dir)
+
+  def test_rewind(self):
+    for msg in ('M0', 'M1', 'M2'):
+      self.spool.append(msg)
+    start = self.spool.cursor
+    self.assertEqual(self.spool.read()[2], 'M0')
+    self.spool.commit(self.spool.cursor)
+    second = self.spool.cursor
+    self.assertEqual(self.spool.read()[2], 'M1')
+    self.assertEqual(self.spool.read()[2], 'M2')
+    self.spool.rewind(start) # not before what was committed
+    self.assertEqual(self.spool.read()[2], 'M1')
+    self.spool.rewind(second)
+    self.assertEqual(self.spool.read()[2], 'M1')
+
+
+class SpoolDrainTestCase(unittest.TestCase):
+  """ Spooled messages queued on a connection that is lost go out again in
+  their spooled order.
+  """
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.spool = Spool(os.path.join(self.dir, 'app.spool'))
+    self.service = server.APNSService('cert.pem', 'sandbox', spool=self.spool)
+    self.factory = server.APNSClientFactory(self.service)
+    self.service.factories = [self.factory]
+    self.size = server.SEND_QUEUE_HIGH_WATERMARK // 2
+
+  def tearDown(self):
+    self.spool.close()
+    shutil.rmtree(self.dir)
+
+  def message(self, n):
+    return ('M%i' % n).ljust(self.size, '.')
+
+  def connect(self, paused=False):
+    p = self.factory.buildProtocol(None)
+    transport = StringTransport()
+    if paused:
+      p.paused = True
+    p.makeConnection(transport)
+    return p, transport
+
+  def test_lost_connection_keeps_order(self):
+    for n in range(6):
+      self.service.write(self.message(n))
+    p, transport = self.connect(paused=True)
+    # congested after M0 and M1, the rest waits in the spool
+    self.assertEqual(len(p.queue), 2)
+    self.assertEqual(len(self.spool), 4 * (self.size + RECORD.size))
+    p.connectionLost(failure.Failure(error.ConnectionLost()))
+    self.service.write(self.message(6))
+    p, transport = self.connect()
+    written = transport.value()
+    self.assertEqual([written[i:i+2] for i in range(0, len(written), self.size)],
+                     ['M%i' % n for n in range(7)])
+    self.assertFalse(self.spool.pending())
+
+  def test_lost_connection_with_others_sends_once(self):
+    self.service.factories.append(server.APNSClientFactory(self.service))
+    for n in range(6):
+      self.service.write(self.message(n))
+    p1, _ = self.connect(paused=True)
+    self.factory = self.service.factories[1]
+    p2, transport = self.connect(paused=True)
+    self.assertEqual(len(p1.queue), 2)
+    self.assertEqual(len(p2.queue), 2)
+    p1.connectionLost(failure.Failure(error.ConnectionLost()))
+    p2.resumeProducing()
+    written = transport.value()
+    self.assertEqual(
+      sorted(written[i:i+2] for i in range(0, len(written), self.size)),
+      ['M%i' % n for n in range(6)])
+    self.assertFalse(self.spool.pending())
@@ -0,0 +1,105 @@
+import json
+import xmlrpclib
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.web import xmlrpc
+from pyapns import server, shard
+from pyapns.template import Template
+
+
+class TemplateTestCase(unittest.TestCase):
+  def render(self, notification, values):
+    return json.loads(Template(notification).render(values))
+
+  def test_render(self):
+    template = Template({'aps': {'alert': 'Hello ${name}', 'badge': '${n}'}})
+    self.assertEqual(template.order, ['n', 'name'])
+    self.assertEqual(json.loads(template.render({'name': 'Ann', 'n': 3})),
+                     {'aps': {'alert': 'Hello Ann', 'badge': 3}})
+    self.assertEqual(json.loads(template.render([4, u'\xe9"'])),
+                     {'aps': {'alert': u'Hello \xe9"', 'badge': 4}})
+
+  def test_escaped_quote(self):
+    self.assertEqual(self.render({'aps': {'alert': '"${n}'}}, {'n': 3}),
+                     {'aps': {'alert': '"3'}})
+    self.assertEqual(self.render({'aps': {'alert': '\\${n}\\'}}, {'n': 'x'}),
+                     {'aps': {'alert': '\\x\\'}})
+
+  def test_lists(self):
+    self.assertEqual(
+      self.render({'aps': {'alert': {'loc-args': ['${a}', 'b ${a}']}}},
+                  {'a': 'c'}),
+      {'aps': {'alert': {'loc-args': ['c', 'b c']}}})
+
+  def test_placeholder_in_key(self):
+    self.assertRaises(ValueError, Template, {'${n}': 1})
+    self.assertRaises(ValueError, Template, {'aps': {'a ${n}': 1}})
+
+  def test_not_a_placeholder(self):
+    self.assertEqual(self.render({'aps': {'alert': '${a-b} $'}}, {}),
+                     {'aps': {'alert': '${a-b} $'}})
+
+
+class TemplateFaultTestCase(unittest.TestCase):
+  def setUp(self):
+    self.server = server.APNSServer()
+    self.server.provisioned = {'app': ('app', 'cert.pem', 'sandbox', 15, 1,
+                                       None)}
+    self.server.templates = {}
+
+  def fault(self, *args):
+    try:
+      self.server.xmlrpc_notify_template(*args)
+    except xmlrpc.Fault, e:
+      return e.faultCode
+    self.fail('No fault raised')
+
+  def test_missing_template(self):
+    self.assertEqual(self.fault('app', 'nope', 'ab' * 32, {}), 412)
+
+  def test_unknown_app_id(self):
+    self.assertEqual(self.fault('other', 'nope', 'ab' * 32, {}), 404)
+
+
+class Supervisor(object):
+  count = 1
+
+  def socket(self, index):
+    return '/nonexistent'
+
+
+class Worker(object):
+  "Stands in for the client of a worker that was restarted"
+
+  def __init__(self):
+    self.calls = []
+    self.templates = set()
+
+  def request(self, method, params):
+    self.calls.append(method)
+    if method == 'template':
+      self.templates.add(params[1])
+    elif method == 'notify_template' and params[1] not in self.templates:
+      return defer.fail(xmlrpclib.Fault(412, 'not registered'))
+    return defer.succeed(None)
+
+
+class ShardTemplateTestCase(unittest.TestCase):
+  def test_templates_replayed(self):
+    sharded = shard.ShardedServer(Supervisor())
+    worker = sharded.clients[0] = Worker()
+    self.successResultOf(sharded.xmlrpc_template('app', 'hi', {'aps': {}}))
+    worker.templates.clear() # restarted, app is autoprovisioned
+    self.successResultOf(
+      sharded.xmlrpc_notify_template('app', 'hi', 'ab' * 32, {}))
+    self.assertEqual(worker.calls, ['template', 'notify_template', 'template',
+                                    'notify_template'])
+
+  def test_unknown_template(self):
+    sharded = shard.ShardedServer(Supervisor())
+    worker = sharded.clients[0] = Worker()
+    f = self.failureResultOf(
+      sharded.xmlrpc_notify_template('app', 'hi', 'ab' * 32, {}),
+      xmlrpc.Fault)
+    self.assertEqual(f.value.faultCode, 412)
+    self.assertEqual(worker.calls, ['notify_template'])
@@ -0,0 +1,63 @@
+import datetime
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from pyapns import wire, ingest, shard, txclient
+
+
+class Server(object):
+  def __init__(self):
+    self.calls = []
+
+  def xmlrpc_register(self, app_id, tokens, registered=None):
+    self.calls.append((app_id, tokens, registered))
+    return 1
+
+
+class Supervisor(object):
+  count = 1
+
+  def socket(self, index):
+    return '/nonexistent'
+
+
+class Worker(object):
+  "The client of a worker, writing its requests to a StringTransport"
+
+  def __init__(self):
+    self.protocol = txclient.IngestClientProtocol()
+    self.transport = proto_helpers.StringTransport()
+    self.protocol.makeConnection(self.transport)
+
+  def request(self, method, params):
+    return self.protocol.call(method, params, None)
+
+
+class WireTestCase(unittest.TestCase):
+  def test_datetime_request(self):
+    registered = datetime.datetime(2012, 3, 4, 5, 6, 7)
+    body = wire.json_request(7, 'register', ['app', ['ab' * 32], registered])
+    self.assertEqual(wire.parse_request(body),
+                     (7, 'register', ['app', ['ab' * 32], registered]))
+
+  def test_ingest_register(self):
+    server = Server()
+    protocol = ingest.IngestFactory(server).buildProtocol(None)
+    transport = proto_helpers.StringTransport()
+    protocol.makeConnection(transport)
+    registered = datetime.datetime(2012, 3, 4, 5, 6, 7)
+    protocol.dataReceived(wire.pack(
+      wire.json_request(1, 'register', ['app', ['ab' * 32], registered])))
+    self.assertEqual(server.calls, [('app', ['ab' * 32], registered)])
+    self.assertEqual(wire.parse_response(transport.value()[4:]),
+                     (1, 1, None))
+
+  def test_sharded_register(self):
+    sharded = shard.ShardedServer(Supervisor())
+    worker = sharded.clients[0] = Worker()
+    registered = datetime.datetime(2012, 3, 4, 5, 6, 7)
+    d = sharded.xmlrpc_register('app', ['ab' * 32], registered)
+    body = worker.transport.value()[4:]
+    self.assertEqual(wire.parse_request(body),
+                     (1, 'register', ['app', ['ab' * 32], registered]))
+    worker.protocol.dataReceived(wire.pack(wire.response(1, 1)))
+    self.assertEqual(self.successResultOf(d), 1)